@@ -0,0 +1,273 @@
+"""
+Offline benchmark for the bot's hot handler routes.
+
+Every route is driven with real `telegram.Update` objects against an in-process
+`FakeBot` that only records the Bot API calls it receives, so no network access
+is needed. Price providers are stubbed: the price cache is pre-filled and any
+attempt to reach a provider raises immediately.
+
+Usage:
+    python bench_handlers.py                         # run all routes
+    python bench_handlers.py -n 5000 -r zodiac       # more iterations, one route
+    python bench_handlers.py --save baseline.json    # store results as a baseline
+    python bench_handlers.py --compare baseline.json # show deltas vs a baseline
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from telegram import Update, CallbackQuery, Message, Chat, User
+
+# The bot persists caches relative to the working directory; keep benchmark runs
+# away from the real files.
+_WORKDIR = tempfile.mkdtemp(prefix="astrokit-bench-")
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+_ORIG_CWD = os.getcwd()
+sys.path.insert(0, _REPO_DIR)
+os.chdir(_WORKDIR)
+
+import bot  # noqa: E402
+from locales import ZODIAC_SIGNS  # noqa: E402
+
+
+class FakeBot:
+    """Minimal stand-in for `telegram.Bot` that records calls instead of sending them."""
+
+    id = 1000000001
+    username = "astrokit_bench_bot"
+
+    def __init__(self):
+        self.calls = {}
+
+    def _record(self, method: str):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    async def answer_callback_query(self, *args, **kwargs):
+        self._record("answerCallbackQuery")
+        return True
+
+    async def edit_message_text(self, *args, **kwargs):
+        self._record("editMessageText")
+        return True
+
+    async def send_message(self, *args, **kwargs):
+        self._record("sendMessage")
+        return True
+
+    async def send_invoice(self, *args, **kwargs):
+        self._record("sendInvoice")
+        return True
+
+
+class _OfflineRequests:
+    """Replaces the `requests` module inside `bot` so a provider call can never hit the network."""
+
+    exceptions = bot.requests.exceptions
+
+    @staticmethod
+    def get(*args, **kwargs):
+        raise RuntimeError("Network access is disabled in the benchmark")
+
+
+def stub_price_providers():
+    """Fills the price cache with fallback data and pins it as fresh."""
+    bot.requests = _OfflineRequests
+    bot._use_fallback_data()
+    bot.api_cache["last_update"] = datetime.now()
+    bot.api_cache["cache_duration"] = 10 ** 9
+
+
+def make_user(chat_id: int, lang: str):
+    """Creates a returning user with today's content already generated."""
+    info = bot.get_user_data(chat_id)
+    info["language"] = lang
+    info["is_new_user"] = False
+    bot.update_user_horoscope(chat_id)
+
+
+def make_callback_update(fake_bot: FakeBot, chat_id: int, data: str, update_id: int = 1) -> Update:
+    user = User(chat_id, "Bench", False)
+    chat = Chat(chat_id, Chat.PRIVATE)
+    message = Message(update_id, datetime.now(timezone.utc), chat, from_user=user, text="menu")
+    query = CallbackQuery(str(update_id), user, "bench", message=message, data=data)
+    update = Update(update_id, callback_query=query)
+    for obj in (update, query, message):
+        obj.set_bot(fake_bot)
+    return update
+
+
+def make_command_update(fake_bot: FakeBot, chat_id: int, command: str, update_id: int = 1) -> Update:
+    user = User(chat_id, "Bench", False)
+    chat = Chat(chat_id, Chat.PRIVATE)
+    message = Message(update_id, datetime.now(timezone.utc), chat, from_user=user, text=f"/{command}")
+    update = Update(update_id, message=message)
+    for obj in (update, message):
+        obj.set_bot(fake_bot)
+    return update
+
+
+LANGS = ["ru", "en", "zh"]
+CALLBACK_DATA = [
+    "main_menu", "horoscope_menu", "learning_tip", "settings_menu",
+    "premium_menu", "commands_info", "support_info",
+] + [f"zodiac_{sign}" for sign in ZODIAC_SIGNS["ru"]]
+
+
+def build_routes(fake_bot: FakeBot) -> dict:
+    """Returns route name -> factory producing (coroutine function, update) for iteration i."""
+    def chat_for(i):
+        return 1 + i % len(LANGS)
+
+    def button_handler(i):
+        data = CALLBACK_DATA[i % len(CALLBACK_DATA)]
+        return lambda u, c: bot.button_handler(u, c), make_callback_update(fake_bot, chat_for(i), data, i)
+
+    def zodiac(i):
+        sign = ZODIAC_SIGNS["ru"][i % 12]
+        update = make_callback_update(fake_bot, chat_for(i), f"zodiac_{sign}", i)
+        return lambda u, c: bot.show_zodiac_horoscope(u, c, sign), update
+
+    def main_menu(i):
+        return bot.show_main_menu, make_callback_update(fake_bot, chat_for(i), "main_menu", i)
+
+    def astro(i):
+        return bot.astro_command, make_command_update(fake_bot, chat_for(i), "astro", i)
+
+    def day(i):
+        return bot.day_command, make_command_update(fake_bot, chat_for(i), "day", i)
+
+    return {
+        "button_handler": button_handler,
+        "zodiac": zodiac,
+        "main_menu": main_menu,
+        "astro": astro,
+        "day": day,
+    }
+
+
+async def run_route(factory, context, iterations: int, warmup: int) -> dict:
+    """Times `iterations` calls of one route, then measures allocations in a separate pass."""
+    # Updates are built up front so their construction is not part of the measurement
+    prepared = [factory(i) for i in range(warmup + iterations)]
+    for handler, update in prepared[:warmup]:
+        await handler(update, context)
+
+    latencies = []
+    started = time.perf_counter()
+    for handler, update in prepared[warmup:]:
+        t0 = time.perf_counter()
+        await handler(update, context)
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+
+    # Allocation pass: tracemalloc slows everything down, so it never overlaps with timing
+    alloc_iterations = min(iterations, 200)
+    tracemalloc.start()
+    peaks = []
+    for handler, update in prepared[warmup:warmup + alloc_iterations]:
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        await handler(update, context)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - baseline)
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "iterations": iterations,
+        "ops_per_sec": iterations / elapsed if elapsed else 0.0,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "alloc_kib_per_op": statistics.mean(peaks) / 1024 if peaks else 0.0,
+    }
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=_REPO_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def print_results(results: dict, baseline: dict = None):
+    header = f"{'route':<16}{'ops/sec':>12}{'p50 ms':>10}{'p99 ms':>10}{'KiB/op':>10}"
+    if baseline:
+        header += f"{'Δ ops/sec':>12}{'Δ p99':>10}"
+    print(header)
+    print("-" * len(header))
+    for route, r in results.items():
+        line = f"{route:<16}{r['ops_per_sec']:>12.0f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['alloc_kib_per_op']:>10.1f}"
+        base = (baseline or {}).get(route)
+        if base:
+            d_ops = (r["ops_per_sec"] / base["ops_per_sec"] - 1) * 100 if base["ops_per_sec"] else 0.0
+            d_p99 = (r["p99_ms"] / base["p99_ms"] - 1) * 100 if base["p99_ms"] else 0.0
+            line += f"{d_ops:>+11.1f}%{d_p99:>+9.1f}%"
+        print(line)
+
+
+async def main_async(args) -> dict:
+    fake_bot = FakeBot()
+    context = SimpleNamespace(bot=fake_bot)
+    stub_price_providers()
+    for i, lang in enumerate(LANGS):
+        make_user(1 + i, lang)
+    # As at startup in main(): today's content is precomputed for every known user
+    bot.publish_daily_content()
+
+    routes = build_routes(fake_bot)
+    selected = args.routes or list(routes)
+    results = {}
+    for name in selected:
+        results[name] = await run_route(routes[name], context, args.iterations, args.warmup)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of AstroKit handler routes")
+    parser.add_argument("-n", "--iterations", type=int, default=2000)
+    parser.add_argument("-w", "--warmup", type=int, default=100)
+    parser.add_argument("-r", "--routes", nargs="+",
+                        choices=["button_handler", "zodiac", "main_menu", "astro", "day"])
+    parser.add_argument("--save", metavar="FILE", help="write results to a baseline JSON file")
+    parser.add_argument("--compare", metavar="FILE", help="compare results against a baseline JSON file")
+    parser.add_argument("--verbose-logs", action="store_true", help="keep the bot's INFO logging enabled")
+    args = parser.parse_args()
+
+    if not args.verbose_logs:
+        logging.getLogger().setLevel(logging.WARNING)
+        bot.logger.setLevel(logging.WARNING)
+
+    results = asyncio.run(main_async(args))
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(_ORIG_CWD, args.compare)) as f:
+            baseline = json.load(f)["routes"]
+    print_results(results, baseline)
+
+    if args.save:
+        path = os.path.join(_ORIG_CWD, args.save)
+        with open(path, "w") as f:
+            json.dump({
+                "revision": _git_revision(),
+                "timestamp": datetime.now().isoformat(),
+                "python": sys.version.split()[0],
+                "routes": results,
+            }, f, indent=4)
+        print(f"Baseline saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Encode/decode throughput of the JSON codecs on a synthetic `user_data` payload.
+
+The payload has the same shape as the bot's `user_data` (int chat IDs, a date,
+a tip index and twelve horoscope indices per user). Every codec that is
+installed is measured: stdlib `json` (also in the old indent=4 + deep-copy form
+that `save_user_data_to_file` used), `orjson` and `msgspec`.
+
+Usage:
+    python bench_json.py                  # 1,000,000 users
+    python bench_json.py --users 100000 --repeat 5
+"""
+import argparse
+import json
+import random
+import time
+from datetime import date
+
+from locales import ZODIAC_SIGNS
+
+
+def make_user_data(users: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    today = date.today()
+    langs = ["ru", "en", "zh", None]
+    return {
+        100000000 + i: {
+            "language": langs[i % len(langs)],
+            "last_update": today,
+            "tip_index": rng.randrange(50),
+            "horoscope_indices": {sign: rng.randrange(2835) for sign in ZODIAC_SIGNS["ru"]},
+            "utc_offset": None,
+            "is_new_user": False,
+        }
+        for i in range(users)
+    }
+
+
+def stdlib_legacy_encode(obj) -> bytes:
+    """What save_user_data_to_file did before the codec: a json round trip as deep copy, then indent=4."""
+    return json.dumps(json.loads(json.dumps(obj, default=str)), indent=4).encode()
+
+
+def stdlib_encode(obj) -> bytes:
+    return json.dumps(obj, default=str, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def available_codecs() -> dict:
+    """Returns codec name -> (encode, decode)."""
+    codecs = {
+        "json (indent=4, copy)": (stdlib_legacy_encode, json.loads),
+        "json": (stdlib_encode, json.loads),
+    }
+    try:
+        import orjson
+        codecs["orjson"] = (
+            lambda obj: orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS),
+            orjson.loads,
+        )
+    except ImportError:
+        pass
+    try:
+        import msgspec
+        encoder = msgspec.json.Encoder()
+        # msgspec only accepts str keys for JSON objects, so the top level is converted first
+        codecs["msgspec"] = (
+            lambda obj: encoder.encode({str(k): v for k, v in obj.items()}),
+            msgspec.json.decode,
+        )
+    except ImportError:
+        pass
+    return codecs
+
+
+def best_of(fn, arg, repeat: int):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(arg)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON codec benchmark on a user_data-shaped payload")
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"Building user_data with {args.users:,} users...", flush=True)
+    payload = make_user_data(args.users)
+
+    header = f"{'codec':<24}{'size MB':>10}{'encode s':>10}{'MB/s':>9}{'decode s':>10}{'MB/s':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, (encode, decode) in available_codecs().items():
+        encode_s, data = best_of(encode, payload, args.repeat)
+        decode_s, _ = best_of(decode, data, args.repeat)
+        size_mb = len(data) / 2 ** 20
+        print(f"{name:<24}{size_mb:>10.1f}{encode_s:>10.3f}{size_mb / encode_s:>9.0f}"
+              f"{decode_s:>10.3f}{size_mb / decode_s:>9.0f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,43 @@
 import logging
+import logging.handlers
 import os
+import queue
+import atexit
 import threading
 import time
 import requests
 import asyncio
 import random
 import json
-from datetime import datetime, date, timedelta
-import pytz
+import math
+import base64
+import sqlite3
+import sys
+import cProfile
+import traceback
+import contextvars
+from array import array
+from collections import OrderedDict, deque
+from io import BytesIO
+from datetime import datetime, date, timedelta, timezone, time as dt_time
+from functools import lru_cache
+from types import MappingProxyType
+from typing import NamedTuple
 from flask import Flask
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, SuccessfulPayment
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, JobQueue, ChatMemberHandler, filters, PreCheckoutQueryHandler, MessageHandler
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, SuccessfulPayment, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, JobQueue, ChatMemberHandler, filters, PreCheckoutQueryHandler, MessageHandler, TypeHandler, BaseUpdateProcessor, InlineQueryHandler
 from telegram.constants import ParseMode
 from telegram.helpers import escape_markdown
-from telegram.error import TelegramError, BadRequest, Conflict
+from telegram.request import HTTPXRequest
+from telegram.error import TelegramError, BadRequest, Conflict, Forbidden, ChatMigrated
 from locales import TEXTS, ZODIAC_SIGNS, ZODIAC_CALLBACK_MAP, ZODIAC_EMOJIS
 
+# Pillow нужен только для картинок с графиком курсов (/chart); без него команда отвечает текстом
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
 # --- Helper Functions ---
 
 def get_text(key: str, lang: str) -> str:
@@ -23,23 +45,224 @@ def get_text(key: str, lang: str) -> str:
     return TEXTS.get(key, {}).get(lang, TEXTS.get(key, {}).get("ru", key))
 
 def get_user_lang(chat_id: int) -> str:
-    """Gets the user's selected language, defaulting to Russian."""
-    lang = get_user_data(chat_id).get("language")
+    """Gets the user's selected language, defaulting to Russian; unknown users are not created."""
+    lang = user_data.get(chat_id, {}).get("language")
     return lang if lang else "ru"
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Настройка логирования: обработчики только кладут записи в очередь, а форматирование
+# и вывод выполняет отдельный поток (QueueListener). LOG_FORMAT=json включает вывод
+# JSON-строками; LOG_RATE_LIMIT ограничивает число записей ниже WARNING в секунду
+# с одного места вызова. Предупреждения и ошибки не отбрасываются никогда
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_RATE_LIMIT = int(os.environ.get('LOG_RATE_LIMIT', 20))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+# Счётчики отброшенных записей (экспортируются в /metrics)
+log_stats = {"dropped": 0, "rate_limited": 0}
+
+class LogRateLimiter(logging.Filter):
+    """Passes at most `limit` records per second per call site below WARNING."""
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        self.windows = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.limit <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        second = int(record.created)
+        window = self.windows.get(key)
+        if window is None or window[0] != second:
+            window = self.windows[key] = [second, 0]
+        window[1] += 1
+        if window[1] > self.limit:
+            log_stats["rate_limited"] += 1
+            return False
+        return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records unformatted, so message formatting happens on the listener thread.
+    Records below WARNING are dropped (and counted) when the queue is full; warnings and
+    errors wait for room instead.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_stats["dropped"] += 1
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "where": f"{record.funcName}:{record.lineno}",
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging() -> logging.handlers.QueueListener:
+    output = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(LogRateLimiter(LOG_RATE_LIMIT))
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет строку INFO на каждый запрос к Bot API
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    # При выходе дописываем всё, что осталось в очереди
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
+# --- JSON codec ---
+
+# Все файлы и ответы источников кодируются через json_dumps/json_loads: orjson, если он
+# установлен, иначе стандартный json. JSON_CODEC=json принудительно включает стандартный
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None and os.environ.get('JSON_CODEC', 'orjson') == 'orjson':
+    JSON_CODEC = "orjson"
+
+    def json_dumps(obj, pretty: bool = False) -> bytes:
+        """Encodes to UTF-8 JSON bytes; non-string keys become strings, unknown types go through str()."""
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        return orjson.dumps(obj, default=str, option=option)
+
+    json_loads = orjson.loads
+else:
+    JSON_CODEC = "json"
+
+    def json_dumps(obj, pretty: bool = False) -> bytes:
+        """Encodes to UTF-8 JSON bytes; non-string keys become strings, unknown types go through str()."""
+        if pretty:
+            return json.dumps(obj, default=str, ensure_ascii=False, indent=2).encode()
+        return json.dumps(obj, default=str, ensure_ascii=False, separators=(",", ":")).encode()
+
+    json_loads = json.loads
+
+def read_json_file(path: str):
+    with open(path, "rb") as f:
+        return json_loads(f.read())
+
+def write_json_file(path: str, obj, pretty: bool = False):
+    """Writes JSON through a temporary file, so a crash never leaves a truncated file behind."""
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(json_dumps(obj, pretty))
+    os.replace(f"{path}.tmp", path)
+
+# --- Metrics ---
+
+# Метрики в формате Prometheus (имя с метками -> значение), отдаются Flask-сервером на /metrics
+metrics = {}
+
+def metric_inc(name: str, amount: float = 1):
+    """Increments a counter metric."""
+    metrics[name] = metrics.get(name, 0) + amount
+
+def metric_set(name: str, value: float):
+    """Sets a gauge metric."""
+    metrics[name] = value
+
+def metric_max(name: str, value: float):
+    """Keeps the maximum observed value of a gauge metric."""
+    if value > metrics.get(name, float("-inf")):
+        metrics[name] = value
+
+def render_metrics() -> str:
+    """Renders all metrics in the Prometheus text exposition format."""
+    export_user_stats()
+    user_data.export_metrics()
+    metric_set("logs_dropped_total", log_stats["dropped"])
+    metric_set("logs_rate_limited_total", log_stats["rate_limited"])
+    return "".join(f"{name} {value}\n" for name, value in sorted(metrics.items()))
+
 BOT_TOKEN = os.environ.get('BOT_TOKEN', '')
 
+# Адрес Bot API (например, локальный стенд из loadtest.py: http://127.0.0.1:8081/bot)
+BOT_API_BASE_URL = os.environ.get('BOT_API_BASE_URL', '')
+
+# Администраторы бота (ID через запятую) — им доступны служебные команды
+ADMIN_IDS = {int(x) for x in os.environ.get('ADMIN_IDS', '').replace(' ', '').split(',') if x}
+
+# Профилирование: каталог для результатов и автозапуск на N секунд при старте
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_ON_START = int(os.environ.get('PROFILE_ON_START', 0))
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile')  # cprofile | sample
+
+# Сторожевой таймер event loop: порог блокировки и период пульса (0 — выключен)
+LOOP_WATCHDOG_THRESHOLD_MS = int(os.environ.get('LOOP_WATCHDOG_THRESHOLD_MS', 250))
+LOOP_WATCHDOG_INTERVAL_MS = int(os.environ.get('LOOP_WATCHDOG_INTERVAL_MS', 50))
+
+# Сколько апдейтов из разных чатов обрабатывается одновременно (1 — последовательно)
+MAX_CONCURRENT_UPDATES = int(os.environ.get('MAX_CONCURRENT_UPDATES', 16))
+
+# Пауза между запросами getUpdates (секунды). getUpdates — long polling (timeout=30), поэтому
+# без паузы бот не крутится вхолостую, а пауза добавляется к задержке ответа на каждое нажатие
+POLL_INTERVAL = float(os.environ.get('POLL_INTERVAL', 0))
+
+# Исходящие запросы к Bot API: доли параллельности и скорости (запросов/с) по классам
+# приоритета, от высшего к низшему, и общий лимит скорости бота. Старшие классы, когда
+# младшие простаивают, занимают свободную часть общего лимита сверх своей доли
+OUTBOUND_LIMITS = {
+    # ответы на нажатия кнопок
+    "interactive": {
+        "concurrency": int(os.environ.get('OUTBOUND_INTERACTIVE_CONCURRENCY', 16)),
+        "rate": float(os.environ.get('OUTBOUND_INTERACTIVE_RATE', 20)),
+    },
+    # ответы на команды
+    "commands": {
+        "concurrency": int(os.environ.get('OUTBOUND_COMMANDS_CONCURRENCY', 8)),
+        "rate": float(os.environ.get('OUTBOUND_COMMANDS_RATE', 10)),
+    },
+    # массовые рассылки
+    "broadcast": {
+        "concurrency": int(os.environ.get('OUTBOUND_BROADCAST_CONCURRENCY', 2)),
+        "rate": float(os.environ.get('OUTBOUND_BROADCAST_RATE', 5)),
+    },
+}
+OUTBOUND_TOTAL_RATE = float(os.environ.get('OUTBOUND_TOTAL_RATE', 30))
+RATE_LIMITED_METHOD_PREFIXES = ("send", "edit", "copy", "forward")
+
+# Файл для записи входящих апдейтов (JSONL) для последующего воспроизведения в loadtest.py
+RECORD_UPDATES_FILE = os.environ.get('RECORD_UPDATES_FILE', '')
+
 # Конфигурация API для получения курсов криптовалют (множественные источники)
+# Адреса можно переопределить (например, на локальные стенды из fake_providers.py)
 CRYPTO_APIS = {
     "coingecko": {
-        "url": "https://api.coingecko.com/api/v3/simple/price",
+        "url": os.environ.get("COINGECKO_API_URL", "https://api.coingecko.com/api/v3/simple/price"),
         "params": {
             "ids": "bitcoin,ethereum,the-open-network",
             "vs_currencies": "usd",
@@ -50,11 +273,11 @@ CRYPTO_APIS = {
         }
     },
     "binance": {
-        "url": "https://api.binance.com/api/v3/ticker/24hr",
+        "url": os.environ.get("BINANCE_API_URL", "https://api.binance.com/api/v3/ticker/24hr"),
         "symbols": ["BTCUSDT", "ETHUSDT", "TONUSDT"]
     },
     "cryptocompare": {
-        "url": "https://min-api.cryptocompare.com/data/pricemultifull",
+        "url": os.environ.get("CRYPTOCOMPARE_API_URL", "https://min-api.cryptocompare.com/data/pricemultifull"),
         "params": {
             "fsyms": "BTC,ETH,TON",
             "tsyms": "USD"
@@ -62,84 +285,390 @@ CRYPTO_APIS = {
     }
 }
 
+# Валюты отображения цен. Курсы источников запрашиваются только в USD, остальные
+# валюты считаются локально по редко обновляемой таблице FX-курсов
+FIAT_CURRENCIES = {"USD": "$", "EUR": "€", "RUB": "₽", "CNY": "¥"}
+DEFAULT_CURRENCY_BY_LANG = {"ru": "RUB", "en": "USD", "zh": "CNY"}
+FX_API_URL = os.environ.get("FX_API_URL", "https://open.er-api.com/v6/latest/USD")
+FX_REFRESH_INTERVAL = int(os.environ.get('FX_REFRESH_INTERVAL', 6 * 3600))
+FALLBACK_FX_RATES = {"USD": 1.0, "EUR": 0.92, "RUB": 92.0, "CNY": 7.2}
+
+# Бесплатные лимиты источников курсов (оценка, с запасом): запросов за одно обновление,
+# в минуту и в сутки (UTC). Планировщик квот не даёт выйти за любой из них
+PROVIDER_QUOTAS = {
+    "coingecko": {"cost": 1, "minute": 10, "day": 330},
+    "binance": {"cost": 3, "minute": 1200, "day": 100000},
+    "cryptocompare": {"cost": 1, "minute": 50, "day": 3300},
+}
+
+# На сколько секунд источник исключается из выбора после ошибки или 429
+PROVIDER_FAILURE_COOLDOWN = int(os.environ.get('PROVIDER_FAILURE_COOLDOWN', 60))
+
+# Верхняя граница cache_time для ответов на inline-запросы (секунды)
+INLINE_CACHE_TIME_MAX = int(os.environ.get('INLINE_CACHE_TIME_MAX', 300))
+
+# Адаптивное обновление курсов: интервал сжимается к минимуму при активных запросах
+# и растягивается до максимума в простое. PRICE_REFRESH_DEMAND_RPM — число запросов
+# курсов в минуту, при котором интервал вдвое короче максимального
+PRICE_REFRESH_MIN_INTERVAL = int(os.environ.get('PRICE_REFRESH_MIN_INTERVAL', 60))
+PRICE_REFRESH_MAX_INTERVAL = int(os.environ.get('PRICE_REFRESH_MAX_INTERVAL', 1800))
+PRICE_REFRESH_DEMAND_RPM = float(os.environ.get('PRICE_REFRESH_DEMAND_RPM', 3))
+
+# Версия формата cache.json; файлы другой версии или старше CACHE_MAX_AGE секунд не загружаются
+CACHE_SCHEMA_VERSION = 2
+CACHE_MAX_AGE = int(os.environ.get('CACHE_MAX_AGE', PRICE_REFRESH_MAX_INTERVAL))
+
+# «День» бота наступает в полночь по часовому поясу пользователя (или чата рассылки).
+# Пояс хранится как смещение от UTC в минутах; по умолчанию — Москва
+DEFAULT_UTC_OFFSET = 180
+
+# Смещения, предлагаемые в меню настроек
+TIMEZONE_CHOICES = [-480, -300, -180, 0, 60, 120, 180, 240, 300, 330, 420, 480, 540, 600]
+
+# Во сколько (по местному времени пояса) заранее готовится контент следующего дня
+DAILY_CONTENT_PREPARE_TIME = os.environ.get('DAILY_CONTENT_PREPARE_TIME', '23:50')
+
 CRYPTO_IDS = {
     "btc": "bitcoin",
     "eth": "ethereum", 
     "ton": "the-open-network"
 }
 
-# Хранение данных пользователей (индивидуально для каждого пользователя)
-user_data = {}
+# Хранение данных пользователей: в памяти только USER_CACHE_SIZE недавно активных (LRU),
+# остальные — в SQLite (USER_STORE_PATH) и подгружаются при следующем обращении
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 20000))
+USER_STORE_PATH = os.environ.get('USER_STORE_PATH', 'user_data.db')
+# Вытесненные записи пишутся на диск пачками такого размера
+USER_STORE_WRITE_BATCH = int(os.environ.get('USER_STORE_WRITE_BATCH', 1000))
 
-# Глобальное хранилище курсов криптовалют с кэшированием
-crypto_prices = {
-    "btc": {"price": None, "change": None, "last_update": None, "source": None},
-    "eth": {"price": None, "change": None, "last_update": None, "source": None},
-    "ton": {"price": None, "change": None, "last_update": None, "source": None}
-}
+class UserStore:
+    """
+    The user_data mapping with a bounded hot tier. The most recently used users stay in memory
+    as plain dicts (mutated in place, as before); the least recently used one is evicted when
+    the tier exceeds `capacity` and faulted back in from SQLite on its next lookup.
+    Evicted entries are buffered and written in batches; flush() writes everything back.
+    Full scans (iteration, items()) stream cold users from disk without caching them.
+
+    Chats pinned while an update of theirs is being handled are never evicted, so a handler
+    holding a user's dict across an await never writes to a copy that was already saved.
+    The store is shared by the event loop, executor jobs and the metrics thread: every
+    access to the tiers and the connection goes through `lock`.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self.capacity = capacity
+        self.hot = OrderedDict()
+        self.pending = {}
+        self.pinned = {}
+        self.size = 0
+        self.lock = threading.RLock()
+        self._db = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """Opens the store on first use."""
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS users (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+            self.size = self._db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        return self._db
+
+    def _load(self, chat_id: int):
+        """Looks a user up below the hot tier and makes it hot; returns None if unknown."""
+        info = self.pending.pop(chat_id, None)
+        if info is None:
+            row = self.db.execute("SELECT data FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is None:
+                return None
+            info = json_loads(row[0])
+        metric_inc("user_cache_misses_total")
+        self.hot[chat_id] = info
+        self._evict()
+        return info
+
+    def _evict(self):
+        skipped = 0
+        while len(self.hot) > self.capacity and skipped < len(self.hot):
+            chat_id, info = self.hot.popitem(last=False)
+            if chat_id in self.pinned:
+                self.hot[chat_id] = info  # обработчик ещё держит запись — вытесним следующую
+                skipped += 1
+                continue
+            self.pending[chat_id] = info
+            metric_inc("user_cache_evictions_total")
+        if len(self.pending) >= USER_STORE_WRITE_BATCH:
+            self._write(self.pending.items())
+            self.pending.clear()
+
+    def _write(self, entries):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO users (chat_id, data) VALUES (?, ?)",
+                ((chat_id, json_dumps(info)) for chat_id, info in entries),
+            )
+
+    def __contains__(self, chat_id) -> bool:
+        return self.get(chat_id) is not None
+
+    def __getitem__(self, chat_id: int) -> dict:
+        info = self.get(chat_id)
+        if info is None:
+            raise KeyError(chat_id)
+        return info
+
+    def get(self, chat_id: int, default=None):
+        with self.lock:
+            info = self.hot.get(chat_id)
+            if info is not None:
+                self.hot.move_to_end(chat_id)
+                metric_inc("user_cache_hits_total")
+                return info
+            info = self._load(chat_id)
+        return default if info is None else info
+
+    def peek(self, chat_id: int):
+        """Returns a user's data without making it hot: a cold user is decoded from disk and not cached."""
+        with self.lock:
+            info = self.hot.get(chat_id)
+            if info is None:
+                info = self.pending.get(chat_id)
+            if info is None:
+                row = self.db.execute("SELECT data FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+                info = json_loads(row[0]) if row is not None else None
+        return info
+
+    def __setitem__(self, chat_id: int, info: dict):
+        with self.lock:
+            if chat_id not in self:
+                self.size += 1
+            self.hot[chat_id] = info
+            self.hot.move_to_end(chat_id)
+            self._evict()
+
+    def __len__(self) -> int:
+        with self.lock:
+            self.db  # the size is read when the store is opened
+            return self.size
+
+    def pin(self, chat_id: int):
+        """Keeps a chat's entry in the hot tier until the matching unpin()."""
+        with self.lock:
+            self.pinned[chat_id] = self.pinned.get(chat_id, 0) + 1
+
+    def unpin(self, chat_id: int):
+        with self.lock:
+            if self.pinned[chat_id] > 1:
+                self.pinned[chat_id] -= 1
+            else:
+                del self.pinned[chat_id]
+            self._evict()
+
+    def _snapshot(self, with_data: bool):
+        """
+        Yields the memory tiers (copied and deduplicated under the lock), then the cold users page
+        by page. Each ID is yielded once even if it moves between tiers during the scan.
+        """
+        with self.lock:
+            memory = dict(self.pending)
+            memory.update(self.hot)
+        yield from (memory.items() if with_data else memory)
+        query = (
+            "SELECT chat_id, data FROM users WHERE chat_id > ? ORDER BY chat_id LIMIT ?" if with_data
+            else "SELECT chat_id FROM users WHERE chat_id > ? ORDER BY chat_id LIMIT ?"
+        )
+        last = -(1 << 63)
+        while True:
+            with self.lock:
+                rows = self.db.execute(query, (last, USER_STORE_WRITE_BATCH)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            for row in rows:
+                if row[0] not in memory:
+                    yield (row[0], json_loads(row[1])) if with_data else row[0]
+
+    def items(self):
+        """Yields every (chat_id, info); cold users are decoded from disk and not made hot."""
+        return self._snapshot(with_data=True)
+
+    def __iter__(self):
+        return self._snapshot(with_data=False)
+
+    def flush(self):
+        """Writes the hot tier and the eviction buffer to disk."""
+        with self.lock:
+            self._write(list(self.hot.items()) + list(self.pending.items()))
+            self.pending.clear()
+
+    def import_entries(self, entries: dict):
+        """Bulk-loads users (migration from user_data.json) straight to disk."""
+        with self.lock:
+            self._write(entries.items())
+            self.size = self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def export_metrics(self):
+        with self.lock:
+            metric_set("user_cache_size", len(self.hot))
+            metric_set("users_stored", self.size)
+
+user_data = UserStore(USER_STORE_PATH, USER_CACHE_SIZE)
+
+class CoinQuote(NamedTuple):
+    """Price and 24h change of one coin as fetched from a provider."""
+    price: float
+    change: float
+    last_update: datetime
+    source: str
+
+class PriceSnapshot(NamedTuple):
+    """
+    Immutable view of all coin quotes at one refresh. Each refresh publishes a new
+    snapshot with a single reference swap, so readers always see one consistent set
+    of prices, sources and timestamps; `version` grows with every publication.
+    """
+    version: int
+    quotes: MappingProxyType
+    fetched_at: datetime = None
+
+    def latest_quote(self):
+        """Returns the most recently updated quote, or None if there are no prices yet."""
+        return max(self.quotes.values(), key=lambda quote: quote.last_update, default=None)
+
+# Текущий снимок курсов криптовалют (заменяется целиком при каждом обновлении)
+price_snapshot = PriceSnapshot(0, MappingProxyType({}))
+price_publish_lock = threading.Lock()
+
+# Последние опубликованные цены (USD) для спарклайнов на картинках /chart
+price_history = deque(maxlen=int(os.environ.get('PRICE_HISTORY_LENGTH', 288)))
+
+def publish_prices(quotes: dict, fetched_at: datetime = None) -> PriceSnapshot:
+    """
+    Publishes a new snapshot with the given quotes. Coins missing from `quotes`
+    (partial provider coverage) keep their previous quote.
+    """
+    global price_snapshot
+    # Обновление может идти одновременно из обработчика и из потока задачи
+    with price_publish_lock:
+        previous = price_snapshot
+        merged = dict(previous.quotes)
+        merged.update(quotes)
+        price_snapshot = PriceSnapshot(previous.version + 1, MappingProxyType(merged), fetched_at or datetime.now())
+        if any(quote.source != "fallback" for quote in quotes.values()):
+            price_history.append((price_snapshot.fetched_at, {symbol: quote.price for symbol, quote in merged.items()}))
+    metric_set("price_snapshot_version", price_snapshot.version)
+    prebuild_inline_results()
+    return price_snapshot
 
 # Кэш для API запросов
 api_cache = {
     "last_update": None,
-    "cache_duration": 290,  # 4 минуты 50 секунд, чуть меньше интервала обновления
+    "cache_duration": 290,  # Текущий интервал обновления, пересчитывается price_refresh_job
     "failed_attempts": 0, # Оставлено для обратной совместимости кэша
     "current_source": "coingecko"
 }
 
 def save_cache_to_file():
-    """Сохранение кэша в файл"""
+    """
+    Сохранение кэша в файл: типизированный снимок со схемой версии CACHE_SCHEMA_VERSION.
+    Время хранится как UNIX timestamp, поэтому после загрузки снова становится datetime.
+    """
+    snapshot = price_snapshot
+    last_update = api_cache["last_update"]
+    cache_data = {
+        "schema": CACHE_SCHEMA_VERSION,
+        "saved_at": time.time(),
+        "version": snapshot.version,
+        "fetched_at": snapshot.fetched_at.timestamp() if snapshot.fetched_at else None,
+        "quotes": {
+            symbol: [quote.price, quote.change, quote.last_update.timestamp(), quote.source]
+            for symbol, quote in snapshot.quotes.items()
+        },
+        "last_update": last_update.timestamp() if last_update else None,
+        "current_source": api_cache["current_source"],
+    }
     try:
-        cache_data = {
-            "crypto_prices": crypto_prices,
-            "api_cache": api_cache,
-            "timestamp": datetime.now().isoformat()
-        }
-        with open("cache.json", "w") as f:
-            json.dump(cache_data, f, default=str)
+        write_json_file("cache.json", cache_data)
         logger.info("💾 Кэш сохранен в файл")
     except Exception as e:
         logger.error(f"Ошибка сохранения кэша: {e}")
 
 def save_user_data_to_file():
-    """Saves user data to a file, handling date objects."""
+    """Writes the in-memory users back to the user store; dates are written as strings by the codec."""
     try:
-        # Create a deep copy to avoid modifying the original data
-        data_to_save = json.loads(json.dumps(user_data, default=str))
-
-        with open("user_data.json", "w") as f:
-            json.dump(data_to_save, f, indent=4)
+        user_data.flush()
+        save_user_stats()
         logger.info("💾 User data saved to file")
     except Exception as e:
         logger.error(f"Error saving user data: {e}")
 
 def load_user_data_from_file():
-    """Loads user data from a file."""
-    global user_data
+    """Opens the user store (importing user_data.json on first start) and rebuilds the indexes."""
     try:
-        with open("user_data.json", "r") as f:
-            user_data = json.load(f)
+        if not len(user_data) and os.path.exists("user_data.json"):
             # Convert integer keys back from string
-            user_data = {int(k): v for k, v in user_data.items()}
-            logger.info("📂 User data loaded from file")
-    except FileNotFoundError:
-        logger.info("📂 User data file not found, starting with empty data")
+            user_data.import_entries({int(k): v for k, v in read_json_file("user_data.json").items()})
+            logger.info(f"📂 user_data.json imported into {USER_STORE_PATH}")
+        rebuild_user_indexes()
+        logger.info(f"📂 User data loaded: {len(user_data)} users ({JSON_CODEC})")
     except Exception as e:
         logger.error(f"Error loading user data: {e}")
 
 
+def _cache_number(value, optional: bool = False):
+    """Validates a number read from cache.json."""
+    if value is None and optional:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"expected a number, got {value!r}")
+    return value
+
 def load_cache_from_file():
-    """Загрузка кэша из файла"""
+    """
+    Загрузка кэша из файла. Возвращает True, только если снимок совместим по схеме и
+    не старше CACHE_MAX_AGE — иначе при запуске курсы запрашиваются заново.
+    """
+    global price_snapshot
     try:
-        with open("cache.json", "r") as f:
-            cache_data = json.load(f)
-        
+        cache_data = read_json_file("cache.json")
+
+        if not isinstance(cache_data, dict) or cache_data.get("schema") != CACHE_SCHEMA_VERSION:
+            logger.warning("📂 Кэш в несовместимом формате, игнорируем")
+            return False
+        age = time.time() - _cache_number(cache_data.get("saved_at"))
+        if age > CACHE_MAX_AGE:
+            logger.info(f"📂 Кэш устарел ({age:.0f} с), игнорируем")
+            return False
+
+        quotes = {}
+        for symbol, (price, change, updated_at, source) in cache_data["quotes"].items():
+            if symbol not in CRYPTO_IDS or not isinstance(source, str):
+                raise ValueError(f"invalid quote for {symbol!r}")
+            quotes[symbol] = CoinQuote(
+                _cache_number(price), _cache_number(change),
+                datetime.fromtimestamp(_cache_number(updated_at)), source
+            )
+        fetched_at = _cache_number(cache_data.get("fetched_at"), optional=True)
+        last_update = _cache_number(cache_data.get("last_update"), optional=True)
+        current_source = cache_data.get("current_source")
+
         # Восстанавливаем данные
-        global crypto_prices, api_cache
-        crypto_prices = cache_data.get("crypto_prices", crypto_prices)
-        api_cache = cache_data.get("api_cache", api_cache)
-        
-        logger.info("📂 Кэш загружен из файла")
-        return True
+        with price_publish_lock:
+            price_snapshot = PriceSnapshot(
+                int(_cache_number(cache_data["version"])),
+                MappingProxyType(quotes),
+                datetime.fromtimestamp(fetched_at) if fetched_at is not None else None
+            )
+        metric_set("price_snapshot_version", price_snapshot.version)
+        api_cache["last_update"] = datetime.fromtimestamp(last_update) if last_update is not None else None
+        if current_source in CRYPTO_APIS:
+            api_cache["current_source"] = current_source
+
+        logger.info(f"📂 Кэш загружен из файла (версия {price_snapshot.version}, возраст {age:.0f} с)")
+        # Резервные данные — не повод пропускать запрос к источникам при запуске
+        return any(quote.source != "fallback" for quote in quotes.values())
     except FileNotFoundError:
         logger.info("📂 Файл кэша не найден, используем значения по умолчанию")
         return False
@@ -154,192 +683,960 @@ FALLBACK_DATA = {
     "ton": {"price": 7.50, "change": 2.5, "source": "fallback"}
 }
 
-def generate_multilingual_horoscopes():
-    """Generates a database of structured and grammatically correct horoscopes for all supported languages."""
-    supported_langs = ["ru", "en", "zh"]
-    templates = [
-        {
-            "ru": "Движение BTC создает фон для TON. Отличное время для изучения {theme}, звезды рекомендуют {action} {asset}.",
-            "en": "BTC's movement is setting the stage for TON. A great time to study {theme}, the stars recommend to {action} {asset}.",
-            "zh": "BTC的走势正在为TON铺平道路。现在是研究{theme}的大好时机，星象建议{action}{asset}。"
-        },
-        {
-            "ru": "Экосистема TON сегодня в центре внимания. Ваша энергия на пике, что идеально для {theme}. Звезды также предлагают {action} {asset}.",
-            "en": "The TON ecosystem is in the spotlight today. Your energy is at its peak, which is perfect for {theme}. The stars also suggest to {action} {asset}.",
-            "zh": "TON生态系统今天备受关注。您的精力充沛，非常适合{theme}。星象也建议{action}{asset}。"
-        },
-        {
-            "ru": "Сеть TON гудит от активности. Это может быть хороший день, чтобы {action} {asset} и следить за новостями.",
-            "en": "The TON network is buzzing with activity. This could be a good day to {action} {asset} and watch the news.",
-            "zh": "TON网络活动频繁。今天可能是{action}{asset}并关注新闻的好日子。"
-        },
-        {
-            "ru": "Ваша интуиция по поводу {theme} может привести к успеху. Сегодня хороший день, чтобы {action} {asset}.",
-            "en": "Your intuition about {theme} could lead to success. Today is a good day to {action} {asset}.",
-            "zh": "您对{theme}的直觉可能会带来成功。今天是{action}{asset}的好日子。"
-        },
-        {
-            "ru": "Анализ {theme} показывает, что сейчас важно {action} {asset}. Будьте внимательны к сигналам рынка.",
-            "en": "Analysis of {theme} shows that it is now important to {action} {asset}. Pay attention to market signals.",
-            "zh": "对{theme}的分析表明，现在{action}{asset}非常重要。请注意市场信号。"
-        }
-    ]
-    themes = [
-        {"ru": "DeFi в сети TON", "en": "DeFi on the TON network", "zh": "TON网络上的DeFi"},
-        {"ru": "рынка Jetton'ов", "en": "the Jetton market", "zh": "Jetton市场"},
-        {"ru": "NFT на Getgems/Fragment", "en": "NFTs on Getgems/Fragment", "zh": "Getgems/Fragment上的NFT"},
-        {"ru": "P2E-игр на TON", "en": "P2E games on TON", "zh": "TON上的P2E游戏"},
-        {"ru": "стейкинга TON", "en": "staking TON", "zh": "质押TON"},
-        {"ru": "корреляции TON и BTC", "en": "the correlation between TON and BTC", "zh": "TON与BTC的相关性"},
-        {"ru": "рыночных настроений", "en": "market sentiment", "zh": "市场情绪"},
-        {"ru": "индекса страха и жадности", "en": "the Fear & Greed Index", "zh": "恐惧与贪婪指数"},
-        {"ru": "циклов FOMO и FUD", "en": "FOMO and FUD cycles", "zh": "FOMO与FUD周期"}
-    ]
-    actions = [
-        {"ru": "присмотреться к", "en": "take a closer look at", "zh": "仔细研究", "case": "dative"},
-        {"ru": "искать новые возможности в", "en": "look for new opportunities in", "zh": "寻找新机会", "case": "prepositional"},
-        {"ru": "увеличить позиции в", "en": "increase positions in", "zh": "增加仓位", "case": "prepositional"},
-        {"ru": "зафиксировать прибыль от", "en": "take profits from", "zh": "获利了结", "case": "genitive"},
-        {"ru": "провести исследование по", "en": "conduct research on", "zh": "进行研究", "case": "dative"},
-        {"ru": "следить за", "en": "keep an eye on", "zh": "关注", "case": "instrumental"},
-        {"ru": "анализировать", "en": "to analyze", "zh": "分析", "case": "nominative"},
-        {"ru": "противостоять", "en": "to resist", "zh": "抵制", "case": "dative"},
-        {"ru": "избегать", "en": "to avoid", "zh": "避免", "case": "genitive"}
-    ]
-    assets = {
-        "BTC": {"en": "BTC", "zh": "BTC", "ru": {"nominative": "BTC", "dative": "BTC", "prepositional": "BTC", "genitive": "BTC", "instrumental": "BTC"}},
-        "TON": {"en": "TON", "zh": "TON", "ru": {"nominative": "TON", "dative": "TON", "prepositional": "TON", "genitive": "TON", "instrumental": "TON"}},
-        "ETH": {"en": "ETH", "zh": "ETH", "ru": {"nominative": "ETH", "dative": "ETH", "prepositional": "ETH", "genitive": "ETH", "instrumental": "ETH"}},
-        "altcoins": {"en": "altcoins", "zh": "山寨币", "ru": {"nominative": "альткоины", "dative": "альткоинам", "prepositional": "альткоинах", "genitive": "альткоинов", "instrumental": "альткоинами"}},
-        "memecoins": {"en": "memecoins", "zh": "模因币", "ru": {"nominative": "мем-коины", "dative": "мем-коинам", "prepositional": "мем-коинах", "genitive": "мем-коинов", "instrumental": "мем-коинами"}},
-        "infrastructure_tokens": {"en": "infrastructure tokens", "zh": "基础设施代币", "ru": {"nominative": "инфраструктурные токены", "dative": "инфраструктурным токенам", "prepositional": "инфраструктурных токенах", "genitive": "инфраструктурных токенов", "instrumental": "инфраструктурными токенами"}},
-        "l2_solutions": {"en": "L2 solutions", "zh": "L2解决方案", "ru": {"nominative": "L2-решения", "dative": "L2-решениям", "prepositional": "L2-решениях", "genitive": "L2-решений", "instrumental": "L2-решениями"}}
+# Пространство гороскопов: шаблон × тема × действие × актив. Гороскоп задаётся одним
+# целым индексом и собирается по запросу, поэтому ничего не генерируется при импорте,
+# а сохранённые horoscope_indices дают тот же текст после перезапуска.
+# Новые варианты добавляйте только в конец списков: порядок определяет нумерацию.
+HOROSCOPE_TEMPLATES = [
+    {
+        "ru": "Движение BTC создает фон для TON. Отличное время для изучения {theme}, звезды рекомендуют {action} {asset}.",
+        "en": "BTC's movement is setting the stage for TON. A great time to study {theme}, the stars recommend to {action} {asset}.",
+        "zh": "BTC的走势正在为TON铺平道路。现在是研究{theme}的大好时机，星象建议{action}{asset}。"
+    },
+    {
+        "ru": "Экосистема TON сегодня в центре внимания. Ваша энергия на пике, что идеально для {theme}. Звезды также предлагают {action} {asset}.",
+        "en": "The TON ecosystem is in the spotlight today. Your energy is at its peak, which is perfect for {theme}. The stars also suggest to {action} {asset}.",
+        "zh": "TON生态系统今天备受关注。您的精力充沛，非常适合{theme}。星象也建议{action}{asset}。"
+    },
+    {
+        "ru": "Сеть TON гудит от активности. Это может быть хороший день, чтобы {action} {asset} и следить за новостями.",
+        "en": "The TON network is buzzing with activity. This could be a good day to {action} {asset} and watch the news.",
+        "zh": "TON网络活动频繁。今天可能是{action}{asset}并关注新闻的好日子。"
+    },
+    {
+        "ru": "Ваша интуиция по поводу {theme} может привести к успеху. Сегодня хороший день, чтобы {action} {asset}.",
+        "en": "Your intuition about {theme} could lead to success. Today is a good day to {action} {asset}.",
+        "zh": "您对{theme}的直觉可能会带来成功。今天是{action}{asset}的好日子。"
+    },
+    {
+        "ru": "Анализ {theme} показывает, что сейчас важно {action} {asset}. Будьте внимательны к сигналам рынка.",
+        "en": "Analysis of {theme} shows that it is now important to {action} {asset}. Pay attention to market signals.",
+        "zh": "对{theme}的分析表明，现在{action}{asset}非常重要。请注意市场信号。"
     }
-
-    horoscopes = {lang: {} for lang in supported_langs}
-
-    for sign_ru in ZODIAC_SIGNS["ru"]:
-        # Prepare variants for each language
-        variants = {lang: [] for lang in supported_langs}
-
-        for _ in range(30):  # 30 variants for each sign
-            template = random.choice(templates)
-            theme = random.choice(themes)
-            action_data = random.choice(actions)
-            asset_key = random.choice(list(assets.keys()))
-
-            for lang in supported_langs:
-                sign_lang = ZODIAC_CALLBACK_MAP.get(lang, {}).get(sign_ru, sign_ru)
-
-                # Select the correct asset form for Russian
-                asset_text = assets[asset_key][lang]
-                if lang == 'ru':
-                    case = action_data.get('case', 'nominative')
-                    asset_text = assets[asset_key]['ru'].get(case, assets[asset_key]['ru']['nominative'])
-
-                text_lang = template[lang].format(
-                    theme=theme[lang],
-                    action=action_data[lang],
-                    asset=asset_text
-                )
-                # The body of the horoscope no longer contains the thematic emoji title
-                full_text = text_lang
-                variants[lang].append(full_text)
-
-        # Assign all generated variants to the database
-        for lang in supported_langs:
-            sign_lang = ZODIAC_CALLBACK_MAP.get(lang, {}).get(sign_ru, sign_ru)
-            horoscopes[lang][sign_lang] = variants[lang]
-
-    return horoscopes
-
-HOROSCOPES_DB = generate_multilingual_horoscopes()
+]
+HOROSCOPE_THEMES = [
+    {"ru": "DeFi в сети TON", "en": "DeFi on the TON network", "zh": "TON网络上的DeFi"},
+    {"ru": "рынка Jetton'ов", "en": "the Jetton market", "zh": "Jetton市场"},
+    {"ru": "NFT на Getgems/Fragment", "en": "NFTs on Getgems/Fragment", "zh": "Getgems/Fragment上的NFT"},
+    {"ru": "P2E-игр на TON", "en": "P2E games on TON", "zh": "TON上的P2E游戏"},
+    {"ru": "стейкинга TON", "en": "staking TON", "zh": "质押TON"},
+    {"ru": "корреляции TON и BTC", "en": "the correlation between TON and BTC", "zh": "TON与BTC的相关性"},
+    {"ru": "рыночных настроений", "en": "market sentiment", "zh": "市场情绪"},
+    {"ru": "индекса страха и жадности", "en": "the Fear & Greed Index", "zh": "恐惧与贪婪指数"},
+    {"ru": "циклов FOMO и FUD", "en": "FOMO and FUD cycles", "zh": "FOMO与FUD周期"}
+]
+HOROSCOPE_ACTIONS = [
+    {"ru": "присмотреться к", "en": "take a closer look at", "zh": "仔细研究", "case": "dative"},
+    {"ru": "искать новые возможности в", "en": "look for new opportunities in", "zh": "寻找新机会", "case": "prepositional"},
+    {"ru": "увеличить позиции в", "en": "increase positions in", "zh": "增加仓位", "case": "prepositional"},
+    {"ru": "зафиксировать прибыль от", "en": "take profits from", "zh": "获利了结", "case": "genitive"},
+    {"ru": "провести исследование по", "en": "conduct research on", "zh": "进行研究", "case": "dative"},
+    {"ru": "следить за", "en": "keep an eye on", "zh": "关注", "case": "instrumental"},
+    {"ru": "анализировать", "en": "to analyze", "zh": "分析", "case": "nominative"},
+    {"ru": "противостоять", "en": "to resist", "zh": "抵制", "case": "dative"},
+    {"ru": "избегать", "en": "to avoid", "zh": "避免", "case": "genitive"}
+]
+HOROSCOPE_ASSETS = [
+    {"en": "BTC", "zh": "BTC", "ru": {"nominative": "BTC", "dative": "BTC", "prepositional": "BTC", "genitive": "BTC", "instrumental": "BTC"}},
+    {"en": "TON", "zh": "TON", "ru": {"nominative": "TON", "dative": "TON", "prepositional": "TON", "genitive": "TON", "instrumental": "TON"}},
+    {"en": "ETH", "zh": "ETH", "ru": {"nominative": "ETH", "dative": "ETH", "prepositional": "ETH", "genitive": "ETH", "instrumental": "ETH"}},
+    {"en": "altcoins", "zh": "山寨币", "ru": {"nominative": "альткоины", "dative": "альткоинам", "prepositional": "альткоинах", "genitive": "альткоинов", "instrumental": "альткоинами"}},
+    {"en": "memecoins", "zh": "模因币", "ru": {"nominative": "мем-коины", "dative": "мем-коинам", "prepositional": "мем-коинах", "genitive": "мем-коинов", "instrumental": "мем-коинами"}},
+    {"en": "infrastructure tokens", "zh": "基础设施代币", "ru": {"nominative": "инфраструктурные токены", "dative": "инфраструктурным токенам", "prepositional": "инфраструктурных токенах", "genitive": "инфраструктурных токенов", "instrumental": "инфраструктурными токенами"}},
+    {"en": "L2 solutions", "zh": "L2解决方案", "ru": {"nominative": "L2-решения", "dative": "L2-решениям", "prepositional": "L2-решениях", "genitive": "L2-решений", "instrumental": "L2-решениями"}}
+]
+
+HOROSCOPE_SPACE_SIZE = len(HOROSCOPE_TEMPLATES) * len(HOROSCOPE_THEMES) * len(HOROSCOPE_ACTIONS) * len(HOROSCOPE_ASSETS)
+
+@lru_cache(maxsize=4096)
+def horoscope_text(index: int, lang: str) -> str:
+    """Decodes a horoscope index into its text in the given language."""
+    index, asset_no = divmod(index % HOROSCOPE_SPACE_SIZE, len(HOROSCOPE_ASSETS))
+    index, action_no = divmod(index, len(HOROSCOPE_ACTIONS))
+    template_no, theme_no = divmod(index, len(HOROSCOPE_THEMES))
+    template = HOROSCOPE_TEMPLATES[template_no]
+    action = HOROSCOPE_ACTIONS[action_no]
+    asset = HOROSCOPE_ASSETS[asset_no]
+
+    # Select the correct asset form for Russian
+    asset_text = asset[lang] if lang != "ru" else asset["ru"].get(action.get("case", "nominative"), asset["ru"]["nominative"])
+    return template.get(lang, template["ru"]).format(
+        theme=HOROSCOPE_THEMES[theme_no].get(lang, HOROSCOPE_THEMES[theme_no]["ru"]),
+        action=action.get(lang, action["ru"]),
+        asset=asset_text
+    )
 
 def get_user_data(chat_id: int) -> dict:
     """Gets or creates a user's data entry."""
-    if chat_id not in user_data:
-        user_data[chat_id] = {
+    user_info = user_data.get(chat_id)
+    if user_info is None:
+        user_info = user_data[chat_id] = {
             "language": None,
             "last_update": None,
             "tip_index": None,
             "horoscope_indices": {},
+            "utc_offset": None,
+            "currency": None,
+            "zodiac": None,
+            "daily_push": False,
+            "push_zodiac": None,
+            "push_day": None,
             "is_new_user": True
         }
+        count_new_user(chat_id)
+        index_user_timezone(chat_id, user_info)
     # Backward compatibility for old keys - notifications removed
-    if "notifications" in user_data[chat_id]:
-        user_data[chat_id].pop("notifications", None)
-    if "polls_enabled" in user_data[chat_id]:
-        user_data[chat_id].pop("polls_enabled", None)
-    if "notifications_enabled" in user_data[chat_id]:
-        user_data[chat_id].pop("notifications_enabled", None)
+    if "notifications" in user_info:
+        user_info.pop("notifications", None)
+    if "polls_enabled" in user_info:
+        user_info.pop("polls_enabled", None)
+    if "notifications_enabled" in user_info:
+        user_info.pop("notifications_enabled", None)
+    # Подписки до появления push_zodiac хранили знак в поле последнего просмотренного знака
+    if user_info.get("daily_push") and "push_zodiac" not in user_info:
+        user_info["push_zodiac"] = user_info.get("zodiac")
+
+    return user_info
+
+# --- Time zones ---
+
+@lru_cache(maxsize=None)
+def offset_tz(utc_offset: int) -> timezone:
+    """Returns a fixed-offset tzinfo for an offset in minutes."""
+    return timezone(timedelta(minutes=utc_offset))
+
+def local_now(utc_offset: int) -> datetime:
+    return datetime.now(offset_tz(utc_offset))
+
+def bucket_time(hh_mm: str, utc_offset: int) -> dt_time:
+    """Returns a local time of day in the given offset, usable with JobQueue.run_daily."""
+    hour, minute = map(int, hh_mm.split(":"))
+    return dt_time(hour, minute, tzinfo=offset_tz(utc_offset))
+
+def day_bounds(day: date, utc_offset: int):
+    """Returns the UNIX timestamps at which the given local day starts and ends."""
+    start = datetime.combine(day, dt_time(), tzinfo=offset_tz(utc_offset)).timestamp()
+    return start, start + 86400
+
+def format_utc_offset(utc_offset: int) -> str:
+    """Formats an offset in minutes as UTC+3, UTC+5:30, UTC-8."""
+    sign = "+" if utc_offset >= 0 else "-"
+    hours, minutes = divmod(abs(utc_offset), 60)
+    return f"UTC{sign}{hours}" + (f":{minutes:02d}" if minutes else "")
+
+def parse_utc_offset(text: str):
+    """Parses '+3', '-8', '+5:30', 'UTC+3' into minutes; returns None if invalid."""
+    text = text.strip().upper().replace("UTC", "").replace("GMT", "") or "0"
+    sign = -1 if text.startswith("-") else 1
+    hours, _, minutes = text.lstrip("+-").partition(":")
+    try:
+        offset = sign * (int(hours) * 60 + int(minutes or 0))
+    except ValueError:
+        return None
+    if not -720 <= offset <= 840 or offset % 15:
+        return None
+    return offset
+
+# Личные чаты по поясам: смещение -> множество chat_id (включая пояс по умолчанию).
+# Ведётся при создании пользователя и смене пояса, так что состав пояса не требует обхода хранилища
+users_by_offset = {}
+
+def get_user_offset(chat_id: int) -> int:
+    offset = user_data.get(chat_id, {}).get("utc_offset")
+    return DEFAULT_UTC_OFFSET if offset is None else offset
+
+def set_user_offset(chat_id: int, utc_offset: int):
+    """Changes a user's time zone and keeps the per-offset index up to date."""
+    user_info = get_user_data(chat_id)
+    old_offset = get_user_offset(chat_id)
+    if chat_id > 0:
+        users_by_offset.get(old_offset, set()).discard(chat_id)
+        if not users_by_offset.get(old_offset):
+            users_by_offset.pop(old_offset, None)
+        users_by_offset.setdefault(utc_offset, set()).add(chat_id)
+    user_info["utc_offset"] = None if utc_offset == DEFAULT_UTC_OFFSET else utc_offset
+    move_push_subscriber(chat_id, old_offset, utc_offset)
+
+def index_user_timezone(chat_id: int, info: dict):
+    """Adds a private chat to the per-offset index (groups have their own zones in chat_timezones)."""
+    if chat_id < 0:
+        return
+    offset = info.get("utc_offset")
+    users_by_offset.setdefault(DEFAULT_UTC_OFFSET if offset is None else offset, set()).add(chat_id)
+
+def bucket_user_ids(utc_offset: int) -> list:
+    """Returns the IDs of all users whose day starts at midnight in the given offset."""
+    return list(users_by_offset.get(utc_offset, ()))
+
+def get_chat_offset(chat_id: int) -> int:
+    """Time zone of a chat: the user's own for private chats, the broadcast setting for groups."""
+    if chat_id > 0:
+        return get_user_offset(chat_id)
+    return load_broadcast_timezones().get(chat_id, DEFAULT_UTC_OFFSET)
+
+# --- Daily content ---
 
-    return user_data[chat_id]
+def _random_block(rng: random.Random, count: int, modulo: int) -> array:
+    """Draws `count` uniform indices below `modulo` from one block of random bytes."""
+    raw = array("I", rng.randbytes(4 * count))
+    return array("H" if modulo <= 0xFFFF else "I", [x % modulo for x in raw])
+
+class DailyContent:
+    """
+    Tip and horoscope indices of one local day for every user of one time zone bucket,
+    stored column-wise in compact arrays. Built off the request path and published with
+    a single reference swap, so handlers only do lookups.
+    """
+
+    __slots__ = ("day", "day_str", "utc_offset", "starts_at", "expires_at", "rows", "tips", "horoscopes")
+
+    def __init__(self, day: date, chat_ids, utc_offset: int = DEFAULT_UTC_OFFSET, seed=None):
+        self.day = day
+        self.day_str = str(day)
+        self.utc_offset = utc_offset
+        self.starts_at, self.expires_at = day_bounds(day, utc_offset)
+        self.rows = dict(zip(chat_ids, range(len(chat_ids))))
+        rng = random.Random(seed)
+        count = len(self.rows)
+        self.tips = _random_block(rng, count, len(TEXTS["learning_tips"]["ru"]))
+        self.horoscopes = [
+            _random_block(rng, count, HOROSCOPE_SPACE_SIZE)
+            for _ in ZODIAC_SIGNS["ru"]
+        ]
+
+    def indices_for(self, chat_id: int):
+        """Returns (tip_index, horoscope_indices) for a user, or None if the user is unknown."""
+        row = self.rows.get(chat_id)
+        if row is None:
+            return None
+        horoscope_indices = {sign_ru: column[row] for sign_ru, column in zip(ZODIAC_SIGNS["ru"], self.horoscopes)}
+        return self.tips[row], horoscope_indices
+
+# Контент по часовым поясам: UTC-смещение -> DailyContent текущего и следующего дня
+daily_content = {}
+next_daily_content = {}
+
+def current_daily_content(utc_offset: int = DEFAULT_UTC_OFFSET):
+    """Returns the published content for the bucket's current day, switching to the prepared one at midnight."""
+    now = time.time()
+    content = daily_content.get(utc_offset)
+    if content is not None and content.starts_at <= now < content.expires_at:
+        return content
+    prepared = next_daily_content.get(utc_offset)
+    if prepared is not None and prepared.starts_at <= now < prepared.expires_at:
+        daily_content[utc_offset] = prepared
+        del next_daily_content[utc_offset]
+        metric_set(f'daily_content_users{{utc_offset="{utc_offset}"}}', len(prepared.rows))
+        return prepared
+    return None
+
+def prepare_daily_content(day: date, utc_offset: int = DEFAULT_UTC_OFFSET, chat_ids: list = None) -> DailyContent:
+    """
+    Builds the content of the local `day` for all users of one time zone bucket.
+    When run in an executor, pass `chat_ids` collected on the event loop thread.
+    """
+    started = time.perf_counter()
+    if chat_ids is None:
+        chat_ids = bucket_user_ids(utc_offset)
+    content = DailyContent(day, chat_ids, utc_offset)
+    duration = time.perf_counter() - started
+    metric_set(f'daily_content_build_seconds{{utc_offset="{utc_offset}"}}', round(duration, 6))
+    logger.info(
+        f"🗓 Daily content for {day} ({format_utc_offset(utc_offset)}) "
+        f"prepared for {len(content.rows)} users in {duration:.2f}s"
+    )
+    return content
+
+def timezone_buckets() -> set:
+    """All offsets in use by users or broadcast chats."""
+    return {DEFAULT_UTC_OFFSET} | set(users_by_offset) | set(load_broadcast_timezones().values())
+
+def publish_daily_content():
+    """Builds and publishes today's content for every bucket (used at startup)."""
+    for utc_offset in timezone_buckets():
+        content = prepare_daily_content(local_now(utc_offset).date(), utc_offset)
+        daily_content[utc_offset] = content
+        metric_set(f'daily_content_users{{utc_offset="{utc_offset}"}}', len(content.rows))
+    prebuild_inline_results()
+
+async def prepare_next_day_content_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job that builds a bucket's next-day content before its midnight; it goes live exactly at 00:00 local time."""
+    utc_offset = (context.job.data or {}).get("utc_offset", DEFAULT_UTC_OFFSET)
+    tomorrow = local_now(utc_offset).date() + timedelta(days=1)
+    # Список пользователей копируется из индекса в потоке event loop: обработчики в это время
+    # меняют множества, и обход их из другого потока мог бы упасть
+    chat_ids = bucket_user_ids(utc_offset)
+    loop = asyncio.get_running_loop()
+    next_daily_content[utc_offset] = await loop.run_in_executor(
+        None, prepare_daily_content, tomorrow, utc_offset, chat_ids
+    )
+    # Inline-ответы нового дня готовы к полуночи, а не собираются первым запросом после неё
+    await loop.run_in_executor(None, prebuild_inline_results)
+
+def schedule_daily_jobs(job_queue: JobQueue, utc_offset: int):
+    """Schedules the content preparation and broadcast jobs of one time zone bucket (once)."""
+    if job_queue is None or job_queue.get_jobs_by_name(f"daily_content_rollover_{utc_offset}"):
+        return
+    job_queue.run_daily(
+        prepare_next_day_content_job,
+        time=bucket_time(DAILY_CONTENT_PREPARE_TIME, utc_offset),
+        data={"utc_offset": utc_offset},
+        name=f"daily_content_rollover_{utc_offset}"
+    )
+    job_queue.run_daily(
+        broadcast_job,
+        time=bucket_time("00:00", utc_offset),
+        data={"utc_offset": utc_offset},
+        name=f"daily_broadcast_job_{utc_offset}"
+    )
+    logger.info(f"📅 Daily jobs scheduled for {format_utc_offset(utc_offset)}")
+
+def _draw_daily_indices():
+    """Draws one user's tip and horoscope indices (for users the batch did not cover)."""
+    num_tips = len(TEXTS["learning_tips"]["ru"])  # Both languages have the same number of tips
+    horoscope_indices = {
+        sign_ru: random.randrange(HOROSCOPE_SPACE_SIZE)
+        for sign_ru in ZODIAC_SIGNS["ru"]
+    }
+    return random.randint(0, num_tips - 1), horoscope_indices
 
 def update_user_horoscope(chat_id: int):
     """
-    Checks if the user's daily content is outdated and regenerates it if necessary.
-    This function ensures that a user gets a new random tip and set of horoscopes once per day.
+    Makes sure the user's daily content belongs to the current day.
+    The indices come from the precomputed DailyContent, so this is only a lookup on the request path.
     It stores indices to ensure content is consistent across language changes.
     """
     user_info = get_user_data(chat_id)
-    moscow_tz = pytz.timezone("Europe/Moscow")
-    today_moscow = datetime.now(moscow_tz).date()
+    utc_offset = get_user_offset(chat_id)
+    content = current_daily_content(utc_offset)
+    if content is not None:
+        today = content.day
+        indices = None if str(user_info.get("last_update")) == content.day_str else content.indices_for(chat_id)
+    else:
+        # No published content for the user's day (new bucket, or the preparation job did not run)
+        today = local_now(utc_offset).date()
+        indices = None
+
+    # The value from user_data could be a date object, its string form (after a restart) or None
+    if str(user_info.get("last_update")) != str(today):
+        logger.debug("Updating daily content for user %s for date %s", chat_id, today)
+        last_update = user_info.get("last_update")
+        user_index.update("last_active", chat_id, str(last_update) if last_update else None, str(today))
+        user_info["last_update"] = today
+        tip_index, horoscope_indices = indices or _draw_daily_indices()
+        user_info["tip_index"] = tip_index
+        user_info["horoscope_indices"] = horoscope_indices
+        logger.debug("Content indices updated for user %s for %s", chat_id, today)
 
-    # The value from user_data could be a date object (from previous runs) or None
-    if user_info.get("last_update") != today_moscow:
-        logger.info(f"Updating daily content for user {chat_id} for date {today_moscow}")
-        user_info["last_update"] = today_moscow
+# --- User statistics ---
 
-        # Select a random index for the learning tip
-        num_tips = len(TEXTS["learning_tips"]["ru"])  # Both languages have the same number of tips
-        user_info["tip_index"] = random.randint(0, num_tips - 1)
+_MASK64 = (1 << 64) - 1
 
-        # Select random indices for each zodiac sign's horoscope
-        horoscope_indices = {}
-        for sign_ru in ZODIAC_SIGNS["ru"]:
-            num_variants = len(HOROSCOPES_DB["ru"][sign_ru])
-            horoscope_indices[sign_ru] = random.randint(0, num_variants - 1)
-        user_info["horoscope_indices"] = horoscope_indices
+def _mix64(value: int) -> int:
+    """splitmix64 finalizer: spreads sequential chat IDs over all 64 bits."""
+    value = (value + 0x9E3779B97F4A7C15) & _MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return value ^ (value >> 31)
+
+class HyperLogLog:
+    """Approximate distinct counter in 16 KiB (2^14 registers, ~0.8% standard error)."""
+
+    __slots__ = ("registers",)
+
+    P = 14
+    M = 1 << P
+    _POWERS = [2.0 ** -rank for rank in range(65)]
+
+    def __init__(self, registers: bytearray = None):
+        self.registers = registers if registers is not None else bytearray(self.M)
+
+    def add(self, value: int) -> bool:
+        """Adds a value; returns True if the estimate may have changed."""
+        hashed = _mix64(value)
+        index = hashed >> (64 - self.P)
+        rank = (64 - self.P) - (hashed & ((1 << (64 - self.P)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        return HyperLogLog(bytearray(map(max, self.registers, other.registers)))
+
+    def count(self) -> int:
+        m = self.M
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(map(self._POWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # поправка для малых значений
+        return round(estimate)
+
+# Счётчики пользователей, обновляемые при записи: не требуют обхода user_data
+user_stats = {"users": 0, "groups": 0, "languages": {}}
+
+# Активные пользователи по дням (дата по поясу DEFAULT_UTC_OFFSET) -> HyperLogLog (храним 8 дней для WAU)
+daily_active = OrderedDict()
+
+# Объединение регистров последних 7 дней для WAU: обновляется при каждом add, а не при чтении
+weekly_active = HyperLogLog()
+
+# Оценки DAU/WAU, посчитанные с последнего изменения регистров (метрики и /stats их переиспользуют)
+daily_active_estimates = {}
+
+# Счётчики пишутся из event loop, а читаются ещё и из потока Flask (/metrics)
+daily_active_lock = threading.Lock()
+
+def count_new_user(chat_id: int):
+    if chat_id < 0:
+        user_stats["groups"] += 1
+        return
+    user_stats["users"] += 1
+    user_stats["languages"]["unset"] = user_stats["languages"].get("unset", 0) + 1
+
+def count_language_change(chat_id: int, old_lang, new_lang):
+    if chat_id < 0 or old_lang == new_lang:
+        return
+    languages = user_stats["languages"]
+    languages[old_lang or "unset"] = languages.get(old_lang or "unset", 0) - 1
+    languages[new_lang or "unset"] = languages.get(new_lang or "unset", 0) + 1
+
+def _rebuild_weekly_active():
+    """Re-merges the weekly register after the set of days changed (once per new day). Caller holds the lock."""
+    global weekly_active
+    merged = HyperLogLog()
+    for day in sorted(daily_active)[-7:]:
+        merged = merged.merge(daily_active[day])
+    weekly_active = merged
+    daily_active_estimates.clear()
+
+def note_daily_active(chat_id: int, day: str = None):
+    """
+    Counts a user as active on `day`, by default today in the reference zone (DEFAULT_UTC_OFFSET):
+    DAU and WAU are calendar days of one zone, so a zone crossing midnight doesn't reset them.
+    """
+    if chat_id < 0:
+        return
+    if day is None:
+        day = str(local_now(DEFAULT_UTC_OFFSET).date())
+    with daily_active_lock:
+        counter = daily_active.get(day)
+        if counter is None:
+            counter = daily_active[day] = HyperLogLog()
+            # Дни приходят почти по порядку (пользователи в разных поясах), держим последние 8
+            for old_day in sorted(daily_active)[:-8]:
+                del daily_active[old_day]
+            _rebuild_weekly_active()
+            if day not in daily_active:
+                return  # запоздавший день старше хранимых восьми
+        if counter.add(chat_id):
+            daily_active_estimates.clear()
+            # День в окне WAU: тот же хэш поднимает тот же регистр недельного счётчика
+            if len(daily_active) < 8 or day != min(daily_active):
+                weekly_active.add(chat_id)
+
+def daily_active_count(days: int) -> int:
+    """Distinct active users over the last `days` reference-zone days, today included."""
+    with daily_active_lock:
+        if days in daily_active_estimates:
+            return daily_active_estimates[days]
+        recent = sorted(daily_active)[-days:]
+        if not recent:
+            return 0
+        if days == 7:
+            merged = weekly_active
+        else:
+            merged = daily_active[recent[0]]
+            for day in recent[1:]:
+                merged = merged.merge(daily_active[day])
+        daily_active_estimates[days] = merged.count()
+        return daily_active_estimates[days]
+
+def count_user(chat_id: int, info: dict):
+    """Adds a loaded user to the counters."""
+    count_new_user(chat_id)
+    count_language_change(chat_id, None, info.get("language"))
+
+def export_user_stats():
+    metric_set("users_total", user_stats["users"])
+    metric_set("groups_total", user_stats["groups"])
+    for lang, count in user_stats["languages"].items():
+        metric_set(f'users_by_language{{lang="{lang}"}}', count)
+    metric_set("users_daily_active", daily_active_count(1))
+    metric_set("users_weekly_active", daily_active_count(7))
+
+def save_user_stats():
+    with daily_active_lock:
+        data = {day: base64.b64encode(bytes(counter.registers)).decode() for day, counter in daily_active.items()}
+    write_json_file("user_stats.json", data)
+
+def load_user_stats():
+    """Restores the DAU/WAU counters, so a restart doesn't reset today's actives."""
+    try:
+        data = read_json_file("user_stats.json")
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.error(f"Error loading user_stats.json: {e}")
+        return
+    with daily_active_lock:
+        daily_active.clear()
+        for day in sorted(data)[-8:]:
+            registers = bytearray(base64.b64decode(data[day]))
+            if len(registers) == HyperLogLog.M:
+                daily_active[day] = HyperLogLog(registers)
+        _rebuild_weekly_active()
+
+# --- User indexes ---
+
+# Размер страницы chat_id при обходе результатов запроса к индексам
+USER_INDEX_PAGE_SIZE = int(os.environ.get('USER_INDEX_PAGE_SIZE', 500))
+
+class UserIndex:
+    """
+    Secondary indexes over the private chats in user_data: field -> value -> set of chat IDs.
+    Indexed are the language, the last active day and the user's own zodiac sign (the one
+    chosen in the morning push menu, not the last viewed one); users without a value are not indexed. Every user is in at most one set per field, so a
+    query costs time proportional to its smallest filter, not to the size of user_data.
+    """
+
+    FIELDS = ("language", "last_active", "zodiac")
+
+    def __init__(self):
+        self.fields = {field: {} for field in self.FIELDS}
+
+    def update(self, field: str, chat_id: int, old, new):
+        """Moves a chat between the sets of a field; called from the write paths."""
+        if chat_id < 0 or old == new:
+            return
+        values = self.fields[field]
+        if old is not None and old in values:
+            values[old].discard(chat_id)
+            if not values[old]:
+                del values[old]
+        if new is not None:
+            values.setdefault(new, set()).add(chat_id)
+
+    def clear(self):
+        for values in self.fields.values():
+            values.clear()
+
+    def add(self, chat_id: int, info: dict):
+        """Adds a loaded user to all indexes."""
+        last_update = info.get("last_update")
+        self.update("language", chat_id, None, info.get("language"))
+        self.update("last_active", chat_id, None, str(last_update) if last_update else None)
+        self.update("zodiac", chat_id, None, own_zodiac(info))
+
+    def _groups(self, language=None, zodiac=None, active_days=None) -> list:
+        """Turns the filters into groups of disjoint sets; a chat matches a group if it is in any of its sets."""
+        groups = []
+        if language is not None:
+            groups.append([self.fields["language"].get(language, set())])
+        if zodiac is not None:
+            groups.append([self.fields["zodiac"].get(zodiac, set())])
+        if active_days is not None:
+            # Даты в ISO-формате сравниваются как строки; дни по поясу пользователя, поэтому
+            # у восточных поясов сегодняшняя дата может быть больше московской — она тоже подходит
+            cutoff = str(local_now(DEFAULT_UTC_OFFSET).date() - timedelta(days=active_days - 1))
+            groups.append([ids for day, ids in self.fields["last_active"].items() if day >= cutoff])
+        return groups
+
+    def count(self, **filters) -> int:
+        return sum(1 for _ in self._match(self._groups(**filters)))
+
+    def _match(self, groups):
+        if not groups:
+            # Без фильтров — все личные чаты
+            yield from (chat_id for chat_id in user_data if chat_id > 0)
+            return
+        groups.sort(key=lambda sets: sum(map(len, sets)))
+        driver, others = groups[0], groups[1:]
+        for ids in driver:
+            for chat_id in ids:
+                if all(any(chat_id in s for s in sets) for sets in others):
+                    yield chat_id
+
+    def pages(self, page_size: int = None, **filters):
+        """
+        Yields sorted pages of matching chat IDs. The matches are collected when the first
+        page is requested, so the caller may await between pages while the indexes change.
+        """
+        page_size = page_size or USER_INDEX_PAGE_SIZE
+        matches = sorted(self._match(self._groups(**filters)))
+        for start in range(0, len(matches), page_size):
+            yield matches[start:start + page_size]
+
+user_index = UserIndex()
+
+# Название знака на любом языке -> русское название (ключ в user_data)
+ZODIAC_BY_NAME = {
+    name.lower(): sign_ru
+    for names in ZODIAC_SIGNS.values()
+    for sign_ru, name in zip(ZODIAC_SIGNS["ru"], names)
+}
+
+# --- Daily push ---
+
+# Личная утренняя рассылка (по подписке): гороскоп своего знака и совет дня.
+# Отправки распределены по окну DAILY_PUSH_WINDOW_START + DAILY_PUSH_WINDOW_MINUTES по времени
+# пользователя: у каждого пользователя постоянный слот длиной DAILY_PUSH_SLOT_SECONDS по хэшу chat_id
+DAILY_PUSH_WINDOW_START = os.environ.get('DAILY_PUSH_WINDOW_START', '09:00')
+DAILY_PUSH_WINDOW_MINUTES = int(os.environ.get('DAILY_PUSH_WINDOW_MINUTES', 180))
+DAILY_PUSH_SLOT_SECONDS = int(os.environ.get('DAILY_PUSH_SLOT_SECONDS', 60))
+DAILY_PUSH_SLOTS = max(1, DAILY_PUSH_WINDOW_MINUTES * 60 // DAILY_PUSH_SLOT_SECONDS)
+
+# Подписчики: UTC-смещение -> слот -> множество chat_id
+push_subscribers = {}
+
+# Прогресс рассылки по поясам: UTC-смещение -> (дата начала окна, первый ещё не обработанный слот)
+push_progress = {}
+
+# Сколько раз пробовать доставить утренний гороскоп при временных ошибках, пока окно не сменилось
+DAILY_PUSH_MAX_ATTEMPTS = int(os.environ.get('DAILY_PUSH_MAX_ATTEMPTS', 3))
+
+# Повторы после временных ошибок: UTC-смещение -> (дата начала окна, {chat_id: сделано попыток})
+push_retries = {}
+
+def push_slot(chat_id: int) -> int:
+    return _mix64(chat_id) % DAILY_PUSH_SLOTS
+
+def push_window_label() -> str:
+    start = datetime.strptime(DAILY_PUSH_WINDOW_START, "%H:%M")
+    end = start + timedelta(minutes=DAILY_PUSH_WINDOW_MINUTES)
+    return f"{start:%H:%M}–{end:%H:%M}"
+
+def _index_push_subscriber(chat_id: int, utc_offset: int, subscribed: bool):
+    slots = push_subscribers.setdefault(utc_offset, {})
+    ids = slots.setdefault(push_slot(chat_id), set())
+    if subscribed:
+        ids.add(chat_id)
+    else:
+        ids.discard(chat_id)
+        if not ids:
+            del slots[push_slot(chat_id)]
+        if not slots:
+            del push_subscribers[utc_offset]
+
+def own_zodiac(info: dict):
+    """The sign a user chose as their own in the morning push menu (kept after unsubscribing), or None."""
+    if "push_zodiac" in info:
+        return info["push_zodiac"]
+    # Старые записи: знак подписки хранился в поле последнего просмотренного знака
+    return info.get("zodiac") if info.get("daily_push") else None
+
+def set_daily_push(chat_id: int, zodiac):
+    """
+    Subscribes a user to the daily push for a sign (Russian name), or unsubscribes with None.
+    The chosen sign is the user's own sign for /campaign sign=...; unsubscribing keeps it.
+    """
+    user_info = get_user_data(chat_id)
+    if user_info.get("daily_push"):
+        _index_push_subscriber(chat_id, get_user_offset(chat_id), False)
+    user_info["daily_push"] = zodiac is not None
+    if zodiac is not None:
+        # Знак подписки хранится отдельно: просмотр других знаков его не меняет
+        user_index.update("zodiac", chat_id, own_zodiac(user_info), zodiac)
+        user_info["push_zodiac"] = zodiac
+        _index_push_subscriber(chat_id, get_user_offset(chat_id), True)
+
+def move_push_subscriber(chat_id: int, old_offset: int, new_offset: int):
+    """Keeps a subscriber in the right time zone bucket when the user changes the zone."""
+    if old_offset != new_offset and user_data.get(chat_id, {}).get("daily_push"):
+        _index_push_subscriber(chat_id, old_offset, False)
+        _index_push_subscriber(chat_id, new_offset, True)
+
+def index_push_subscriber(chat_id: int, info: dict):
+    """Adds a loaded user to the subscriber index."""
+    if info.get("daily_push") and own_zodiac(info):
+        offset = info.get("utc_offset")
+        _index_push_subscriber(chat_id, DEFAULT_UTC_OFFSET if offset is None else offset, True)
+
+def rebuild_user_indexes():
+    """
+    Rebuilds every per-user index and counter after the store was opened, in one pass over
+    the store: cold users are decoded from disk and dropped again, not loaded into memory.
+    """
+    users_by_offset.clear()
+    user_stats.update(users=0, groups=0, languages={})
+    user_index.clear()
+    push_subscribers.clear()
+    for chat_id, info in user_data.items():
+        index_user_timezone(chat_id, info)
+        count_user(chat_id, info)
+        user_index.add(chat_id, info)
+        index_push_subscriber(chat_id, info)
+    load_user_stats()
+
+def due_push_slots(utc_offset: int):
+    """
+    Returns (window day, slots) whose send time has come in the given time zone and marks
+    them as processed. The window day is the local date the latest window started on, so a
+    window running past midnight keeps its slots. Slots missed while the job was delayed
+    are caught up, but a window first seen after it has ended is skipped rather than sent late.
+    """
+    now = local_now(utc_offset)
+    window_start = datetime.combine(now.date(), bucket_time(DAILY_PUSH_WINDOW_START, utc_offset))
+    if now < window_start:
+        window_start -= timedelta(days=1)
+    day = window_start.date()
+    elapsed = (now - window_start).total_seconds()
+    due = min(DAILY_PUSH_SLOTS, int(elapsed // DAILY_PUSH_SLOT_SECONDS) + 1)
+    progress_day, first = push_progress.get(utc_offset, (None, 0))
+    if progress_day != day:
+        first = DAILY_PUSH_SLOTS if elapsed >= DAILY_PUSH_WINDOW_MINUTES * 60 else 0
+    push_progress[utc_offset] = (day, max(first, due))
+    return day, range(first, due)
+
+def daily_indices(chat_id: int):
+    """Today's (tip_index, horoscope_indices) of a user; for users in the day's batch a push does not count as a visit."""
+    user_info = get_user_data(chat_id)
+    content = current_daily_content(get_user_offset(chat_id))
+    if content is not None and str(user_info.get("last_update")) != content.day_str:
+        indices = content.indices_for(chat_id)
+        if indices is not None:
+            return indices
+    update_user_horoscope(chat_id)
+    return user_info.get("tip_index"), user_info.get("horoscope_indices") or {}
 
-        logger.info(f"Content indices updated for user {chat_id} for {today_moscow}")
+class QuotaPlanner:
+    """
+    Tracks calls per provider in the current minute and UTC day (persisted across
+    restarts) and picks a provider at random, weighted by the refreshes its daily budget
+    has left, so calls are spread over all free tiers and none of them is exceeded.
+    """
+
+    def __init__(self, quotas: dict, path: str = "provider_quota.json"):
+        self.quotas = quotas
+        self.path = path
+        self.lock = threading.Lock()
+        self.day = None
+        self.usage = {}
+        self._reset_day(datetime.now(timezone.utc).date())
+
+    def _reset_day(self, day: date):
+        self.day = day
+        self.usage = {name: {"day": 0, "minute_start": 0.0, "minute": 0, "cooldown_until": 0.0} for name in self.quotas}
+
+    def _roll_windows(self, now: float):
+        today = datetime.fromtimestamp(now, timezone.utc).date()
+        if today != self.day:
+            self._reset_day(today)
+        for usage in self.usage.values():
+            if now - usage["minute_start"] >= 60:
+                usage["minute_start"], usage["minute"] = now, 0
+
+    def remaining(self, name: str) -> tuple:
+        """Returns the (minute, day) budget left for a provider."""
+        quota, usage = self.quotas[name], self.usage[name]
+        return quota["minute"] - usage["minute"], quota["day"] - usage["day"]
+
+    def pick(self, exclude=()):
+        """Returns the provider to call next, or None if every provider is out of budget or cooling down."""
+        now = time.time()
+        with self.lock:
+            self._roll_windows(now)
+            weights = {}
+            for name, quota in self.quotas.items():
+                if name in exclude or self.usage[name]["cooldown_until"] > now:
+                    continue
+                minute_left, day_left = self.remaining(name)
+                if minute_left < quota["cost"] or day_left < quota["cost"]:
+                    continue
+                weights[name] = day_left // quota["cost"]
+        if not weights:
+            return None
+        # Доля запросов к источнику пропорциональна оставшимся у него обновлениям,
+        # поэтому каждый источник (и переключение на следующий) работает постоянно
+        return random.choices(list(weights), weights=list(weights.values()))[0]
+
+    def record(self, name: str, ok: bool):
+        """Accounts for one refresh attempt against a provider."""
+        now = time.time()
+        with self.lock:
+            self._roll_windows(now)
+            usage = self.usage[name]
+            usage["minute"] += self.quotas[name]["cost"]
+            usage["day"] += self.quotas[name]["cost"]
+            if not ok:
+                usage["cooldown_until"] = now + PROVIDER_FAILURE_COOLDOWN
+            metric_inc(f'provider_calls_total{{provider="{name}"}}', self.quotas[name]["cost"])
+        self.export_metrics()
+        self.save()
+
+    def min_refresh_interval(self) -> float:
+        """Shortest refresh interval that the daily budgets left can sustain until the end of the UTC day."""
+        now = time.time()
+        with self.lock:
+            self._roll_windows(now)
+            refreshes_left = sum(
+                max(0, self.remaining(name)[1]) // quota["cost"] for name, quota in self.quotas.items()
+            )
+        day_end = datetime.combine(self.day + timedelta(days=1), dt_time(), tzinfo=timezone.utc).timestamp()
+        return (day_end - now) / max(1, refreshes_left)
+
+    def export_metrics(self):
+        for name in self.quotas:
+            minute_left, day_left = self.remaining(name)
+            metric_set(f'provider_budget_remaining{{provider="{name}",window="minute"}}', minute_left)
+            metric_set(f'provider_budget_remaining{{provider="{name}",window="day"}}', day_left)
+
+    def save(self):
+        try:
+            with self.lock:
+                data = {"day": str(self.day), "usage": self.usage}
+                write_json_file(self.path, data)
+        except Exception as e:
+            logger.error(f"Error saving {self.path}: {e}")
+
+    def load(self):
+        """Restores today's usage; counters from a previous UTC day are discarded."""
+        try:
+            data = read_json_file(self.path)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Error loading {self.path}: {e}")
+            return
+        with self.lock:
+            if data.get("day") == str(self.day):
+                for name, usage in data.get("usage", {}).items():
+                    if name in self.usage:
+                        self.usage[name].update(usage)
+        self.export_metrics()
+
+quota_planner = QuotaPlanner(PROVIDER_QUOTAS)
+
+class DemandRate:
+    """Exponentially decaying event rate, used to measure how often prices are requested."""
+
+    def __init__(self, half_life: float = 300.0):
+        self.decay = math.log(2) / half_life
+        self.value = 0.0
+        self.updated = time.monotonic()
+
+    def _advance(self):
+        now = time.monotonic()
+        self.value *= math.exp(-self.decay * (now - self.updated))
+        self.updated = now
+
+    def note(self):
+        self._advance()
+        self.value += 1
+
+    def per_minute(self) -> float:
+        self._advance()
+        return self.value * self.decay * 60
+
+price_demand = DemandRate()
+
+def price_refresh_interval() -> float:
+    """Refresh interval for the current demand: the maximum when idle, approaching the minimum under load."""
+    rpm = price_demand.per_minute()
+    interval = PRICE_REFRESH_MAX_INTERVAL * PRICE_REFRESH_DEMAND_RPM / (PRICE_REFRESH_DEMAND_RPM + rpm)
+    # Никогда не чаще, чем позволяют оставшиеся на сегодня квоты источников
+    interval = max(interval, quota_planner.min_refresh_interval())
+    return max(PRICE_REFRESH_MIN_INTERVAL, min(PRICE_REFRESH_MAX_INTERVAL, interval))
+
+async def price_refresh_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Runs every PRICE_REFRESH_MIN_INTERVAL seconds: recomputes the refresh interval from
+    recent demand and refreshes prices only once the data is older than that interval.
+    """
+    interval = price_refresh_interval()
+    api_cache["cache_duration"] = interval
+    metric_set("price_demand_rpm", round(price_demand.per_minute(), 3))
+    metric_set("price_refresh_interval_seconds", round(interval, 1))
+    if prices_stale(interval):
+        await refresh_prices(on_request=False)
+
+def prices_stale(max_age: float) -> bool:
+    last_update = api_cache["last_update"]
+    return last_update is None or (datetime.now() - last_update).total_seconds() >= max_age
+
+async def refresh_prices(on_request: bool):
+    # Запросы к провайдерам блокирующие — выполняем их вне event loop
+    await asyncio.get_running_loop().run_in_executor(None, update_crypto_prices, on_request)
+
+# Не больше одного обновления курсов одновременно: иначе задача, досрочное обновление
+# и запуск могли бы параллельно тратить квоты источников
+price_fetch_lock = threading.Lock()
+
+# Досрочное обновление, запущенное обработчиком (не больше одного одновременно)
+price_refresh_task = None
 
-def update_crypto_prices():
-    """Обновляет курсы криптовалют, ротируя источники для надежности."""
+def note_price_demand():
+    """
+    Called by every handler that shows prices, instead of fetching them: counts the demand
+    and, once the prices are older than the interval for the current demand, starts a
+    refresh in the background without waiting for the next price_refresh_job tick.
+    The handler itself shows the current snapshot and never waits for a provider.
+    """
+    global price_refresh_task
+    price_demand.note()
+    if price_fetch_lock.locked() or (price_refresh_task is not None and not price_refresh_task.done()):
+        return
+    if not prices_stale(PRICE_REFRESH_MIN_INTERVAL):
+        return
+    interval = price_refresh_interval()
+    if prices_stale(interval):
+        api_cache["cache_duration"] = interval
+        try:
+            price_refresh_task = asyncio.get_running_loop().create_task(refresh_prices(on_request=True))
+        except RuntimeError:
+            pass  # вне event loop (скрипты, бенчмарки) — обновит задача
+
+def update_crypto_prices(on_request: bool = False):
+    """
+    Обновляет курсы криптовалют; источник выбирает планировщик квот, при ошибке берётся следующий.
+    Блокирующая функция: из event loop вызывается только через executor. Если обновление
+    уже идёт в другом потоке, сразу возвращается. on_request — досрочное обновление по спросу.
+    """
+    if not price_fetch_lock.acquire(blocking=False):
+        logger.debug("Обновление курсов уже выполняется.")
+        return
+    try:
+        _update_crypto_prices(on_request)
+    finally:
+        price_fetch_lock.release()
+
+def _update_crypto_prices(on_request: bool):
     try:
         # Проверяем, нужно ли обновлять данные из API
         if api_cache["last_update"] is not None and \
            (datetime.now() - api_cache["last_update"]).total_seconds() < api_cache["cache_duration"]:
-            logger.info("Используем кэшированные данные курсов (в пределах окна кэширования).")
+            logger.debug("Используем кэшированные данные курсов (в пределах окна кэширования).")
             return
 
-        # Ротация источников API для распределения нагрузки
-        sources = ["coingecko", "binance", "cryptocompare"]
-
-        # Начинаем со следующего источника в списке
-        _switch_api_source()
-
-        initial_source = api_cache["current_source"]
+        tried = set()
+        while (current_source := quota_planner.pick(exclude=tried)) is not None:
+            tried.add(current_source)
+            api_cache["current_source"] = current_source
+            logger.info("Попытка обновления курсов от источника: %s", current_source)
 
-        for i in range(len(sources)):
-            current_source = api_cache["current_source"]
-            logger.info(f"Попытка обновления курсов от источника: {current_source}")
-
-            success = False
+            quotes = {}
             if current_source == "coingecko":
-                success = _update_from_coingecko()
+                quotes = _update_from_coingecko()
             elif current_source == "binance":
-                success = _update_from_binance()
+                quotes = _update_from_binance()
             elif current_source == "cryptocompare":
-                success = _update_from_cryptocompare()
+                quotes = _update_from_cryptocompare()
+            quota_planner.record(current_source, bool(quotes))
 
-            if success:
+            if quotes:
+                publish_prices(quotes)
                 api_cache["last_update"] = datetime.now()
-                logger.info(f"Курсы успешно обновлены от {current_source}")
+                metric_inc(f'price_refreshes_total{{trigger="{"request" if on_request else "job"}"}}')
+                logger.info("Курсы успешно обновлены от %s", current_source)
                 save_cache_to_file()
                 return # Успешно, выходим из функции
             else:
                 logger.warning(f"Не удалось обновить от {current_source}. Переключение на следующий источник.")
-                _switch_api_source()
+
+        if not tried and price_snapshot.quotes:
+            # Квоты исчерпаны: остаёмся на последних полученных курсах, не подменяя их резервными
+            logger.warning("Квоты всех источников исчерпаны или они на паузе. Оставляем текущие курсы.")
+            return
 
         # Если все источники не сработали
         logger.error("Все источники API недоступны. Используем резервные данные.")
@@ -351,7 +1648,7 @@ def update_crypto_prices():
         _use_fallback_data()
 
 def _update_from_coingecko():
-    """Обновление курсов от CoinGecko API"""
+    """Получение курсов от CoinGecko API"""
     try:
         api_config = CRYPTO_APIS["coingecko"]
         response = requests.get(
@@ -363,13 +1660,13 @@ def _update_from_coingecko():
 
         if response.status_code == 429:
             logger.warning("CoinGecko: превышен лимит запросов")
-            return False
+            return {}
 
         response.raise_for_status()
-        prices = response.json()
+        prices = json_loads(response.content)
 
         current_time = datetime.now()
-        success_count = 0
+        quotes = {}
 
         for symbol, coin_id in CRYPTO_IDS.items():
             if coin_id in prices:
@@ -378,25 +1675,21 @@ def _update_from_coingecko():
                 change = coin_data.get("usd_24h_change")
 
                 if price is not None and change is not None:
-                    crypto_prices[symbol]["price"] = price
-                    crypto_prices[symbol]["change"] = change
-                    crypto_prices[symbol]["last_update"] = current_time
-                    crypto_prices[symbol]["source"] = "coingecko"
-                    success_count += 1
-                    logger.info(f"Курс {symbol.upper()}: ${price:.2f} ({change:.2f}%)")
+                    quotes[symbol] = CoinQuote(price, change, current_time, "coingecko")
+                    logger.debug("Курс %s: $%.2f (%.2f%%)", symbol.upper(), price, change)
 
-        return success_count > 0
+        return quotes
 
     except Exception as e:
         logger.error(f"Ошибка CoinGecko API: {e}")
-        return False
+        return {}
 
 def _update_from_binance():
-    """Обновление курсов от Binance API"""
+    """Получение курсов от Binance API"""
     try:
         api_config = CRYPTO_APIS["binance"]
         current_time = datetime.now()
-        success_count = 0
+        quotes = {}
 
         for symbol in api_config["symbols"]:
             response = requests.get(
@@ -406,10 +1699,10 @@ def _update_from_binance():
 
             if response.status_code == 429:
                 logger.warning("Binance: превышен лимит запросов")
-                return False
+                return {}
 
             response.raise_for_status()
-            data = response.json()
+            data = json_loads(response.content)
 
             # Преобразуем символы Binance в наши символы
             symbol_map = {"BTCUSDT": "btc", "ETHUSDT": "eth", "TONUSDT": "ton"}
@@ -420,21 +1713,17 @@ def _update_from_binance():
                 change = float(data.get("priceChangePercent", 0))
 
                 if price > 0:
-                    crypto_prices[our_symbol]["price"] = price
-                    crypto_prices[our_symbol]["change"] = change
-                    crypto_prices[our_symbol]["last_update"] = current_time
-                    crypto_prices[our_symbol]["source"] = "binance"
-                    success_count += 1
-                    logger.info(f"Курс {our_symbol.upper()}: ${price:.2f} ({change:.2f}%)")
+                    quotes[our_symbol] = CoinQuote(price, change, current_time, "binance")
+                    logger.debug("Курс %s: $%.2f (%.2f%%)", our_symbol.upper(), price, change)
 
-        return success_count > 0
+        return quotes
 
     except Exception as e:
         logger.error(f"Ошибка Binance API: {e}")
-        return False
+        return {}
 
 def _update_from_cryptocompare():
-    """Обновление курсов от CryptoCompare API"""
+    """Получение курсов от CryptoCompare API"""
     try:
         api_config = CRYPTO_APIS["cryptocompare"]
         response = requests.get(
@@ -445,13 +1734,13 @@ def _update_from_cryptocompare():
 
         if response.status_code == 429:
             logger.warning("CryptoCompare: превышен лимит запросов")
-            return False
+            return {}
 
         response.raise_for_status()
-        data = response.json()
+        data = json_loads(response.content)
 
         current_time = datetime.now()
-        success_count = 0
+        quotes = {}
 
         if "RAW" in data:
             raw_data = data["RAW"]
@@ -464,41 +1753,86 @@ def _update_from_cryptocompare():
                     change = usd_data.get("CHANGEPCT24HOUR", 0)
 
                     if price > 0:
-                        crypto_prices[our_symbol]["price"] = price
-                        crypto_prices[our_symbol]["change"] = change
-                        crypto_prices[our_symbol]["last_update"] = current_time
-                        crypto_prices[our_symbol]["source"] = "cryptocompare"
-                        success_count += 1
-                        logger.info(f"Курс {our_symbol.upper()}: ${price:.2f} ({change:.2f}%)")
+                        quotes[our_symbol] = CoinQuote(price, change, current_time, "cryptocompare")
+                        logger.debug("Курс %s: $%.2f (%.2f%%)", our_symbol.upper(), price, change)
 
-        return success_count > 0
+        return quotes
 
     except Exception as e:
         logger.error(f"Ошибка CryptoCompare API: {e}")
-        return False
-
-def _switch_api_source():
-    """Переключение между источниками API"""
-    sources = ["coingecko", "binance", "cryptocompare"]
-    current = api_cache["current_source"]
-
-    try:
-        current_index = sources.index(current)
-        next_index = (current_index + 1) % len(sources)
-        api_cache["current_source"] = sources[next_index]
-    except ValueError:
-        api_cache["current_source"] = "coingecko"
+        return {}
 
 def _use_fallback_data():
     """Использование резервных данных"""
     current_time = datetime.now()
-    for symbol, data in FALLBACK_DATA.items():
-        crypto_prices[symbol]["price"] = data["price"]
-        crypto_prices[symbol]["change"] = data["change"]
-        crypto_prices[symbol]["last_update"] = current_time
-        crypto_prices[symbol]["source"] = data["source"]
+    publish_prices({
+        symbol: CoinQuote(data["price"], data["change"], current_time, data["source"])
+        for symbol, data in FALLBACK_DATA.items()
+    }, current_time)
     logger.info("Использованы резервные данные курсов")
 
+# --- FX rates ---
+
+class FxRates(NamedTuple):
+    """Units of each display currency per 1 USD, replaced as a whole on refresh."""
+    rates: MappingProxyType
+    fetched_at: datetime = None
+    source: str = "fallback"
+
+fx_rates = FxRates(MappingProxyType(dict(FALLBACK_FX_RATES)))
+
+def update_fx_rates() -> bool:
+    """Fetches USD cross rates for FIAT_CURRENCIES and saves them to fx_rates.json."""
+    global fx_rates
+    try:
+        response = requests.get(FX_API_URL, timeout=15)
+        response.raise_for_status()
+        rates = json_loads(response.content).get("rates", {})
+        missing = [currency for currency in FIAT_CURRENCIES if not isinstance(rates.get(currency), (int, float))]
+        if missing:
+            logger.warning(f"FX: нет курсов для {', '.join(missing)}")
+            return False
+        fx_rates = FxRates(
+            MappingProxyType({currency: float(rates[currency]) for currency in FIAT_CURRENCIES}),
+            datetime.now(), "api"
+        )
+        write_json_file("fx_rates.json", {"fetched_at": fx_rates.fetched_at.timestamp(), "rates": dict(fx_rates.rates)})
+        logger.info("💱 FX-курсы обновлены: " + ", ".join(f"{c}={r:g}" for c, r in fx_rates.rates.items()))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка FX API: {e}")
+        return False
+
+def load_fx_rates_from_file():
+    """Restores the last fetched FX rates, so a restart needs no FX request."""
+    global fx_rates
+    try:
+        data = read_json_file("fx_rates.json")
+        rates = {currency: float(data["rates"][currency]) for currency in FIAT_CURRENCIES}
+        fx_rates = FxRates(MappingProxyType(rates), datetime.fromtimestamp(data["fetched_at"]), "file")
+        logger.info("📂 FX-курсы загружены из файла")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Ошибка загрузки FX-курсов: {e}")
+
+async def fx_refresh_job(context: ContextTypes.DEFAULT_TYPE):
+    """Refreshes FX rates once they are older than FX_REFRESH_INTERVAL."""
+    fetched_at = fx_rates.fetched_at
+    if fetched_at is None or (datetime.now() - fetched_at).total_seconds() >= FX_REFRESH_INTERVAL:
+        await asyncio.get_running_loop().run_in_executor(None, update_fx_rates)
+
+def get_user_currency(chat_id: int) -> str:
+    """Display currency: the user's choice, otherwise the default for their language; unknown chats are not created."""
+    currency = user_data.get(chat_id, {}).get("currency")
+    return currency if currency in FIAT_CURRENCIES else DEFAULT_CURRENCY_BY_LANG.get(get_user_lang(chat_id), "USD")
+
+def format_fiat_price(usd_price: float, currency: str) -> str:
+    """Converts a USD price with the cached FX table and formats it with the currency sign."""
+    value = usd_price * fx_rates.rates.get(currency, 1.0)
+    sign = FIAT_CURRENCIES.get(currency, "$")
+    return f"{value:,.2f} {sign}" if currency == "RUB" else f"{sign}{value:,.2f}"
+
 def format_change_bar(percent_change):
     """Форматирование графического представления изменения цены"""
     if percent_change is None:
@@ -538,6 +1872,15 @@ def main_menu_text_keyboard(lang: str):
         [InlineKeyboardButton(get_text("main_menu_text_button", lang), callback_data="main_menu")]
     ])
 
+def market_keyboard(lang: str, main_menu: bool = True):
+    """Keyboard under a market block: the chart card button (if Pillow is installed) and the main menu button."""
+    rows = []
+    if Image is not None:
+        rows.append([InlineKeyboardButton(get_text("chart_button", lang), callback_data="market_chart")])
+    if main_menu:
+        rows.append([InlineKeyboardButton(get_text("main_menu_text_button", lang), callback_data="main_menu")])
+    return InlineKeyboardMarkup(rows) if rows else None
+
 def back_to_premium_menu_keyboard(lang: str):
     """Creates a back button to the premium menu."""
     return InlineKeyboardMarkup([
@@ -570,7 +1913,10 @@ def settings_keyboard(chat_id: int, lang: str):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(get_text("commands_button", lang), callback_data="commands_info"),
          InlineKeyboardButton(get_text("support_button", lang), callback_data="support_info")],
-        [InlineKeyboardButton(get_text("change_language_button", lang), callback_data="change_language")],
+        [InlineKeyboardButton(get_text("change_language_button", lang), callback_data="change_language"),
+         InlineKeyboardButton(get_text("timezone_button", lang), callback_data="timezone_menu")],
+        [InlineKeyboardButton(get_text("currency_button", lang), callback_data="currency_menu"),
+         InlineKeyboardButton(get_text("daily_push_button", lang), callback_data="daily_push_menu")],
         [InlineKeyboardButton(get_text("main_menu_button", lang), callback_data="main_menu")]
     ])
 
@@ -582,6 +1928,51 @@ def back_to_settings_keyboard(lang: str):
     ])
 
 
+def timezone_keyboard(lang: str, current_offset: int):
+    """Creates the time zone selection keyboard, marking the current choice."""
+    buttons = [
+        InlineKeyboardButton(
+            ("✅ " if offset == current_offset else "") + format_utc_offset(offset),
+            callback_data=f"set_tz_{offset}"
+        )
+        for offset in TIMEZONE_CHOICES
+    ]
+    rows = [buttons[i:i+3] for i in range(0, len(buttons), 3)]
+    rows.append([InlineKeyboardButton(get_text("main_menu_button", lang), callback_data="settings_menu")])
+    return InlineKeyboardMarkup(rows)
+
+
+def currency_keyboard(lang: str, current_currency: str):
+    """Creates the display currency selection keyboard, marking the current choice."""
+    buttons = [
+        InlineKeyboardButton(
+            ("✅ " if currency == current_currency else "") + f"{sign} {currency}",
+            callback_data=f"set_cur_{currency}"
+        )
+        for currency, sign in FIAT_CURRENCIES.items()
+    ]
+    return InlineKeyboardMarkup([
+        buttons[:2], buttons[2:],
+        [InlineKeyboardButton(get_text("main_menu_button", lang), callback_data="settings_menu")]
+    ])
+
+
+def daily_push_keyboard(lang: str, current_zodiac):
+    """Creates the daily push keyboard: a sign subscribes to it, the last button unsubscribes."""
+    buttons = [
+        InlineKeyboardButton(
+            ("✅ " if sign_ru == current_zodiac else "") + f"{ZODIAC_EMOJIS.get(sign_ru, '')} "
+            + ZODIAC_CALLBACK_MAP.get(lang, {}).get(sign_ru, sign_ru),
+            callback_data=f"push_sign_{sign_ru}"
+        )
+        for sign_ru in ZODIAC_SIGNS["ru"]
+    ]
+    rows = [buttons[i:i+3] for i in range(0, len(buttons), 3)]
+    rows.append([InlineKeyboardButton(get_text("daily_push_off_button", lang), callback_data="push_off")])
+    rows.append([InlineKeyboardButton(get_text("main_menu_button", lang), callback_data="settings_menu")])
+    return InlineKeyboardMarkup(rows)
+
+
 def language_keyboard():
     """Returns the language selection keyboard."""
     return InlineKeyboardMarkup([
@@ -592,6 +1983,97 @@ def language_keyboard():
         ]
     ])
 
+# Последний отрисованный контент сообщений: (chat_id, message_id) -> хэш текста и клавиатуры
+rendered_messages = OrderedDict()
+RENDERED_MESSAGES_LIMIT = 20000
+
+# Последнее нажатие кнопки под каждым сообщением: (chat_id, message_id) -> update_id
+latest_callback_taps = {}
+
+async def edit_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, text: str, reply_markup=None, **kwargs) -> bool:
+    """
+    Edits a message unless it already shows exactly this text and keyboard.
+    Returns True if the edit was sent to Telegram.
+    """
+    key = (chat_id, message_id)
+    content_hash = hash((text, reply_markup, kwargs.get("parse_mode")))
+    if rendered_messages.get(key) == content_hash:
+        rendered_messages.move_to_end(key)
+        metric_inc("edits_suppressed_total")
+        return False
+
+    try:
+        await context.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=text,
+            reply_markup=reply_markup,
+            **kwargs
+        )
+        metric_inc("edits_sent_total")
+    except BadRequest as e:
+        # Same content as before (e.g. after a restart): nothing to fix, just remember it
+        if "message is not modified" not in str(e).lower():
+            raise
+        metric_inc("edits_not_modified_total")
+
+    rendered_messages[key] = content_hash
+    rendered_messages.move_to_end(key)
+    if len(rendered_messages) > RENDERED_MESSAGES_LIMIT:
+        rendered_messages.popitem(last=False)
+    return True
+
+def note_callback_tap(update: object):
+    """Remembers the newest button tap on a message; called as soon as the update arrives."""
+    if isinstance(update, Update) and update.callback_query and update.callback_query.message:
+        message = update.callback_query.message
+        latest_callback_taps[(message.chat_id, message.message_id)] = update.update_id
+
+# Кнопки, которые только перерисовывают сообщение: из серии нажатий на одно сообщение
+# достаточно отрисовать последнее. Остальные (настройки, оплата, отправка графика) выполняются всегда
+RENDER_ONLY_CALLBACKS = {
+    "main_menu", "horoscope_menu", "learning_tip", "settings_menu", "premium_menu",
+    "commands_info", "support_info", "change_language", "timezone_menu", "currency_menu",
+    "daily_push_menu",
+}
+
+def is_render_only_callback(data: str) -> bool:
+    return data in RENDER_ONLY_CALLBACKS or data.startswith("zodiac_")
+
+def apply_callback_setting(context: ContextTypes.DEFAULT_TYPE, chat_id: int, data: str) -> bool:
+    """Applies the setting a settings button changes (language, zone, currency, push); returns False for other buttons."""
+    if data.startswith("set_lang_"):
+        user_info = get_user_data(chat_id)
+        lang = data.split("_")[-1]
+        count_language_change(chat_id, user_info.get("language"), lang)
+        user_index.update("language", chat_id, user_info.get("language"), lang)
+        user_info["language"] = lang
+    elif data.startswith("set_tz_"):
+        utc_offset = int(data[len("set_tz_"):])
+        set_user_offset(chat_id, utc_offset)
+        schedule_daily_jobs(context.job_queue, utc_offset)
+    elif data.startswith("set_cur_"):
+        if data[len("set_cur_"):] in FIAT_CURRENCIES:
+            get_user_data(chat_id)["currency"] = data[len("set_cur_"):]
+    elif data.startswith("push_sign_"):
+        if data[len("push_sign_"):] in ZODIAC_SIGNS["ru"]:
+            set_daily_push(chat_id, data[len("push_sign_"):])
+    elif data == "push_off":
+        set_daily_push(chat_id, None)
+    else:
+        return False
+    return True
+
+def is_superseded_tap(update: Update) -> bool:
+    """True if a newer tap on the same message is already waiting to be processed."""
+    message = update.callback_query.message
+    key = (message.chat_id, message.message_id)
+    latest = latest_callback_taps.get(key)
+    if latest is None or latest == update.update_id:
+        latest_callback_taps.pop(key, None)
+        return False
+    return latest > update.update_id
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handler for the /start command."""
     user = update.effective_user
@@ -618,9 +2100,9 @@ async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
     user = query.from_user
     chat_id = query.message.chat_id
+    apply_callback_setting(context, chat_id, query.data)
     user_info = get_user_data(chat_id)
-    lang = query.data.split("_")[-1]
-    user_info["language"] = lang
+    lang = user_info["language"]
 
     if user_info.get("is_new_user"):
         user_info["is_new_user"] = False
@@ -650,7 +2132,8 @@ async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             f"{l4}"
         )
 
-        await context.bot.edit_message_text(
+        await edit_message(
+            context,
             chat_id=chat_id,
             message_id=query.message.message_id,
             text=final_text,
@@ -672,7 +2155,7 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     lang = get_user_lang(chat_id)
 
     update_user_horoscope(chat_id)
-    update_crypto_prices()
+    note_price_demand()
 
     title_raw = get_text('main_menu_title', lang)
     title = f"✨ *{escape_markdown(title_raw, 2)}* ✨"
@@ -698,7 +2181,8 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     try:
         if query:
-            await context.bot.edit_message_text(
+            await edit_message(
+                context,
                 chat_id=chat_id,
                 message_id=query.message.message_id,
                 text=text_to_send,
@@ -733,7 +2217,8 @@ async def show_horoscope_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     try:
         title_raw = get_text("zodiac_select_title", lang)
         title_md = f"🔮 ***{escape_markdown(title_raw, 2)}***"
-        await context.bot.edit_message_text(
+        await edit_message(
+            context,
             chat_id=chat_id,
             message_id=query.message.message_id,
             text=title_md,
@@ -749,54 +2234,27 @@ async def show_zodiac_horoscope(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer()
 
     chat_id, lang = query.message.chat_id, get_user_lang(query.message.chat_id)
-    update_crypto_prices()
+    note_price_demand()
 
     # --- Title ---
-    current_date_md = escape_markdown(datetime.now().strftime("%d.%m.%Y"), 2)
+    current_date_md = escape_markdown(local_now(get_user_offset(chat_id)).strftime("%d.%m.%Y"), 2)
     display_zodiac_raw = ZODIAC_CALLBACK_MAP.get(lang, {}).get(zodiac, zodiac) if lang != "ru" else zodiac
     display_zodiac_md = escape_markdown(display_zodiac_raw, 2)
     emoji = ZODIAC_EMOJIS.get(zodiac, "✨")
     title = f"*{emoji} {display_zodiac_md} \\| {current_date_md}*"
 
-    # --- Horoscope Text ---
-    horoscope_text_raw = get_text('horoscope_unavailable', lang)
-    if (horoscope_indices := get_user_data(chat_id).get("horoscope_indices")) and \
-       (horoscope_index := horoscope_indices.get(zodiac)) is not None:
-        horoscope_text_raw = HOROSCOPES_DB[lang][display_zodiac_raw][horoscope_index]
-    horoscope_text_md = escape_markdown(horoscope_text_raw, 2)
-
-    # --- Market Data Section ---
-    market_data_items = []
-    latest_update_time = None
-    latest_source = "unknown"
-
-    for symbol in CRYPTO_IDS:
-        price_data = crypto_prices[symbol]
-        if price_data.get("price") is not None and price_data.get("change") is not None:
-            change_text, bar = format_change_bar(price_data["change"])
-            symbol_md = escape_markdown(symbol.upper(), 2)
-            price_md = escape_markdown(f'{price_data["price"]:,.2f}', 2)
-            change_with_duration = f"{change_text} (24h)"
-            change_md = escape_markdown(change_with_duration, 2)
-            market_data_items.append(f"*{symbol_md}*: ${price_md} {change_md}\n{bar}")
-
-            if price_data.get("last_update"):
-                if latest_update_time is None or price_data["last_update"] > latest_update_time:
-                    latest_update_time = price_data["last_update"]
-                    latest_source = price_data.get("source", "unknown")
-
-    last_update_str = latest_update_time.strftime("%H:%M") if latest_update_time else "N/A"
-    source_emoji = {"coingecko": "🦎", "binance": "📊", "cryptocompare": "🔄", "fallback": "🛡️"}.get(latest_source, "❓")
-    update_line_raw = f"{get_text('updated_at', lang)}: {last_update_str} {source_emoji}"
+    # --- Horoscope Text ---
+    horoscope_text_raw = get_text('horoscope_unavailable', lang)
+    if (horoscope_indices := get_user_data(chat_id).get("horoscope_indices")) and \
+       (horoscope_index := horoscope_indices.get(zodiac)) is not None:
+        horoscope_text_raw = horoscope_text(horoscope_index, lang)
+    horoscope_text_md = escape_markdown(horoscope_text_raw, 2)
 
-    market_title_raw = get_text('market_rates_title', lang)
-    market_data_str = "\n\n".join(market_data_items)
+    # --- Market Data Section ---
+    market_section = format_market_section(lang, get_user_currency(chat_id))
 
-    market_section = (
-        f"*{escape_markdown(market_title_raw, 2)}*\n"
-        f"{market_data_str}\n\n"
-        f"{escape_markdown(update_line_raw, 2)}"
-    )
+    # Последний просмотренный знак; знак самого пользователя (для адресных рассылок) — push_zodiac
+    get_user_data(chat_id)["zodiac"] = zodiac
 
     # --- Final Assembly ---
     disclaimer_raw = get_text('horoscope_disclaimer', lang)
@@ -811,11 +2269,12 @@ async def show_zodiac_horoscope(update: Update, context: ContextTypes.DEFAULT_TY
     )
 
     try:
-        await context.bot.edit_message_text(
+        await edit_message(
+            context,
             chat_id=chat_id,
             message_id=query.message.message_id,
             text=text,
-            reply_markup=main_menu_text_keyboard(lang),
+            reply_markup=market_keyboard(lang),
             parse_mode=ParseMode.MARKDOWN_V2
         )
     except BadRequest as e:
@@ -849,7 +2308,8 @@ async def show_learning_tip(update: Update, context: ContextTypes.DEFAULT_TYPE)
     text = f"{title_md}\n\n{quoted_tip}"
 
     try:
-        await context.bot.edit_message_text(
+        await edit_message(
+            context,
             chat_id=chat_id,
             message_id=query.message.message_id,
             text=text,
@@ -875,7 +2335,8 @@ async def show_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     text = f"{title}\n\n{description}"
 
     try:
-        await context.bot.edit_message_text(
+        await edit_message(
+            context,
             chat_id=chat_id,
             message_id=query.message.message_id,
             text=text,
@@ -895,38 +2356,462 @@ async def change_language(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         f"🇬🇧 {get_text('language_select', 'en')} / "
         f"🇨🇳 {get_text('language_select', 'zh')}"
     )
-    await context.bot.edit_message_text(
+    await edit_message(
+        context,
         chat_id=query.message.chat_id,
         message_id=query.message.message_id,
         text=lang_prompt,
         reply_markup=language_keyboard()
     )
 
+async def show_timezone_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows the time zone selection menu; `set_tz_<minutes>` callbacks change the zone."""
+    query = update.callback_query
+    await query.answer()
+    chat_id = query.message.chat_id
+    lang = get_user_lang(chat_id)
+
+    apply_callback_setting(context, chat_id, query.data)
+    current_offset = get_user_offset(chat_id)
+
+    title = f"🕐 *{escape_markdown(get_text('timezone_title', lang), 2)}*"
+    description_raw = get_text("timezone_description", lang).format(timezone=format_utc_offset(current_offset))
+    description = "\n".join(f">{escape_markdown(line, 2)}" for line in description_raw.splitlines())
+
+    try:
+        await edit_message(
+            context,
+            chat_id=chat_id,
+            message_id=query.message.message_id,
+            text=f"{title}\n\n{description}",
+            reply_markup=timezone_keyboard(lang, current_offset),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+    except BadRequest as e:
+        logger.error(f"Error showing timezone menu: {e}")
+
+async def show_currency_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows the display currency menu; `set_cur_<code>` callbacks change the currency."""
+    query = update.callback_query
+    await query.answer()
+    chat_id = query.message.chat_id
+    lang = get_user_lang(chat_id)
+
+    apply_callback_setting(context, chat_id, query.data)
+    current_currency = get_user_currency(chat_id)
+
+    title = f"💱 *{escape_markdown(get_text('currency_title', lang), 2)}*"
+    description_raw = get_text("currency_description", lang).format(currency=current_currency)
+    description = "\n".join(f">{escape_markdown(line, 2)}" for line in description_raw.splitlines())
+
+    try:
+        await edit_message(
+            context,
+            chat_id=chat_id,
+            message_id=query.message.message_id,
+            text=f"{title}\n\n{description}",
+            reply_markup=currency_keyboard(lang, current_currency),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+    except BadRequest as e:
+        logger.error(f"Error showing currency menu: {e}")
+
+async def show_daily_push_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows the daily push menu; `push_sign_<sign>` subscribes, `push_off` unsubscribes."""
+    query = update.callback_query
+    await query.answer()
+    chat_id = query.message.chat_id
+    lang = get_user_lang(chat_id)
+
+    apply_callback_setting(context, chat_id, query.data)
+    user_info = user_data.get(chat_id, {})
+    current_zodiac = user_info.get("push_zodiac") if user_info.get("daily_push") else None
+
+    if current_zodiac:
+        status = get_text("daily_push_status_on", lang).format(
+            sign=ZODIAC_CALLBACK_MAP.get(lang, {}).get(current_zodiac, current_zodiac),
+            window=push_window_label(),
+            timezone=format_utc_offset(get_user_offset(chat_id)),
+        )
+    else:
+        status = get_text("daily_push_status_off", lang)
+    title = f"🔔 *{escape_markdown(get_text('daily_push_title', lang), 2)}*"
+    description_raw = get_text("daily_push_description", lang).format(status=status)
+    description = "\n".join(f">{escape_markdown(line, 2)}" for line in description_raw.splitlines())
+
+    try:
+        await edit_message(
+            context,
+            chat_id=chat_id,
+            message_id=query.message.message_id,
+            text=f"{title}\n\n{description}",
+            reply_markup=daily_push_keyboard(lang, current_zodiac),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+    except BadRequest as e:
+        logger.error(f"Error showing daily push menu: {e}")
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /timezone +3 — sets the user's time zone in a private chat, or the chat's
+    broadcast time zone in a group (administrators only).
+    """
+    chat = update.effective_chat
+    lang = get_user_lang(update.effective_user.id)
+    utc_offset = parse_utc_offset(context.args[0]) if context.args else None
+    if utc_offset is None:
+        await update.message.reply_text(get_text("timezone_usage", lang))
+        return
+
+    if chat.type == chat.PRIVATE:
+        set_user_offset(chat.id, utc_offset)
+    else:
+        member = await context.bot.get_chat_member(chat.id, update.effective_user.id)
+        if member.status not in ("administrator", "creator"):
+            await update.message.reply_text(get_text("timezone_admin_only", lang))
+            return
+        set_chat_offset(chat.id, utc_offset)
+
+    schedule_daily_jobs(context.job_queue, utc_offset)
+    await update.message.reply_text(get_text("timezone_set", lang).format(timezone=format_utc_offset(utc_offset)))
+
+# --- Chart Cards ---
+
+CHART_FONT_PATH = os.environ.get('CHART_FONT_PATH', 'DejaVuSans.ttf')
+
+@lru_cache(maxsize=None)
+def chart_font(size: int, bold: bool = False):
+    """Loads the card font; falls back to Pillow's built-in font if the TTF is not installed."""
+    path = CHART_FONT_PATH.replace(".ttf", "-Bold.ttf") if bold else CHART_FONT_PATH
+    try:
+        return ImageFont.truetype(path, size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+def render_chart_card(snapshot: PriceSnapshot, currency: str, history: list) -> bytes:
+    """Renders a PNG card with price, 24h change and a sparkline of recent prices per coin."""
+    width, row_height, header = 720, 110, 70
+    image = Image.new("RGB", (width, header + row_height * len(CRYPTO_IDS) + 20), "#14161f")
+    draw = ImageDraw.Draw(image)
+    fetched_at = snapshot.fetched_at.strftime("%d.%m.%Y %H:%M") if snapshot.fetched_at else ""
+    draw.text((24, 22), "AstroKit", font=chart_font(28, bold=True), fill="#e8e8f0")
+    draw.text((width - 24, 28), fetched_at, font=chart_font(20), fill="#8a8fa3", anchor="ra")
+
+    for row, symbol in enumerate(CRYPTO_IDS):
+        top = header + row * row_height
+        quote = snapshot.quotes.get(symbol)
+        draw.line((24, top, width - 24, top), fill="#262a38")
+        draw.text((24, top + 18), symbol.upper(), font=chart_font(30, bold=True), fill="#e8e8f0")
+        if quote is None:
+            continue
+        color = "#2ecc71" if quote.change >= 0 else "#e74c3c"
+        draw.text((24, top + 60), format_fiat_price(quote.price, currency), font=chart_font(22), fill="#c9cbd6")
+        arrow = "▲" if quote.change >= 0 else "▼"
+        draw.text((width - 24, top + 36), f"{arrow} {abs(quote.change):.2f}%", font=chart_font(26, bold=True), fill=color, anchor="ra")
+
+        # Спарклайн: история цен, а при её нехватке — цена 24 часа назад и текущая
+        prices = [prices[symbol] for _, prices in history if symbol in prices]
+        if len(prices) < 2:
+            # При падении на 100% цену сутки назад не восстановить — рисуем ровную линию
+            prices = [quote.price / (1 + quote.change / 100) if quote.change > -100 else quote.price, quote.price]
+        low, high = min(prices), max(prices)
+        left, right, line_top, line_bottom = 250, 540, top + 20, top + row_height - 20
+        span = (high - low) or 1.0
+        points = [
+            (left + (right - left) * i / (len(prices) - 1), line_bottom - (line_bottom - line_top) * (price - low) / span)
+            for i, price in enumerate(prices)
+        ]
+        draw.line(points, fill=color, width=3, joint="curve")
+
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+class ChartCard:
+    """One rendered card: the render future, and the Telegram file_id once it was uploaded."""
+
+    __slots__ = ("render", "file_id", "upload_lock")
+
+    def __init__(self, render):
+        self.render = render
+        self.file_id = None
+        self.upload_lock = asyncio.Lock()
+
+# Карточки по (валюта, версия снимка цен). Картинка не зависит от языка — он только в подписи
+chart_cards = {}
+
+def _drop_failed_card(key, card: ChartCard, render):
+    """Forgets a card whose render failed, so the next /chart renders it again."""
+    if (render.cancelled() or render.exception() is not None) and chart_cards.get(key) is card:
+        del chart_cards[key]
+        metric_inc("chart_render_failures_total")
+
+def get_chart_card(currency: str) -> ChartCard:
+    """Returns the card of the current snapshot, starting its render (off the event loop) on first use."""
+    snapshot = price_snapshot
+    key = (currency, snapshot.version)
+    card = chart_cards.get(key)
+    if card is None:
+        loop = asyncio.get_running_loop()
+        card = chart_cards[key] = ChartCard(
+            loop.run_in_executor(None, render_chart_card, snapshot, currency, list(price_history))
+        )
+        card.render.add_done_callback(lambda render: _drop_failed_card(key, card, render))
+        metric_inc("chart_renders_total")
+        for old_key in [k for k in chart_cards if k[1] < snapshot.version]:
+            del chart_cards[old_key]
+    return card
+
+async def send_chart_card(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    """Sends the market card image to a chat, uploading each render only once."""
+    lang = get_user_lang(chat_id)
+    if Image is None:
+        await context.bot.send_message(chat_id=chat_id, text=get_text("chart_unavailable", lang))
+        return
+    note_price_demand()
+    card = get_chart_card(get_user_currency(chat_id))
+    caption = get_text("market_rates_title", lang)
+
+    async with card.upload_lock:
+        if card.file_id is None:
+            try:
+                photo = await card.render
+            except Exception as e:
+                logger.error(f"Error rendering chart card: {e}")
+                await context.bot.send_message(chat_id=chat_id, text=get_text("chart_unavailable", lang))
+                return
+            message = await context.bot.send_photo(chat_id=chat_id, photo=photo, caption=caption)
+            card.file_id = message.photo[-1].file_id
+            metric_inc("chart_uploads_total")
+            return
+    metric_inc("chart_file_id_reuses_total")
+    await context.bot.send_photo(chat_id=chat_id, photo=card.file_id, caption=caption)
+
+async def chart_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handler for /chart."""
+    await send_chart_card(context, update.message.chat_id)
+
+# --- Inline Mode ---
+
+def inline_horoscope_index(day: date, sign_ru: str) -> int:
+    """Horoscope of the day for a sign in inline mode: the same for everyone and stable across restarts."""
+    return random.Random(f"{day}:{sign_ru}").randrange(HOROSCOPE_SPACE_SIZE)
+
+class InlineResults:
+    """
+    Inline answers for one (lang, currency, day, price snapshot version), built once and
+    indexed by every prefix of every sign name, so answering a query is a dict lookup.
+    """
+
+    __slots__ = ("by_query",)
+
+    MARKET_ALIASES = ("btc", "eth", "ton", "market", "price", "курс", "рынок", "行情", "价格")
+
+    def __init__(self, lang: str, currency: str, day: date):
+        self.by_query = {}
+        market_md = format_market_section(lang, currency)
+        market_title = get_text('market_rates_title', lang).rstrip(":：")
+        market = InlineQueryResultArticle(
+            id="market",
+            title=f"📊 {market_title}",
+            description=" · ".join(symbol.upper() for symbol in CRYPTO_IDS),
+            input_message_content=InputTextMessageContent(market_md, parse_mode=ParseMode.MARKDOWN_V2)
+        )
+        date_md = escape_markdown(day.strftime("%d.%m.%Y"), 2)
+        signs = []
+        for sign_ru in ZODIAC_SIGNS["ru"]:
+            sign_lang = ZODIAC_CALLBACK_MAP.get(lang, {}).get(sign_ru, sign_ru)
+            emoji = ZODIAC_EMOJIS.get(sign_ru, "✨")
+            text = horoscope_text(inline_horoscope_index(day, sign_ru), lang)
+            message = (
+                f"*{emoji} {escape_markdown(sign_lang, 2)} \\| {date_md}*\n\n"
+                f"{escape_markdown(text, 2)}\n\n"
+                f"━━━━━━━━━━━━━━━━━━━\n\n"
+                f"{market_md}"
+            )
+            result = InlineQueryResultArticle(
+                id=f"sign_{ZODIAC_SIGNS['ru'].index(sign_ru)}",
+                title=f"{emoji} {sign_lang}",
+                description=text,
+                input_message_content=InputTextMessageContent(message, parse_mode=ParseMode.MARKDOWN_V2)
+            )
+            signs.append(result)
+            aliases = {ZODIAC_CALLBACK_MAP.get(other, {}).get(sign_ru, sign_ru).lower() for other in ("ru", "en", "zh")}
+            self._index(aliases, result)
+        self._index({alias.lower() for alias in self.MARKET_ALIASES + (market_title,)}, market)
+        self.by_query[""] = signs + [market]
+
+    def _index(self, aliases, result):
+        for alias in aliases:
+            for length in range(1, len(alias) + 1):
+                results = self.by_query.setdefault(alias[:length], [])
+                if not results or results[-1] is not result:
+                    results.append(result)
+
+# Готовые ответы: (язык, валюта, день, версия снимка цен) -> InlineResults. Собираются заранее
+# при публикации цен и контента дня (в потоке обновления), словарь заменяется целиком
+inline_results = {}
+inline_results_lock = threading.Lock()
+
+def inline_days() -> set:
+    """Local dates in use by the users' time zones, plus the days already prepared for the next rollover."""
+    now = datetime.now(timezone.utc)
+    days = {(now + timedelta(minutes=offset)).date() for offset in [DEFAULT_UTC_OFFSET, *list(users_by_offset)]}
+    return days | {content.day for content in list(next_daily_content.values())}
+
+def prebuild_inline_results():
+    """Builds the inline answers of the current price snapshot for every language, currency and day in use."""
+    global inline_results
+    snapshot = price_snapshot
+    days = inline_days()
+    with inline_results_lock:
+        current = dict(inline_results)
+    built = {}
+    for lang, day in ((lang, day) for lang in DEFAULT_CURRENCY_BY_LANG for day in days):
+        for currency in FIAT_CURRENCIES:
+            key = (lang, currency, day, snapshot.version)
+            built[key] = current.get(key) or InlineResults(lang, currency, day)
+    metric_inc("inline_results_builds_total", len(built.keys() - current.keys()))
+    with inline_results_lock:
+        # Ответы, собранные обработчиком за это время, тоже сохраняем, если они ещё актуальны
+        for key, results in inline_results.items():
+            if key[3] == snapshot.version and key[2] in days:
+                built.setdefault(key, results)
+        inline_results = built
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Answers `@bot leo` style inline queries with sign horoscope and market cards."""
+    query = update.inline_query
+    user_id = query.from_user.id
+    # Inline queries come from anyone; users the bot doesn't know are not added to user_data,
+    # and known ones are only peeked at, so a query doesn't pull a cold user into memory
+    user_info = user_data.peek(user_id)
+    if user_info is not None:
+        lang = user_info.get("language") or "ru"
+        currency = user_info.get("currency")
+        if currency not in FIAT_CURRENCIES:
+            currency = DEFAULT_CURRENCY_BY_LANG.get(lang, "USD")
+        utc_offset = user_info.get("utc_offset")
+    else:
+        code = (query.from_user.language_code or "")[:2]
+        lang = code if code in DEFAULT_CURRENCY_BY_LANG else "ru"
+        currency = DEFAULT_CURRENCY_BY_LANG[lang]
+        utc_offset = None
+
+    # Только снимок курсов: обновление, если нужно, уходит в фон
+    note_price_demand()
+    day = local_now(DEFAULT_UTC_OFFSET if utc_offset is None else utc_offset).date()
+    snapshot = price_snapshot
+    key = (lang, currency, day, snapshot.version)
+    results = inline_results.get(key)
+    if results is None:
+        # Заранее не собрано (например, пояс перешёл через полночь раньше подготовки) — собираем здесь
+        results = InlineResults(lang, currency, day)
+        with inline_results_lock:
+            inline_results[key] = results
+        metric_inc("inline_results_builds_total")
+        metric_inc("inline_results_misses_total")
+    metric_inc("inline_queries_total")
+
+    # Клиенты Telegram кэшируют ответ, пока наши курсы не устарели
+    age = (datetime.now() - snapshot.fetched_at).total_seconds() if snapshot.fetched_at else 0
+    cache_time = int(max(30, min(INLINE_CACHE_TIME_MAX, api_cache["cache_duration"] - age)))
+    await query.answer(
+        results.by_query.get(query.query.strip().lower(), []),
+        cache_time=cache_time,
+        # Ответ зависит от языка и валюты пользователя, поэтому кэшируется для каждого отдельно
+        is_personal=True
+    )
+
 # --- Channel Broadcast Feature ---
 
-def load_broadcast_chats():
-    """Loads the list of broadcast chat IDs from a JSON file."""
+# Чат удаляется из рассылки после стольких постоянных ошибок доставки подряд
+BROADCAST_MAX_PERMANENT_FAILURES = int(os.environ.get("BROADCAST_MAX_PERMANENT_FAILURES", 3))
+
+# Фрагменты текста BadRequest, означающие, что в чат больше нельзя писать
+PERMANENT_BAD_REQUEST_MARKERS = (
+    "chat not found",
+    "chat_write_forbidden",
+    "have no rights to send",
+    "not enough rights to send",
+    "peer_id_invalid",
+    "bot is not a member",
+)
+
+def load_broadcast_data() -> dict:
+    """Loads broadcast_chats.json: chat IDs, delivery failure counters and chat time zones."""
     try:
-        with open("broadcast_chats.json", "r") as f:
-            data = json.load(f)
-            return data.get("broadcast_chat_ids", [])
+        data = read_json_file("broadcast_chats.json")
     except FileNotFoundError:
         logger.warning("broadcast_chats.json not found. Creating a new one.")
-        with open("broadcast_chats.json", "w") as f:
-            json.dump({"broadcast_chat_ids": []}, f)
-        return []
+        write_json_file("broadcast_chats.json", {"broadcast_chat_ids": []}, pretty=True)
+        data = {}
     except Exception as e:
         logger.error(f"Error loading broadcast_chats.json: {e}")
-        return []
+        data = {}
+    return {
+        "broadcast_chat_ids": data.get("broadcast_chat_ids", []),
+        "delivery_failures": {int(k): v for k, v in data.get("delivery_failures", {}).items()},
+        "timezones": {int(k): v for k, v in data.get("timezones", {}).items()},
+    }
+
+def load_broadcast_chats():
+    """Loads the list of broadcast chat IDs from a JSON file."""
+    return load_broadcast_data()["broadcast_chat_ids"]
+
+def load_broadcast_failures() -> dict:
+    """Loads per-chat counters of consecutive permanent delivery failures."""
+    return load_broadcast_data()["delivery_failures"]
 
-def save_broadcast_chats(chat_ids):
-    """Saves the list of broadcast chat IDs to a JSON file."""
+# Часовые пояса групп: chat_id -> UTC-смещение в минутах. Читаются с диска один раз при запуске
+# и записываются в broadcast_chats.json только при изменении; не зависят от подписки на рассылку
+chat_timezones = {}
+
+def load_chat_timezones():
+    chat_timezones.clear()
+    chat_timezones.update(load_broadcast_data()["timezones"])
+
+def load_broadcast_timezones() -> dict:
+    """Returns per-chat time zones (UTC offsets in minutes) from memory; missing chats use the default."""
+    return chat_timezones
+
+def set_chat_offset(chat_id: int, utc_offset: int):
+    """Changes a group's time zone and persists it, whether or not the group gets the broadcast."""
+    if utc_offset == DEFAULT_UTC_OFFSET:
+        chat_timezones.pop(chat_id, None)
+    else:
+        chat_timezones[chat_id] = utc_offset
+    save_broadcast_chats(load_broadcast_chats())
+
+def save_broadcast_chats(chat_ids, failures=None):
+    """Saves the list of broadcast chat IDs (with failure counters and chat time zones) to a JSON file."""
+    if failures is None:
+        failures = load_broadcast_failures()
+    # Failure counters are only kept for chats that are still subscribed
+    failures = {chat_id: count for chat_id, count in failures.items() if chat_id in chat_ids and count > 0}
     try:
-        with open("broadcast_chats.json", "w") as f:
-            json.dump({"broadcast_chat_ids": chat_ids}, f, indent=4)
+        write_json_file(
+            "broadcast_chats.json",
+            {"broadcast_chat_ids": chat_ids, "delivery_failures": failures, "timezones": chat_timezones},
+            pretty=True
+        )
     except Exception as e:
         logger.error(f"Error saving broadcast_chats.json: {e}")
 
+def classify_delivery_error(error: Exception) -> str:
+    """
+    Classifies a broadcast delivery error as "permanent" (the chat can no longer receive
+    messages: bot kicked/blocked, chat deleted) or "transient" (flood control, timeouts,
+    network problems) that is worth retrying on the next broadcast.
+    """
+    if isinstance(error, Forbidden):
+        return "permanent"
+    if isinstance(error, BadRequest):
+        message = str(error).lower()
+        if any(marker in message for marker in PERMANENT_BAD_REQUEST_MARKERS):
+            return "permanent"
+    return "transient"
+
 async def handle_new_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the bot being added to a new chat."""
     if update.my_chat_member.new_chat_member.user.id == context.bot.id:
@@ -934,9 +2819,13 @@ async def handle_new_chat_member(update: Update, context: ContextTypes.DEFAULT_T
         if update.my_chat_member.new_chat_member.status in ["member", "administrator"]:
             logger.info(f"Bot was added to chat {chat_id}. Adding to broadcast list.")
             chat_ids = load_broadcast_chats()
-            if chat_id not in chat_ids:
-                chat_ids.append(chat_id)
-                save_broadcast_chats(chat_ids)
+            failures = load_broadcast_failures()
+            if chat_id not in chat_ids or chat_id in failures:
+                if chat_id not in chat_ids:
+                    chat_ids.append(chat_id)
+                # Re-adding the bot clears any earlier delivery failures
+                failures.pop(chat_id, None)
+                save_broadcast_chats(chat_ids, failures)
         elif update.my_chat_member.new_chat_member.status in ["left", "kicked"]:
             logger.info(f"Bot was removed from chat {chat_id}. Removing from broadcast list.")
             chat_ids = load_broadcast_chats()
@@ -944,58 +2833,60 @@ async def handle_new_chat_member(update: Update, context: ContextTypes.DEFAULT_T
                 chat_ids.remove(chat_id)
                 save_broadcast_chats(chat_ids)
 
-def format_daily_summary(lang: str) -> str:
-    """Formats the full daily summary message in MarkdownV2."""
-    # --- Title ---
-    title_raw = get_text('astro_command_title', lang)
-    title_md = escape_markdown(title_raw, 2)
-    current_date_md = escape_markdown(datetime.now(pytz.timezone("Europe/Moscow")).strftime("%d.%m.%Y"), 2)
-    title = f"🌌 *{title_md} \\| {current_date_md}*"
-
-    # --- Horoscopes Section ---
-    horoscopes = {}
-    ru_to_lang_map = ZODIAC_CALLBACK_MAP.get(lang, {})
-    for sign_ru in ZODIAC_SIGNS["ru"]:
-        sign_lang = ru_to_lang_map.get(sign_ru, sign_ru)
-        horoscope_index = random.randint(0, len(HOROSCOPES_DB["ru"][sign_ru]) - 1)
-        horoscopes[sign_lang] = HOROSCOPES_DB[lang][sign_lang][horoscope_index]
-    horoscope_section_raw = "\n\n".join(horoscopes.values())
-    horoscope_section_md = escape_markdown(horoscope_section_raw, 2)
-
-    # --- Market Data Section ---
-    update_crypto_prices()
+def format_market_section(lang: str, currency: str = "USD") -> str:
+    """Formats the crypto rates block in MarkdownV2 from one price snapshot, in the given fiat currency."""
     market_data_items = []
-    latest_update_time = None
-    latest_source = "unknown"
+    snapshot = price_snapshot  # один согласованный снимок на всё сообщение
 
     for symbol in CRYPTO_IDS:
-        price_data = crypto_prices[symbol]
-        if price_data.get("price") is not None and price_data.get("change") is not None:
-            change_text, bar = format_change_bar(price_data["change"])
+        quote = snapshot.quotes.get(symbol)
+        if quote is not None:
+            change_text, bar = format_change_bar(quote.change)
             symbol_md = escape_markdown(symbol.upper(), 2)
-            price_md = escape_markdown(f'{price_data["price"]:,.2f}', 2)
+            price_md = escape_markdown(format_fiat_price(quote.price, currency), 2)
             change_with_duration = f"{change_text} (24h)"
             change_md = escape_markdown(change_with_duration, 2)
-            market_data_items.append(f"*{symbol_md}*: ${price_md} {change_md}\n{bar}")
-
-            if price_data.get("last_update"):
-                if latest_update_time is None or price_data["last_update"] > latest_update_time:
-                    latest_update_time = price_data["last_update"]
-                    latest_source = price_data.get("source", "unknown")
+            market_data_items.append(f"*{symbol_md}*: {price_md} {change_md}\n{bar}")
 
-    last_update_str = latest_update_time.strftime("%H:%M") if latest_update_time else "N/A"
+    latest = snapshot.latest_quote()
+    latest_source = latest.source if latest else "unknown"
+    last_update_str = latest.last_update.strftime("%H:%M") if latest else "N/A"
     source_emoji = {"coingecko": "🦎", "binance": "📊", "cryptocompare": "🔄", "fallback": "🛡️"}.get(latest_source, "❓")
     update_line_raw = f"{get_text('updated_at', lang)}: {last_update_str} {source_emoji}"
 
     market_title_raw = get_text('market_rates_title', lang)
     market_data_str = "\n\n".join(market_data_items)
 
-    market_section = (
+    return (
         f"*{escape_markdown(market_title_raw, 2)}*\n"
         f"{market_data_str}\n\n"
         f"{escape_markdown(update_line_raw, 2)}"
     )
 
+def format_daily_summary(lang: str, utc_offset: int = DEFAULT_UTC_OFFSET, currency: str = None) -> str:
+    """
+    Formats the full daily summary message in MarkdownV2 for the local day of `utc_offset`.
+    Prices are shown in `currency`, by default the one of the language.
+    """
+    # --- Title ---
+    title_raw = get_text('astro_command_title', lang)
+    title_md = escape_markdown(title_raw, 2)
+    current_date_md = escape_markdown(local_now(utc_offset).strftime("%d.%m.%Y"), 2)
+    title = f"🌌 *{title_md} \\| {current_date_md}*"
+
+    # --- Horoscopes Section ---
+    horoscopes = {}
+    ru_to_lang_map = ZODIAC_CALLBACK_MAP.get(lang, {})
+    for sign_ru in ZODIAC_SIGNS["ru"]:
+        sign_lang = ru_to_lang_map.get(sign_ru, sign_ru)
+        horoscopes[sign_lang] = horoscope_text(random.randrange(HOROSCOPE_SPACE_SIZE), lang)
+    horoscope_section_raw = "\n\n".join(horoscopes.values())
+    horoscope_section_md = escape_markdown(horoscope_section_raw, 2)
+
+    # --- Market Data Section ---
+    note_price_demand()
+    market_section = format_market_section(lang, currency or DEFAULT_CURRENCY_BY_LANG.get(lang, "USD"))
+
     # --- Final Assembly ---
     return (
         f"{title}\n\n"
@@ -1006,10 +2897,17 @@ def format_daily_summary(lang: str) -> str:
 
 async def astro_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handler for the /astro command."""
-    update_user_horoscope(update.message.chat_id)
+    # Сводка общая для всех и от профиля не зависит: неизвестные чаты (группы, новые
+    # пользователи) в хранилище не заводим, у известных отмечаем активность дня
+    if update.message.chat_id in user_data:
+        update_user_horoscope(update.message.chat_id)
     lang = get_user_lang(update.message.chat_id)
-    full_message = format_daily_summary(lang)
-    await update.message.reply_text(full_message, parse_mode=ParseMode.MARKDOWN_V2)
+    full_message = format_daily_summary(
+        lang, get_chat_offset(update.message.chat_id), get_user_currency(update.message.chat_id)
+    )
+    await update.message.reply_text(
+        full_message, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=market_keyboard(lang, main_menu=False)
+    )
 
 
 async def day_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1038,22 +2936,154 @@ async def day_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
 
 
+def format_daily_push(chat_id: int) -> str:
+    """Builds the personal daily message: the horoscope of the user's sign and the tip of the day."""
+    user_info = get_user_data(chat_id)
+    lang = user_info.get("language") or "ru"
+    zodiac = user_info["push_zodiac"]
+    tip_index, horoscope_indices = daily_indices(chat_id)
+
+    display_zodiac = ZODIAC_CALLBACK_MAP.get(lang, {}).get(zodiac, zodiac)
+    current_date = local_now(get_user_offset(chat_id)).strftime("%d.%m.%Y")
+    title = f"*{ZODIAC_EMOJIS.get(zodiac, '✨')} {escape_markdown(display_zodiac, 2)} \\| {escape_markdown(current_date, 2)}*"
+
+    horoscope_index = horoscope_indices.get(zodiac)
+    horoscope = horoscope_text(horoscope_index, lang) if horoscope_index is not None else get_text('horoscope_unavailable', lang)
+
+    tip_text_raw = get_text('horoscope_unavailable', lang)
+    if tip_index is not None and tip_index < len(TEXTS["learning_tips"][lang]):
+        tip_text_raw = TEXTS["learning_tips"][lang][tip_index]
+    emoji, _, tip_body = tip_text_raw.partition(' ')
+
+    return (
+        f"{title}\n\n"
+        f"{escape_markdown(horoscope, 2)}\n\n"
+        f"💡 *{escape_markdown(get_text('tip_of_the_day_title', lang), 2)}*\n"
+        f">{emoji} {escape_markdown(tip_body, 2)}"
+    )
+
+async def daily_push_job(context: ContextTypes.DEFAULT_TYPE):
+    """Runs every slot and sends the personal push to the subscribers whose slot has come, in every time zone."""
+    outbound_priority.set("broadcast")
+    for utc_offset in set(push_subscribers) | set(push_retries):
+        day, slots = due_push_slots(utc_offset)
+        day_str = str(day)
+        retry_day, attempts = push_retries.pop(utc_offset, (None, {}))
+        if retry_day != day:
+            attempts = {}  # окно сменилось — недоставленное в прошлом окне уже не актуально
+        due = list(attempts)
+        for slot in slots:
+            due.extend(push_subscribers.get(utc_offset, {}).get(slot, ()))
+        failed = {}
+        for chat_id in due:
+            user_info = user_data.get(chat_id, {})
+            # Отметка о доставке за окно — чтобы не отправить повторно после перезапуска
+            if not user_info.get("daily_push") or user_info.get("push_day") == day_str:
+                continue
+            lang = user_info.get("language") or "ru"
+            try:
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=format_daily_push(chat_id),
+                    reply_markup=main_menu_text_keyboard(lang),
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+                # После await запись могла быть вытеснена — берём актуальную
+                get_user_data(chat_id)["push_day"] = day_str
+                metric_inc("daily_push_sent_total")
+            except Exception as e:
+                metric_inc("daily_push_failed_total")
+                if classify_delivery_error(e) == "permanent":
+                    # Пользователь заблокировал бота — подписка больше не нужна
+                    set_daily_push(chat_id, None)
+                    logger.info("Daily push disabled for %s: %s", chat_id, e)
+                elif attempts.get(chat_id, 0) + 1 < DAILY_PUSH_MAX_ATTEMPTS:
+                    # Временная ошибка — повторим при следующем запуске задачи
+                    failed[chat_id] = attempts.get(chat_id, 0) + 1
+                    logger.warning("Daily push to %s failed, will retry: %s", chat_id, e)
+                else:
+                    logger.warning("Daily push to %s failed: %s", chat_id, e)
+        if failed:
+            push_retries[utc_offset] = (day, failed)
+    metric_set("daily_push_subscribers", sum(len(ids) for slots in push_subscribers.values() for ids in slots.values()))
+
 async def broadcast_job(context: ContextTypes.DEFAULT_TYPE):
     """Job to broadcast the daily summary to all subscribed channels."""
-    logger.info("Starting daily broadcast job...")
-    chat_ids = load_broadcast_chats()
+    utc_offset = (context.job.data or {}).get("utc_offset", DEFAULT_UTC_OFFSET)
+    logger.info(f"Starting daily broadcast job for {format_utc_offset(utc_offset)}...")
+    outbound_priority.set("broadcast")
+    stored = load_broadcast_data()
+    timezones = chat_timezones
+    chat_ids = [
+        chat_id for chat_id in stored["broadcast_chat_ids"]
+        if timezones.get(chat_id, DEFAULT_UTC_OFFSET) == utc_offset
+    ]
     if not chat_ids:
         logger.info("No broadcast chats to send to.")
         return
 
-    full_message = format_daily_summary(lang="ru") # Broadcasts are in Russian by default
+    full_message = format_daily_summary("ru", utc_offset) # Broadcasts are in Russian by default
+    failures = stored["delivery_failures"]
+    delivered, transient, pruned, migrated = 0, 0, [], {}
+
     for chat_id in chat_ids:
         try:
             await context.bot.send_message(chat_id=chat_id, text=full_message, parse_mode=ParseMode.MARKDOWN_V2)
-            logger.info(f"Successfully broadcasted to chat {chat_id}")
+            failures.pop(chat_id, None)
+            delivered += 1
+            logger.debug("Successfully broadcasted to chat %s", chat_id)
+        except ChatMigrated as e:
+            # The group was upgraded to a supergroup: keep the subscription under the new ID
+            migrated[chat_id] = e.new_chat_id
+            failures.pop(chat_id, None)
+            logger.warning(f"Chat {chat_id} migrated to {e.new_chat_id}. Updating broadcast list.")
+            # Сегодняшняя сводка не должна потеряться: повторяем отправку уже в новый чат
+            try:
+                await context.bot.send_message(chat_id=e.new_chat_id, text=full_message, parse_mode=ParseMode.MARKDOWN_V2)
+                delivered += 1
+            except Exception as retry_error:
+                if classify_delivery_error(retry_error) == "permanent":
+                    failures[e.new_chat_id] = failures.get(e.new_chat_id, 0) + 1
+                else:
+                    transient += 1
+                logger.error(f"Failed to broadcast to migrated chat {e.new_chat_id}: {retry_error}")
         except Exception as e:
-            logger.error(f"Failed to broadcast to chat {chat_id}: {e}")
-    logger.info("Daily broadcast job finished.")
+            if classify_delivery_error(e) == "permanent":
+                failures[chat_id] = failures.get(chat_id, 0) + 1
+                logger.warning(
+                    f"Permanent delivery failure to chat {chat_id} "
+                    f"({failures[chat_id]}/{BROADCAST_MAX_PERMANENT_FAILURES}): {e}"
+                )
+                if failures[chat_id] >= BROADCAST_MAX_PERMANENT_FAILURES:
+                    pruned.append(chat_id)
+            else:
+                transient += 1
+                logger.error(f"Failed to broadcast to chat {chat_id}: {e}")
+
+    current = load_broadcast_data()
+    if pruned or migrated or failures != current["delivery_failures"]:
+        # Re-read the list so chats added while the job was running are not lost
+        updated_ids = []
+        for chat_id in current["broadcast_chat_ids"]:
+            if chat_id in pruned:
+                continue
+            new_id = migrated.get(chat_id, chat_id)
+            if new_id not in updated_ids:
+                updated_ids.append(new_id)
+        for old_id, new_id in migrated.items():
+            if old_id in chat_timezones:
+                chat_timezones[new_id] = chat_timezones.pop(old_id)
+        save_broadcast_chats(updated_ids, failures)
+
+    for chat_id in pruned:
+        logger.warning(
+            f"Removed chat {chat_id} from broadcast list after "
+            f"{BROADCAST_MAX_PERMANENT_FAILURES} permanent delivery failures."
+        )
+    logger.info(
+        f"Daily broadcast job finished: {delivered} delivered, {transient} transient failures, "
+        f"{len(pruned)} pruned, {len(migrated)} migrated, {len(chat_ids) - len(pruned)} chats remaining."
+    )
 
 
 def premium_menu_keyboard(lang: str):
@@ -1096,7 +3126,8 @@ async def show_premium_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
     try:
-        await context.bot.edit_message_text(
+        await edit_message(
+            context,
             chat_id=chat_id,
             message_id=query.message.message_id,
             text=text,
@@ -1168,7 +3199,8 @@ async def show_commands_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
     text = f"{title_md}\n\n{quoted_body}"
 
     try:
-        await context.bot.edit_message_text(
+        await edit_message(
+            context,
             chat_id=chat_id,
             message_id=query.message.message_id,
             text=text,
@@ -1205,7 +3237,8 @@ async def show_support_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
     final_text = f"{title}\n\n{quoted_text}"
 
     try:
-        await context.bot.edit_message_text(
+        await edit_message(
+            context,
             chat_id=chat_id,
             message_id=query.message.message_id,
             text=final_text,
@@ -1237,6 +3270,15 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """Main callback query handler."""
     query = update.callback_query
     data = query.data
+
+    # A burst of taps on one message collapses into a single render of the last tap;
+    # a superseded settings tap is still applied, only its re-render is skipped
+    if query.message and is_superseded_tap(update):
+        if is_render_only_callback(data) or apply_callback_setting(context, query.message.chat_id, data):
+            metric_inc("callback_taps_coalesced_total")
+            await query.answer()
+            return
+
     lang = get_user_lang(query.message.chat_id)
 
     try:
@@ -1247,6 +3289,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         elif data.startswith("zodiac_"):
             zodiac = data[7:]
             await show_zodiac_horoscope(update, context, zodiac)
+        elif data == "market_chart":
+            await query.answer()
+            await send_chart_card(context, query.message.chat_id)
         elif data == "learning_tip":
             await show_learning_tip(update, context)
         elif data == "settings_menu":
@@ -1263,11 +3308,548 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await set_language(update, context)
         elif data == "change_language":
             await change_language(update, context)
+        elif data == "timezone_menu" or data.startswith("set_tz_"):
+            await show_timezone_menu(update, context)
+        elif data == "currency_menu" or data.startswith("set_cur_"):
+            await show_currency_menu(update, context)
+        elif data in ("daily_push_menu", "push_off") or data.startswith("push_sign_"):
+            await show_daily_push_menu(update, context)
 
     except Exception as e:
         logger.error(f"Error in button handler: {e}")
         await query.answer(get_text("error_occurred", lang))
 
+_record_started_at = None
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Appends every incoming update to RECORD_UPDATES_FILE for later replay."""
+    global _record_started_at
+    now = time.monotonic()
+    if _record_started_at is None:
+        _record_started_at = now
+    try:
+        with open(RECORD_UPDATES_FILE, "ab") as f:
+            f.write(json_dumps({"t": round(now - _record_started_at, 3), "update": update.to_dict()}) + b"\n")
+    except Exception as e:
+        logger.error(f"Error recording update: {e}")
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin-only /stats: user counts from the incrementally maintained counters."""
+    if not is_admin(update.effective_user.id):
+        return
+    languages = ", ".join(f"{lang} {count}" for lang, count in sorted(user_stats["languages"].items()))
+    await update.message.reply_text(
+        f"👥 Users: {user_stats['users']} (groups: {user_stats['groups']})\n"
+        f"🌐 Languages: {languages or '-'}\n"
+        f"📅 DAU: ~{daily_active_count(1)}\n"
+        f"🗓 WAU: ~{daily_active_count(7)}"
+    )
+
+CAMPAIGN_USAGE = (
+    "Usage: /campaign [lang=en] [days=7] [sign=Leo] [text]\n"
+    "sign is the user's own sign chosen in the morning horoscope menu. Without text only the recipients are counted."
+)
+
+def parse_campaign_filters(args: list):
+    """Splits /campaign arguments into index filters and the message text; returns None if a filter is invalid."""
+    filters = {}
+    while args and "=" in args[0]:
+        key, _, value = args.pop(0).partition("=")
+        if key == "lang" and value in ("ru", "en", "zh"):
+            filters["language"] = value
+        elif key == "days" and value.isdigit() and int(value) > 0:
+            filters["active_days"] = int(value)
+        elif key == "sign" and value.lower() in ZODIAC_BY_NAME:
+            filters["zodiac"] = ZODIAC_BY_NAME[value.lower()]
+        else:
+            return None
+    return filters, " ".join(args)
+
+async def campaign_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin-only /campaign: a direct message to the users matching the index filters."""
+    if not is_admin(update.effective_user.id):
+        return
+    parsed = parse_campaign_filters(list(context.args or []))
+    if parsed is None:
+        await update.message.reply_text(CAMPAIGN_USAGE)
+        return
+    filters, text = parsed
+    recipients = user_index.count(**filters)
+    if not text:
+        await update.message.reply_text(f"Recipients: {recipients}")
+        return
+    context.job_queue.run_once(
+        campaign_job, 0, name="campaign",
+        data={"filters": filters, "text": text, "report_chat_id": update.effective_chat.id},
+    )
+    await update.message.reply_text(f"Campaign queued for {recipients} recipients.")
+
+async def campaign_job(context: ContextTypes.DEFAULT_TYPE):
+    """Sends a campaign page by page with broadcast priority, then reports the result to the admin."""
+    data = context.job.data
+    outbound_priority.set("broadcast")
+    delivered, permanent, transient = 0, 0, 0
+    for page in user_index.pages(**data["filters"]):
+        for chat_id in page:
+            try:
+                await context.bot.send_message(chat_id=chat_id, text=data["text"])
+                delivered += 1
+            except Exception as e:
+                if classify_delivery_error(e) == "permanent":
+                    permanent += 1
+                else:
+                    transient += 1
+                logger.debug("Campaign delivery to %s failed: %s", chat_id, e)
+    metric_inc("campaign_messages_total", delivered)
+    logger.info(f"Campaign finished: {delivered} delivered, {permanent} permanent and {transient} transient failures")
+    await context.bot.send_message(
+        chat_id=data["report_chat_id"],
+        text=f"Campaign finished: {delivered} delivered, {permanent} blocked, {transient} failed.",
+    )
+
+# --- Profiling ---
+
+def is_admin(user_id: int) -> bool:
+    """Checks whether the user may run service commands."""
+    return user_id in ADMIN_IDS
+
+class StackSampler:
+    """
+    Statistical profiler: periodically samples the stacks of every thread (or only of
+    `thread_id`) from a background thread and aggregates them into collapsed stacks for
+    flamegraphs. Each stack starts with the thread name, so work moved off the event loop
+    (executor jobs, chart rendering, file writes) shows up next to the loop itself.
+    """
+
+    def __init__(self, thread_id: int = None, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="StackSampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                frames = {self.thread_id: frames[self.thread_id]} if self.thread_id in frames else {}
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+
+# Активный сеанс профилирования (None — профилирование выключено и ничего не стоит)
+profiling_session = None
+
+def start_profiling(mode: str = "cprofile") -> bool:
+    """
+    Starts a profiling session. "sample" covers every thread of the process; "cprofile"
+    covers only the calling thread, which must be the event loop thread so that every
+    handler and JobQueue job is covered (executor and Flask threads are not).
+    Returns False if a session is already running.
+    """
+    global profiling_session
+    if profiling_session is not None:
+        return False
+    if mode == "sample":
+        profiler = StackSampler()
+        profiler.start()
+        scope = "all threads"
+    else:
+        mode = "cprofile"
+        profiler = cProfile.Profile()
+        profiler.enable()
+        scope = "event loop thread only; use sample mode for executor threads"
+    profiling_session = {"mode": mode, "profiler": profiler, "started_at": datetime.now()}
+    logger.info(f"🔬 Profiling started ({mode}, {scope})")
+    return True
+
+def stop_profiling():
+    """Stops the active profiling session and writes its results to PROFILE_DIR. Returns the file path."""
+    global profiling_session
+    session, profiling_session = profiling_session, None
+    if session is None:
+        return None
+    profiler = session["profiler"]
+    stamp = session["started_at"].strftime("%Y%m%d-%H%M%S")
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    try:
+        if session["mode"] == "sample":
+            profiler.stop()
+            path = os.path.join(PROFILE_DIR, f"profile-{stamp}.collapsed")
+            profiler.dump(path)
+        else:
+            profiler.disable()
+            path = os.path.join(PROFILE_DIR, f"profile-{stamp}.pstats")
+            profiler.dump_stats(path)
+    except Exception as e:
+        logger.error(f"Error saving profile: {e}")
+        return None
+    duration = (datetime.now() - session["started_at"]).total_seconds()
+    logger.info(f"🔬 Profiling stopped after {duration:.0f}s, results saved to {path}")
+    return path
+
+async def profiling_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue callback: starts (data = {"mode": ...}) or stops a profiling session."""
+    data = context.job.data or {}
+    if data.get("action") == "start":
+        start_profiling(data.get("mode", "cprofile"))
+    else:
+        stop_profiling()
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Admin-only /profile command.
+    /profile [seconds] [cprofile|sample] starts a session, /profile stop ends it early.
+    """
+    if not is_admin(update.effective_user.id):
+        return
+    args = context.args or []
+
+    if args and args[0] == "stop":
+        for job in context.job_queue.get_jobs_by_name("profile_stop"):
+            job.schedule_removal()
+        path = stop_profiling()
+        await update.message.reply_text(f"Profile saved to {path}" if path else "Profiling is not running.")
+        return
+
+    try:
+        seconds = int(args[0]) if args else 60
+    except ValueError:
+        await update.message.reply_text("Usage: /profile [seconds] [cprofile|sample] | /profile stop")
+        return
+    mode = args[1] if len(args) > 1 and args[1] in ("cprofile", "sample") else "cprofile"
+
+    if not start_profiling(mode):
+        await update.message.reply_text("Profiling is already running.")
+        return
+    context.job_queue.run_once(profiling_job, seconds, data={"action": "stop"}, name="profile_stop")
+    scope = "all threads" if mode == "sample" else "event loop thread only"
+    await update.message.reply_text(f"Profiling ({mode}, {scope}) for {seconds}s, results go to {PROFILE_DIR}/.")
+
+# --- Concurrent update processing ---
+
+def update_chat_key(update: object):
+    """Returns the chat (or, for chat-less updates, the user) an update belongs to."""
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+    return None
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different chats concurrently (at most `max_concurrent_updates`
+    at a time) while updates from the same chat run strictly in arrival order, so e.g.
+    set_language followed by main_menu can never race.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = 1024):
+        # The base semaphore only caps pending tasks; the worker semaphore caps real concurrency
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.workers = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks = {}
+        self._chat_depth = {}
+        self._in_flight = 0
+        self._waiting = 0
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        note_callback_tap(update)
+        # Любое обновление от пользователя — активность за сегодня (по поясу DEFAULT_UTC_OFFSET)
+        if isinstance(update, Update) and update.effective_user:
+            note_daily_active(update.effective_user.id)
+        # Every update runs in its own task, so this only affects this update's API calls
+        outbound_priority.set(priority_for_update(update))
+        chat_id = update_chat_key(update)
+        enqueued_at = time.monotonic()
+        self._waiting += 1
+        metric_set("updates_waiting", self._waiting)
+
+        if chat_id is None:
+            async with self.workers:
+                await self._run(coroutine, enqueued_at)
+            return
+
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        depth = self._chat_depth[chat_id] = self._chat_depth.get(chat_id, 0) + 1
+        metric_max("updates_chat_queue_depth_max", depth)
+        metric_set("updates_active_chats", len(self._chat_locks))
+        try:
+            # Locks are FIFO, so updates of one chat are processed in arrival order
+            async with lock:
+                async with self.workers:
+                    # Запись пользователя не вытесняется, пока его обработчик не завершился
+                    user_data.pin(chat_id)
+                    try:
+                        await self._run(coroutine, enqueued_at)
+                    finally:
+                        user_data.unpin(chat_id)
+        finally:
+            self._chat_depth[chat_id] -= 1
+            if not self._chat_depth[chat_id]:
+                del self._chat_depth[chat_id]
+                del self._chat_locks[chat_id]
+            metric_set("updates_active_chats", len(self._chat_locks))
+
+    async def _run(self, coroutine, enqueued_at: float):
+        wait = time.monotonic() - enqueued_at
+        self._waiting -= 1
+        self._in_flight += 1
+        metric_set("updates_waiting", self._waiting)
+        metric_set("updates_in_flight", self._in_flight)
+        metric_inc("updates_processed_total")
+        metric_inc("updates_wait_seconds_total", wait)
+        metric_max("updates_wait_seconds_max", wait)
+        try:
+            await coroutine
+        finally:
+            self._in_flight -= 1
+            metric_set("updates_in_flight", self._in_flight)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# --- Outbound request scheduling ---
+
+# Класс приоритета исходящих запросов текущей задачи (апдейта или задачи JobQueue)
+outbound_priority = contextvars.ContextVar("outbound_priority", default="commands")
+
+def priority_for_update(update: object) -> str:
+    """Button taps and inline queries are interactive; everything else a user sends is a command."""
+    if isinstance(update, Update) and (update.callback_query or update.inline_query):
+        return "interactive"
+    return "commands"
+
+class TokenBucket:
+    """Classic token bucket; `delay()` says how long until a token is available."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class OutboundScheduler:
+    """
+    Shares the bot's Bot API budget between priority classes. Every class has its own
+    concurrency and rate share; on top of that one global rate limit is handed out
+    highest class first, so interactive edits overtake a running broadcast fan-out.
+    A class other than the lowest that has used up its share may borrow global tokens
+    while no lower class is waiting for one; the lowest (broadcast) never exceeds its share.
+    """
+
+    def __init__(self, limits: dict, total_rate: float):
+        self.classes = list(limits)
+        self.slots = {name: asyncio.Semaphore(limit["concurrency"]) for name, limit in limits.items()}
+        self.buckets = {name: TokenBucket(limit["rate"]) for name, limit in limits.items()}
+        self.total = TokenBucket(total_rate)
+        # Requests holding a concurrency slot and waiting for a rate token, per class
+        self.ready = {name: 0 for name in limits}
+        self.in_flight = {name: 0 for name in limits}
+
+    async def acquire(self, name: str, rate_limited: bool = True):
+        if name not in self.slots:
+            name = self.classes[-1]
+        started = time.monotonic()
+        await self.slots[name].acquire()
+        position = self.classes.index(name)
+        higher = self.classes[:position]
+        lower = self.classes[position + 1:]
+        self.ready[name] += 1
+        metric_set(f'outbound_waiting{{class="{name}"}}', self.ready[name])
+        try:
+            while rate_limited:
+                if any(self.ready[h] for h in higher):
+                    # Let higher-priority requests take the next global token first
+                    delay = 0.005
+                else:
+                    own_delay = self.buckets[name].delay()
+                    delay = self.total.delay()
+                    if own_delay and lower and not any(self.ready[l] for l in lower):
+                        # Своя доля исчерпана, но младшие классы простаивают — берём из общего лимита
+                        if delay == 0:
+                            self.total.take()
+                            metric_inc(f'outbound_borrowed_total{{class="{name}"}}')
+                            break
+                    else:
+                        delay = max(own_delay, delay)
+                        if delay == 0:
+                            self.buckets[name].take()
+                            self.total.take()
+                            break
+                await asyncio.sleep(delay)
+        except BaseException:
+            self.slots[name].release()
+            raise
+        finally:
+            self.ready[name] -= 1
+            metric_set(f'outbound_waiting{{class="{name}"}}', self.ready[name])
+
+        wait = time.monotonic() - started
+        self.in_flight[name] += 1
+        metric_set(f'outbound_in_flight{{class="{name}"}}', self.in_flight[name])
+        metric_inc(f'outbound_requests_total{{class="{name}"}}')
+        metric_inc(f'outbound_wait_seconds_total{{class="{name}"}}', wait)
+        metric_max(f'outbound_wait_seconds_max{{class="{name}"}}', wait)
+        return name
+
+    def release(self, name: str):
+        self.in_flight[name] -= 1
+        metric_set(f'outbound_in_flight{{class="{name}"}}', self.in_flight[name])
+        self.slots[name].release()
+
+class PriorityRequest(HTTPXRequest):
+    """HTTPXRequest that passes every Bot API call through the OutboundScheduler."""
+
+    def __init__(self, scheduler: OutboundScheduler, **kwargs):
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        # Only message-producing calls count towards Telegram's rate limits;
+        # answerCallbackQuery and friends just take a concurrency slot
+        api_method = url.rsplit("/", 1)[-1]
+        rate_limited = api_method.startswith(RATE_LIMITED_METHOD_PREFIXES)
+        name = await self.scheduler.acquire(outbound_priority.get(), rate_limited)
+        try:
+            return await super().do_request(url, method, request_data, **kwargs)
+        finally:
+            self.scheduler.release(name)
+
+# --- Event loop watchdog ---
+
+class LoopWatchdog:
+    """
+    Detects callbacks that hold the event loop for too long.
+
+    A heartbeat coroutine on the loop measures scheduling lag continuously; a watchdog
+    thread notices when the heartbeat stops and captures the loop thread's stack while the
+    loop is still blocked, together with the handler or job that owns the blocking frame.
+    """
+
+    def __init__(self, threshold: float, interval: float):
+        self.threshold = threshold
+        self.interval = interval
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.callback_names = {}
+        self._reported_heartbeat = None
+        self._task = None
+
+    def register_callbacks(self, application: Application):
+        """Maps the code objects of registered handlers and jobs to readable names."""
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                code = getattr(handler.callback, "__code__", None)
+                if code is not None:
+                    self.callback_names[code] = f"handler:{handler.callback.__name__}"
+        if application.job_queue:
+            for job in application.job_queue.jobs():
+                code = getattr(job.callback, "__code__", None)
+                if code is not None:
+                    # Per-bucket jobs share a callback, so name them by the callback itself
+                    name = job.name if job.callback.__name__ == "<lambda>" else job.callback.__name__
+                    self.callback_names[code] = f"job:{name}"
+
+    def start(self):
+        """Starts the heartbeat on the running loop and the watchdog thread."""
+        self.loop_thread_id = threading.get_ident()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        thread = threading.Thread(target=self._watch, name="LoopWatchdog", daemon=True)
+        thread.start()
+        logger.info(f"🐶 Loop watchdog started (threshold {self.threshold * 1000:.0f} ms)")
+
+    async def _heartbeat(self):
+        while True:
+            before = time.monotonic()
+            self.heartbeat = before
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - before - self.interval, 0.0)
+            metric_set("loop_lag_seconds", round(lag, 6))
+            metric_max("loop_lag_max_seconds", round(lag, 6))
+            if lag >= self.threshold:
+                metric_inc("loop_blocked_total")
+                metric_inc("loop_blocked_seconds_total", round(lag, 6))
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold or self._reported_heartbeat == heartbeat:
+                continue
+            self._reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            callback = self._owner(frame)
+            metric_inc(f'loop_blocked_by_total{{callback="{callback}"}}')
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning(f"🐢 Event loop blocked for {stalled * 1000:.0f} ms+ by {callback}:\n{stack}")
+
+    def _owner(self, frame) -> str:
+        """Returns the outermost registered handler/job on the stack, or the innermost bot.py function."""
+        owner, innermost = None, None
+        while frame is not None:
+            code = frame.f_code
+            if code in self.callback_names:
+                owner = self.callback_names[code]
+            if innermost is None and code.co_filename == __file__:
+                innermost = code.co_name
+            frame = frame.f_back
+        return owner or innermost or "unknown"
+
+loop_watchdog = None
+
+async def post_init(application: Application) -> None:
+    """Runs inside the event loop once the application is initialized."""
+    global loop_watchdog
+    if LOOP_WATCHDOG_THRESHOLD_MS > 0:
+        loop_watchdog = LoopWatchdog(LOOP_WATCHDOG_THRESHOLD_MS / 1000, LOOP_WATCHDOG_INTERVAL_MS / 1000)
+        loop_watchdog.register_callbacks(application)
+        loop_watchdog.start()
+
 def run_flask_server():
     """Запуск Flask-сервера для Render"""
     app = Flask(__name__)
@@ -1280,6 +3862,10 @@ def run_flask_server():
     def health_check():
         return "OK", 200
 
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
     port = int(os.environ.get("PORT", 10000))
     app.run(host='0.0.0.0', port=port, threaded=True)
 
@@ -1325,13 +3911,17 @@ def main() -> None:
     # Загружаем кэш и данные пользователей при запуске
     logger.info("📂 Загрузка кэша...")
     cache_loaded = load_cache_from_file()
+    quota_planner.load()
+    load_fx_rates_from_file()
     logger.info("📂 Загрузка данных пользователей...")
     load_user_data_from_file()
+    load_chat_timezones()
+    publish_daily_content()
 
     # Инициализация курсов криптовалют
     logger.info("📊 Инициализация курсов криптовалют...")
     if not cache_loaded:
-        update_crypto_prices()
+        update_crypto_prices(on_request=False)
     else:
         logger.info("✅ Используем кэшированные данные")
 
@@ -1353,12 +3943,38 @@ def main() -> None:
 
     # Инициализация бота с JobQueue
     logger.info("🤖 Инициализация Telegram бота...")
-    application = Application.builder().token(BOT_TOKEN).build()
+    outbound_scheduler = OutboundScheduler(OUTBOUND_LIMITS, OUTBOUND_TOTAL_RATE)
+    pool_size = sum(limit["concurrency"] for limit in OUTBOUND_LIMITS.values())
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .request(PriorityRequest(outbound_scheduler, connection_pool_size=pool_size))
+    )
+    # Процессор используется и при MAX_CONCURRENT_UPDATES=1 (по одному апдейту за раз):
+    # он же задаёт класс приоритета исходящих запросов каждого апдейта
+    builder = builder.concurrent_updates(PerChatUpdateProcessor(max(1, MAX_CONCURRENT_UPDATES)))
+    if MAX_CONCURRENT_UPDATES > 1:
+        logger.info(f"⚡ Параллельная обработка апдейтов: до {MAX_CONCURRENT_UPDATES} чатов одновременно")
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+        logger.info(f"🧪 Используется Bot API по адресу {BOT_API_BASE_URL}")
+    application = builder.build()
 
     # Регистрация обработчиков
+    if RECORD_UPDATES_FILE:
+        # Группа -1 выполняется до основных обработчиков и не мешает им
+        application.add_handler(TypeHandler(Update, record_update), group=-1)
+        logger.info(f"📼 Запись входящих апдейтов в {RECORD_UPDATES_FILE}")
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("astro", astro_command, filters=filters.ALL))
     application.add_handler(CommandHandler("day", day_command, filters=filters.ALL))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("campaign", campaign_command))
+    application.add_handler(CommandHandler("timezone", timezone_command))
+    application.add_handler(CommandHandler("chart", chart_command))
+    application.add_handler(InlineQueryHandler(inline_query_handler))
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(ChatMemberHandler(handle_new_chat_member, chat_member_types=ChatMemberHandler.MY_CHAT_MEMBER))
     # Payment handlers
@@ -1368,20 +3984,30 @@ def main() -> None:
 
     # Задачи JobQueue
     if application.job_queue:
-        moscow_tz = pytz.timezone("Europe/Moscow")
+        # Рассылка и подготовка контента следующего дня: по одной паре задач на часовой пояс,
+        # а не на пользователя — число задач растёт с числом поясов
+        for utc_offset in sorted(timezone_buckets()):
+            schedule_daily_jobs(application.job_queue, utc_offset)
 
-        # Schedule daily broadcast job
-        broadcast_time = datetime.strptime("00:00", "%H:%M").time().replace(tzinfo=moscow_tz)
-        application.job_queue.run_daily(broadcast_job, time=broadcast_time, name="daily_broadcast_job")
-        logger.info("📅 Daily broadcast job scheduled for 00:00 Moscow time.")
-
-        # Обновление курсов криптовалют каждые 5 минут
+        # Обновление курсов по спросу: интервал от PRICE_REFRESH_MIN_INTERVAL до PRICE_REFRESH_MAX_INTERVAL
         application.job_queue.run_repeating(
-            lambda context: update_crypto_prices(),
-            interval=300,
+            price_refresh_job,
+            interval=PRICE_REFRESH_MIN_INTERVAL,
             name="crypto_update"
         )
-        logger.info("📊 Обновление курсов криптовалют запланировано каждые 5 минут")
+        logger.info(
+            f"📊 Обновление курсов по спросу: каждые {PRICE_REFRESH_MIN_INTERVAL}–{PRICE_REFRESH_MAX_INTERVAL} с"
+        )
+
+        # FX-курсы для цен в RUB/CNY/EUR: проверка раз в час, запрос раз в FX_REFRESH_INTERVAL
+        application.job_queue.run_repeating(fx_refresh_job, interval=3600, first=10, name="fx_update")
+
+        # Личная утренняя рассылка: задача раз в слот, получатели распределены по окну
+        application.job_queue.run_repeating(daily_push_job, interval=DAILY_PUSH_SLOT_SECONDS, first=5, name="daily_push")
+        logger.info(
+            f"🔔 Личная рассылка: {push_window_label()} по времени пользователя, "
+            f"{DAILY_PUSH_SLOTS} слотов по {DAILY_PUSH_SLOT_SECONDS} с"
+        )
 
         # Периодическое сохранение кэша каждые 10 минут
         application.job_queue.run_repeating(
@@ -1399,6 +4025,12 @@ def main() -> None:
         )
         logger.info("💾 Автосохранение данных пользователей запланировано каждые 3 минуты")
 
+        # Профилирование первых N секунд работы (PROFILE_ON_START)
+        if PROFILE_ON_START > 0:
+            application.job_queue.run_once(profiling_job, 0, data={"action": "start", "mode": PROFILE_MODE}, name="profile_start")
+            application.job_queue.run_once(profiling_job, PROFILE_ON_START, data={"action": "stop"}, name="profile_stop")
+            logger.info(f"🔬 Профилирование ({PROFILE_MODE}) запланировано на первые {PROFILE_ON_START} секунд")
+
 
     logger.info("🤖 Бот запущен! Ожидание сообщений...")
 
@@ -1412,7 +4044,7 @@ def main() -> None:
             application.run_polling(
                 drop_pending_updates=True,
                 allowed_updates=Update.ALL_TYPES,
-                poll_interval=2.0,  # Увеличенный интервал для стабильности
+                poll_interval=POLL_INTERVAL,
                 close_loop=False,
                 timeout=30
             )
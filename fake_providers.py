@@ -0,0 +1,322 @@
+"""
+Local stand-ins for the CoinGecko, Binance and CryptoCompare price APIs.
+
+Each provider serves its real response shape and can be scripted per request:
+latency, 429 with Retry-After, 5xx, malformed JSON, hanging connections and
+partial coin coverage. The bot is pointed at them through the
+COINGECKO_API_URL / BINANCE_API_URL / CRYPTOCOMPARE_API_URL variables (and FX_API_URL
+for the static USD cross rates).
+
+Usage:
+    # serve the fakes and print the variables to export for bot.py
+    python fake_providers.py --port 8090 --script binance=429,ok --latency coingecko=200
+
+    # benchmark refresh latency and failover of update_crypto_prices() offline
+    # binance has the largest free tier and gets most refreshes, so failing it exercises failover
+    python fake_providers.py --bench 50 --script binance=500 --coins cryptocompare=btc,eth
+
+    # from Python (tests, other benchmarks)
+    providers = FakeProviders()
+    providers.start()
+    providers.configure("coingecko", script=["429", "ok"], latency_ms=50)
+    os.environ.update(providers.env())
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from aiohttp import web
+
+PROVIDERS = ["coingecko", "binance", "cryptocompare"]
+COINS = {
+    # our symbol: (CoinGecko id, Binance pair, CryptoCompare symbol, base price)
+    "btc": ("bitcoin", "BTCUSDT", "BTC", 60000.0),
+    "eth": ("ethereum", "ETHUSDT", "ETH", 3000.0),
+    "ton": ("the-open-network", "TONUSDT", "TON", 7.5),
+}
+PATHS = {
+    "coingecko": "/coingecko/api/v3/simple/price",
+    "binance": "/binance/api/v3/ticker/24hr",
+    "cryptocompare": "/cryptocompare/data/pricemultifull",
+}
+# USD cross rates served at FX_PATH in the open.er-api.com format
+FX_PATH = "/fx/v6/latest/USD"
+FX_RATES = {"USD": 1.0, "EUR": 0.92, "RUB": 92.0, "CNY": 7.2}
+# Possible outcomes of a scripted request
+OUTCOMES = {"ok", "429", "500", "502", "503", "malformed", "hang"}
+
+
+class ProviderBehaviour:
+    """Scripted behaviour of one fake provider."""
+
+    def __init__(self):
+        self.script = ["ok"]
+        self.latency_ms = 0.0
+        self.retry_after = 60
+        self.coins = list(COINS)
+        self.hang_seconds = 60.0
+        self.requests = 0
+        self.outcomes = {}
+
+    def next_outcome(self) -> str:
+        outcome = self.script[self.requests % len(self.script)]
+        self.requests += 1
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        return outcome
+
+
+class FakeProviders:
+    """Serves all three fake providers from one aiohttp application."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, seed: int = 0):
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.behaviour = {name: ProviderBehaviour() for name in PROVIDERS}
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    # --- Configuration -----------------------------------------------------
+
+    def configure(self, provider: str, script=None, latency_ms=None, retry_after=None,
+                  coins=None, hang_seconds=None):
+        """Changes a provider's behaviour; the script cycles over its outcomes."""
+        behaviour = self.behaviour[provider]
+        if script is not None:
+            unknown = set(script) - OUTCOMES
+            if unknown:
+                raise ValueError(f"Unknown outcomes for {provider}: {', '.join(sorted(unknown))}")
+            behaviour.script = list(script)
+            behaviour.requests = 0
+        if latency_ms is not None:
+            behaviour.latency_ms = float(latency_ms)
+        if retry_after is not None:
+            behaviour.retry_after = int(retry_after)
+        if coins is not None:
+            behaviour.coins = [c for c in coins if c in COINS]
+        if hang_seconds is not None:
+            behaviour.hang_seconds = float(hang_seconds)
+
+    def urls(self) -> dict:
+        return {name: f"http://{self.host}:{self.port}{path}" for name, path in PATHS.items()}
+
+    def env(self) -> dict:
+        """Environment variables that point bot.py at these fakes."""
+        urls = self.urls()
+        return {
+            "COINGECKO_API_URL": urls["coingecko"],
+            "BINANCE_API_URL": urls["binance"],
+            "CRYPTOCOMPARE_API_URL": urls["cryptocompare"],
+            "FX_API_URL": f"http://{self.host}:{self.port}{FX_PATH}",
+        }
+
+    # --- Server ------------------------------------------------------------
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        for name, path in PATHS.items():
+            app.router.add_get(path, self._handler(name))
+        app.router.add_get(FX_PATH, self._fx)
+        app.router.add_post("/_control/{provider}", self._control)
+        return app
+
+    async def start_async(self):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if not self.port:
+            self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop_async(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def start(self):
+        """Starts the server on a background thread (for synchronous callers like update_crypto_prices)."""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start_async())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="FakeProviders", daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        if self._loop:
+            asyncio.run_coroutine_threadsafe(self.stop_async(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    async def _fx(self, request: web.Request) -> web.Response:
+        return web.json_response({"result": "success", "base_code": "USD", "rates": FX_RATES})
+
+    async def _control(self, request: web.Request) -> web.Response:
+        provider = request.match_info["provider"]
+        if provider not in self.behaviour:
+            return web.json_response({"error": f"unknown provider {provider}"}, status=404)
+        try:
+            self.configure(provider, **(await request.json()))
+        except (TypeError, ValueError) as e:
+            return web.json_response({"error": str(e)}, status=400)
+        return web.json_response({"ok": True})
+
+    def _handler(self, provider: str):
+        async def handle(request: web.Request) -> web.Response:
+            behaviour = self.behaviour[provider]
+            outcome = behaviour.next_outcome()
+            if behaviour.latency_ms:
+                await asyncio.sleep(behaviour.latency_ms / 1000)
+
+            if outcome == "hang":
+                await asyncio.sleep(behaviour.hang_seconds)
+                outcome = "ok"
+            if outcome == "429":
+                return web.json_response(
+                    {"status": {"error_code": 429, "error_message": "You've exceeded the Rate Limit."}},
+                    status=429, headers={"Retry-After": str(behaviour.retry_after)},
+                )
+            if outcome in ("500", "502", "503"):
+                return web.Response(status=int(outcome), text="upstream error")
+            if outcome == "malformed":
+                return web.Response(text='{"bitcoin": {"usd": 600', content_type="application/json")
+
+            body, status = getattr(self, f"_{provider}_body")(request, behaviour.coins)
+            return web.json_response(body, status=status)
+        return handle
+
+    def _quote(self, symbol: str):
+        base = COINS[symbol][3]
+        return round(base * (1 + self.random.uniform(-0.02, 0.02)), 6), round(self.random.uniform(-5, 5), 4)
+
+    def _coingecko_body(self, request, coins):
+        body = {}
+        for symbol in coins:
+            price, change = self._quote(symbol)
+            body[COINS[symbol][0]] = {"usd": price, "usd_24h_change": change}
+        return body, 200
+
+    def _binance_body(self, request, coins):
+        pair = request.query.get("symbol")
+        symbol = next((s for s in coins if COINS[s][1] == pair), None)
+        if symbol is None:
+            return {"code": -1121, "msg": "Invalid symbol."}, 400
+        price, change = self._quote(symbol)
+        return {
+            "symbol": pair,
+            "lastPrice": f"{price:.8f}",
+            "priceChangePercent": f"{change:.3f}",
+            "openTime": int(time.time() * 1000) - 86400000,
+            "closeTime": int(time.time() * 1000),
+        }, 200
+
+    def _cryptocompare_body(self, request, coins):
+        raw = {}
+        for symbol in coins:
+            price, change = self._quote(symbol)
+            raw[COINS[symbol][2]] = {"USD": {"PRICE": price, "CHANGEPCT24HOUR": change}}
+        return {"RAW": raw, "DISPLAY": {}}, 200
+
+
+def _parse_assignments(values: list) -> dict:
+    """Parses ['coingecko=429,ok', ...] into {'coingecko': '429,ok'}."""
+    result = {}
+    for value in values or []:
+        provider, _, spec = value.partition("=")
+        if provider not in PROVIDERS:
+            raise SystemExit(f"Unknown provider: {provider}")
+        result[provider] = spec
+    return result
+
+
+def apply_cli_behaviour(providers: FakeProviders, args):
+    for provider, spec in _parse_assignments(args.script).items():
+        providers.configure(provider, script=spec.split(","))
+    for provider, spec in _parse_assignments(args.latency).items():
+        providers.configure(provider, latency_ms=float(spec))
+    for provider, spec in _parse_assignments(args.coins).items():
+        providers.configure(provider, coins=[c for c in spec.split(",") if c])
+    for provider in PROVIDERS:
+        providers.configure(provider, retry_after=args.retry_after, hang_seconds=args.hang_seconds)
+
+
+def run_bench(providers: FakeProviders, iterations: int):
+    """Times update_crypto_prices() against the fakes, bypassing the cache window."""
+    import logging
+
+    os.environ.update(providers.env())
+    os.chdir(tempfile.mkdtemp(prefix="astrokit-providers-"))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    logging.getLogger().setLevel(logging.CRITICAL)
+    bot.logger.setLevel(logging.CRITICAL)
+
+    latencies, sources = [], {}
+    for _ in range(iterations):
+        bot.api_cache["last_update"] = None
+        started = time.perf_counter()
+        bot.update_crypto_prices()
+        latencies.append((time.perf_counter() - started) * 1000)
+        for quote in bot.price_snapshot.quotes.values():
+            sources[quote.source] = sources.get(quote.source, 0) + 1
+
+    latencies.sort()
+    print(f"refreshes:   {iterations}")
+    print(f"latency ms:  p50 {latencies[len(latencies) // 2]:.1f}  "
+          f"p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]:.1f}  max {latencies[-1]:.1f}")
+    print("coin sources: " + ", ".join(f"{k}={v}" for k, v in sorted(sources.items())))
+    for name, behaviour in providers.behaviour.items():
+        print(f"{name:<14} requests={behaviour.requests} " +
+              " ".join(f"{k}={v}" for k, v in sorted(behaviour.outcomes.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake CoinGecko/Binance/CryptoCompare servers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--script", action="append", metavar="PROVIDER=OUTCOMES",
+                        help=f"comma-separated outcomes cycled per request: {', '.join(sorted(OUTCOMES))}")
+    parser.add_argument("--latency", action="append", metavar="PROVIDER=MS")
+    parser.add_argument("--coins", action="append", metavar="PROVIDER=btc,eth",
+                        help="coins the provider knows about (partial coverage)")
+    parser.add_argument("--retry-after", type=int, default=60)
+    parser.add_argument("--hang-seconds", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bench", type=int, metavar="N", help="run N refreshes of update_crypto_prices and exit")
+    args = parser.parse_args()
+
+    providers = FakeProviders(args.host, 0 if args.bench else args.port, args.seed)
+    apply_cli_behaviour(providers, args)
+
+    if args.bench:
+        providers.start()
+        try:
+            run_bench(providers, args.bench)
+        finally:
+            providers.stop()
+        return
+
+    async def serve():
+        await providers.start_async()
+        for key, value in providers.env().items():
+            print(f"export {key}={value}")
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+"""
+Record-and-replay load harness for the bot.
+
+Starts a local stand-in for the Telegram Bot API (getMe / getUpdates /
+sendMessage / editMessageText / answerCallbackQuery ...) with configurable
+latency and 429 (RetryAfter) injection, feeds it a stream of updates at a
+chosen rate and measures end-to-end latency: from the moment an update becomes
+available to getUpdates until the bot answers it. A message is answered by
+sendMessage / editMessageText / sendInvoice for the same chat, a callback tap by
+answerCallbackQuery for its query ID (coalesced taps and unchanged edits get no
+edit, only the answer).
+
+Updates can be recorded from a live bot by setting RECORD_UPDATES_FILE, or
+generated synthetically (the midnight /astro + zodiac tap surge).
+
+Usage:
+    # 1. run the harness and let it start the bot against the fake API
+    python loadtest.py --synthetic midnight --users 300 --rate 50 --spawn-bot
+
+    # 2. or run the bot yourself
+    python loadtest.py --replay updates.jsonl --speed 2 --port 8081
+    BOT_TOKEN=123:TEST BOT_API_BASE_URL=http://127.0.0.1:8081/bot python bot.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, web
+
+from locales import ZODIAC_SIGNS
+
+FAKE_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "AstroKit", "username": "astrokit_loadtest_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+RESPONSE_METHODS = {"sendMessage", "editMessageText", "sendInvoice"}
+CALLBACK_RESPONSE_METHOD = "answerCallbackQuery"
+
+
+class FakeBotAPI:
+    """In-memory Telegram Bot API stand-in."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 rate_429: float = 0.0, retry_after: int = 1, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+        self.updates = []
+        self.next_update_id = 1
+        self.updates_available = asyncio.Event()
+        self.first_poll = asyncio.Event()
+        self.next_message_id = 1000
+
+        # pending_key -> FIFO of enqueue timestamps still waiting for a response
+        self.pending = {}
+        self.latencies = []
+        self.method_counts = {}
+        self.injected_429 = 0
+
+    # --- Driver side -------------------------------------------------------
+
+    def enqueue(self, update: dict):
+        update = dict(update, update_id=self.next_update_id)
+        self.next_update_id += 1
+        self.updates.append(update)
+        key = _pending_key(update)
+        if key is not None:
+            self.pending.setdefault(key, []).append(time.perf_counter())
+        self.updates_available.set()
+
+    def unanswered(self) -> int:
+        return sum(len(v) for v in self.pending.values())
+
+    # --- HTTP side ---------------------------------------------------------
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await _read_params(request)
+        self.method_counts[method] = self.method_counts.get(method, 0) + 1
+
+        if method == "getUpdates":
+            self.first_poll.set()
+            return _ok(await self._get_updates(params))
+
+        delay = self.latency_ms + (self.random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        if method not in ("getMe", "deleteWebhook", "getWebhookInfo") and self.random.random() < self.rate_429:
+            self.injected_429 += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+
+        if method in RESPONSE_METHODS:
+            try:
+                self._record_response(int(params.get("chat_id")))
+            except (TypeError, ValueError):
+                pass
+        elif method == CALLBACK_RESPONSE_METHOD:
+            self._record_response(("callback", str(params.get("callback_query_id"))))
+
+        if method == "getMe":
+            return _ok(BOT_USER)
+        if method in ("sendMessage", "editMessageText", "sendInvoice"):
+            return _ok(self._message(params))
+        # deleteWebhook, answerCallbackQuery, answerPreCheckoutQuery, ...
+        return _ok(True)
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        if offset:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.updates_available.clear()
+            try:
+                await asyncio.wait_for(self.updates_available.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    def _record_response(self, key):
+        queue = self.pending.get(key)
+        if queue:
+            self.latencies.append(time.perf_counter() - queue.pop(0))
+
+    def _message(self, params: dict) -> dict:
+        message_id = params.get("message_id")
+        if message_id is None:
+            self.next_message_id += 1
+            message_id = self.next_message_id
+        chat_id = int(params.get("chat_id") or 0)
+        return {
+            "message_id": int(message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "text": str(params.get("text", "")),
+        }
+
+
+def _ok(result) -> web.Response:
+    return web.json_response({"ok": True, "result": result})
+
+
+async def _read_params(request: web.Request) -> dict:
+    if request.content_type == "application/json":
+        return await request.json()
+    params = {}
+    for key, value in (await request.post()).items():
+        # PTB sends every non-string parameter JSON-encoded
+        try:
+            params[key] = json.loads(value)
+        except (TypeError, ValueError):
+            params[key] = value
+    return params
+
+
+def _pending_key(update: dict):
+    """What answers an update: its callback query ID for taps, its chat for messages."""
+    if "callback_query" in update:
+        return "callback", update["callback_query"]["id"]
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    return None
+
+
+# --- Update streams ----------------------------------------------------------
+
+def _user(chat_id: int) -> dict:
+    return {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}", "language_code": "ru"}
+
+
+def command_update(chat_id: int, command: str) -> dict:
+    text = f"/{command}"
+    return {"message": {
+        "message_id": random.randint(1, 10 ** 6), "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"}, "from": _user(chat_id), "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+    }}
+
+
+def callback_update(chat_id: int, data: str, message_id: int = 1) -> dict:
+    return {"callback_query": {
+        "id": str(random.randint(1, 10 ** 12)), "from": _user(chat_id), "chat_instance": str(chat_id),
+        "data": data,
+        "message": {"message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": "menu"},
+    }}
+
+
+def synthetic_midnight(users: int, taps_per_user: int, seed: int = 0) -> list:
+    """
+    The post-00:00 surge: each user runs /astro, then taps through the zodiac menu.
+    Users start at random moments and pause between taps; their sequences are merged by
+    time, so users interleave but every user's own taps stay in the order a client sends them.
+    """
+    rng = random.Random(seed)
+    timed = []
+    for chat_id in range(10_000, 10_000 + users):
+        session = [command_update(chat_id, "astro"), callback_update(chat_id, "horoscope_menu")]
+        for _ in range(taps_per_user):
+            session.append(callback_update(chat_id, f"zodiac_{rng.choice(ZODIAC_SIGNS['ru'])}"))
+        session.append(callback_update(chat_id, "main_menu"))
+        # Начала сеансов плотно: в первые минуты после полуночи сеансы сильно перекрываются
+        t = rng.uniform(0, max(1.0, users / 10))
+        for update in session:
+            timed.append((t, len(timed), update))
+            t += rng.expovariate(1.0)  # пауза между нажатиями одного пользователя
+    timed.sort()
+    return [(None, update) for _, _, update in timed]
+
+
+def synthetic_mixed(users: int, count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    choices = ["main_menu", "horoscope_menu", "learning_tip", "settings_menu"] + \
+              [f"zodiac_{s}" for s in ZODIAC_SIGNS["ru"]]
+    stream = []
+    for _ in range(count):
+        chat_id = 10_000 + rng.randrange(users)
+        roll = rng.random()
+        if roll < 0.1:
+            stream.append(command_update(chat_id, "astro"))
+        elif roll < 0.15:
+            stream.append(command_update(chat_id, "day"))
+        else:
+            stream.append(callback_update(chat_id, rng.choice(choices)))
+    return [(None, u) for u in stream]
+
+
+def load_recording(path: str) -> list:
+    """Reads a RECORD_UPDATES_FILE recording as [(relative_time, update_dict)]."""
+    stream = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                update = entry["update"]
+                update.pop("update_id", None)
+                stream.append((entry.get("t"), update))
+    return stream
+
+
+# --- Driver ------------------------------------------------------------------
+
+async def replay(api: FakeBotAPI, stream: list, rate: float, speed: float):
+    """Feeds the stream at a fixed rate, or at recorded timing scaled by `speed`."""
+    started = time.perf_counter()
+    for i, (t, update) in enumerate(stream):
+        if rate:
+            due = i / rate
+        elif t is not None:
+            due = t / speed
+        else:
+            due = 0
+        delay = started + due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        api.enqueue(update)
+    return time.perf_counter() - started
+
+
+def _percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def report(api: FakeBotAPI, sent: int, send_seconds: float, total_seconds: float):
+    lat = [x * 1000 for x in api.latencies]
+    unanswered = api.unanswered()
+    print(f"updates sent:      {sent} in {send_seconds:.1f}s ({sent / send_seconds if send_seconds else 0:.1f}/s)")
+    print(f"responses:         {len(lat)} ({len(lat) / total_seconds if total_seconds else 0:.1f}/s)")
+    print(f"unanswered:        {unanswered} (error rate {unanswered / sent * 100 if sent else 0:.2f}%)")
+    print(f"injected 429:      {api.injected_429}")
+    print(f"latency ms:        p50 {_percentile(lat, 0.5):.1f}  p95 {_percentile(lat, 0.95):.1f}  "
+          f"p99 {_percentile(lat, 0.99):.1f}  max {max(lat) if lat else 0:.1f}")
+    print("api calls:         " + ", ".join(f"{k}={v}" for k, v in sorted(api.method_counts.items())))
+
+
+async def print_bot_metrics(port: int, prefixes: list):
+    """Prints selected metrics scraped from the spawned bot (event loop lag, queues, ...)."""
+    try:
+        async with ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                text = await response.text()
+    except Exception as e:
+        print(f"bot metrics:       unavailable ({e})")
+        return
+    lines = [line for line in text.splitlines() if line.startswith(tuple(prefixes))]
+    print("bot metrics:")
+    for line in lines:
+        print(f"  {line}")
+
+
+async def main_async(args):
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms, args.rate_429, args.retry_after, args.seed)
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    app.router.add_get("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    base_url = f"http://{args.host}:{args.port}/bot"
+    print(f"Fake Bot API listening on {base_url}")
+
+    if args.replay:
+        stream = load_recording(args.replay)
+    elif args.synthetic == "midnight":
+        stream = synthetic_midnight(args.users, args.taps, args.seed)
+    else:
+        stream = synthetic_mixed(args.users, args.count, args.seed)
+
+    bot_process = None
+    if args.spawn_bot:
+        env = dict(os.environ, BOT_TOKEN=FAKE_TOKEN, BOT_API_BASE_URL=base_url, PORT=str(args.bot_http_port))
+        env.pop("RENDER", None)
+        env.pop("RENDER_EXTERNAL_URL", None)
+        bot_process = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")],
+            env=env, cwd=tempfile.mkdtemp(prefix="astrokit-loadtest-"),
+            stdout=subprocess.DEVNULL if not args.bot_logs else None,
+            stderr=subprocess.DEVNULL if not args.bot_logs else None,
+        )
+    else:
+        print(f"Start the bot with BOT_TOKEN={FAKE_TOKEN} BOT_API_BASE_URL={base_url}")
+
+    try:
+        print("Waiting for the bot to start polling...")
+        await api.first_poll.wait()
+        # run_polling drops pending updates on startup; give it one poll cycle
+        await asyncio.sleep(1)
+        print(f"Replaying {len(stream)} updates...")
+        started = time.perf_counter()
+        send_seconds = await replay(api, stream, args.rate, args.speed)
+
+        deadline = time.perf_counter() + args.drain
+        while api.unanswered() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+        report(api, len(stream), send_seconds, time.perf_counter() - started)
+        if bot_process:
+            await print_bot_metrics(args.bot_http_port, args.metrics_prefix)
+    finally:
+        if bot_process:
+            bot_process.send_signal(signal.SIGINT)
+            try:
+                bot_process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                bot_process.kill()
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay update streams against a local fake Bot API")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--replay", metavar="FILE", help="JSONL recording produced via RECORD_UPDATES_FILE")
+    source.add_argument("--synthetic", choices=["midnight", "mixed"], default="midnight")
+    parser.add_argument("--users", type=int, default=200, help="synthetic users")
+    parser.add_argument("--taps", type=int, default=3, help="zodiac taps per user (midnight)")
+    parser.add_argument("--count", type=int, default=2000, help="updates (mixed)")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="updates per second; 0 replays recorded timing (or as fast as possible)")
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression for recorded timing")
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="fake API latency per call")
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="probability of answering 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after returned with 429")
+    parser.add_argument("--drain", type=float, default=30.0, help="seconds to wait for outstanding responses")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--spawn-bot", action="store_true", help="start bot.py against the fake API")
+    parser.add_argument("--bot-http-port", type=int, default=10080, help="PORT for the spawned bot's Flask server")
+    parser.add_argument("--bot-logs", action="store_true", help="show the spawned bot's output")
+    parser.add_argument("--metrics-prefix", nargs="+", default=["loop_", "updates_"],
+                        help="metric name prefixes to print from the spawned bot's /metrics")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
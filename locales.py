@@ -187,6 +187,91 @@ TEXTS = {
         "en": "💌 Support",
         "zh": "💌 支持"
     },
+    "timezone_button": {
+        "ru": "🕐 Часовой пояс",
+        "en": "🕐 Time Zone",
+        "zh": "🕐 时区"
+    },
+    "timezone_title": {
+        "ru": "Часовой пояс",
+        "en": "Time Zone",
+        "zh": "时区"
+    },
+    "timezone_description": {
+        "ru": "Новый гороскоп и совет дня появляются в полночь по вашему времени.\n\nСейчас: {timezone}",
+        "en": "The new horoscope and tip of the day arrive at midnight in your time zone.\n\nCurrent: {timezone}",
+        "zh": "新的星座运势和每日提示将在您所在时区的午夜更新。\n\n当前：{timezone}"
+    },
+    "timezone_set": {
+        "ru": "Часовой пояс установлен: {timezone}",
+        "en": "Time zone set: {timezone}",
+        "zh": "时区已设置：{timezone}"
+    },
+    "timezone_usage": {
+        "ru": "Использование: /timezone +3 (или +5:30, -8)",
+        "en": "Usage: /timezone +3 (or +5:30, -8)",
+        "zh": "用法：/timezone +3（或 +5:30、-8）"
+    },
+    "timezone_admin_only": {
+        "ru": "Часовой пояс чата может изменить только администратор.",
+        "en": "Only a chat administrator can change the chat's time zone.",
+        "zh": "只有聊天管理员可以更改聊天的时区。"
+    },
+    "chart_button": {
+        "ru": "📈 График",
+        "en": "📈 Chart",
+        "zh": "📈 图表"
+    },
+    "chart_unavailable": {
+        "ru": "Картинки с графиком сейчас недоступны.",
+        "en": "Chart images are not available right now.",
+        "zh": "图表图片暂时不可用。"
+    },
+    "currency_button": {
+        "ru": "💱 Валюта",
+        "en": "💱 Currency",
+        "zh": "💱 货币"
+    },
+    "currency_title": {
+        "ru": "Валюта цен",
+        "en": "Price Currency",
+        "zh": "价格货币"
+    },
+    "currency_description": {
+        "ru": "В какой валюте показывать курсы криптовалют.\n\nСейчас: {currency}",
+        "en": "The currency used to show crypto prices.\n\nCurrent: {currency}",
+        "zh": "显示加密货币价格所用的货币。\n\n当前：{currency}"
+    },
+    "daily_push_button": {
+        "ru": "🔔 Утренний гороскоп",
+        "en": "🔔 Morning Horoscope",
+        "zh": "🔔 早间运势"
+    },
+    "daily_push_title": {
+        "ru": "Утренний гороскоп",
+        "en": "Morning Horoscope",
+        "zh": "早间运势"
+    },
+    "daily_push_description": {
+        "ru": "Каждое утро бот пришлёт гороскоп вашего знака и совет дня. Выберите знак, чтобы подписаться.\n\n{status}",
+        "en": "Every morning the bot sends the horoscope for your sign and the tip of the day. Pick a sign to subscribe.\n\n{status}",
+        "zh": "每天早上机器人会发送您星座的运势和每日提示。选择星座即可订阅。\n\n{status}"
+    },
+    "daily_push_status_on": {
+        "ru": "Сейчас: {sign}, {window} ({timezone})",
+        "en": "Current: {sign}, between {window} ({timezone})",
+        "zh": "当前：{sign}，{window}（{timezone}）"
+    },
+    "daily_push_status_off": {
+        "ru": "Сейчас: выключено",
+        "en": "Current: off",
+        "zh": "当前：已关闭"
+    },
+    "daily_push_off_button": {
+        "ru": "🔕 Отписаться",
+        "en": "🔕 Unsubscribe",
+        "zh": "🔕 取消订阅"
+    },
 
     # --- Premium / Support ---
     "premium_menu_title": {
@@ -303,9 +388,9 @@ TEXTS = {
         "zh": "可用命令:"
     },
     "commands_info_body": {
-        "ru": "AstroKit можно добавить в ваш чат или канал!\n\n/astro - присылает гороскоп для всех знаков зодиака\n/day - присылает совет дня\n\nДля настройки бота в вашем чате обратитесь в {support_link}.",
-        "en": "AstroKit can be added to your chat or channel!\n\n/astro - sends a horoscope for all zodiac signs\n/day - sends the tip of the day\n\nTo set up the bot in your chat, contact {support_link}.",
-        "zh": "AstroKit可以添加到您的聊天或频道中！\n\n/astro - 发送所有星座的星座运势\n/day - 发送每日提示\n\n要在您的聊天中设置机器人，请联系{support_link}。"
+        "ru": "AstroKit можно добавить в ваш чат или канал!\n\n/astro - присылает гороскоп для всех знаков зодиака\n/day - присылает совет дня\n/chart - картинка с курсами и графиком\n/timezone +3 - часовой пояс ежедневной рассылки в чате\n\nДля настройки бота в вашем чате обратитесь в {support_link}.",
+        "en": "AstroKit can be added to your chat or channel!\n\n/astro - sends a horoscope for all zodiac signs\n/day - sends the tip of the day\n/chart - an image with rates and a chart\n/timezone +3 - time zone of the daily broadcast in a chat\n\nTo set up the bot in your chat, contact {support_link}.",
+        "zh": "AstroKit可以添加到您的聊天或频道中！\n\n/astro - 发送所有星座的星座运势\n/day - 发送每日提示\n/chart - 带有汇率和图表的图片\n/timezone +3 - 聊天中每日推送的时区\n\n要在您的聊天中设置机器人，请联系{support_link}。"
     },
     "support_info_text": {
         "ru": "По всем вопросам, связанным с предложениями, ошибками или сотрудничеством, пожалуйста, обращайтесь в нашу {support_link}.",
@@ -0,0 +1,41 @@
+import asyncio
+import os
+import tempfile
+from types import SimpleNamespace
+
+os.environ.setdefault("USER_STORE_PATH", os.path.join(tempfile.mkdtemp(), "user_data.db"))
+
+import bot
+from bench_handlers import FakeBot, stub_price_providers
+from telegram.error import ChatMigrated
+
+stub_price_providers()
+
+
+class MigratingBot(FakeBot):
+    """Answers sends to `old_id` with ChatMigrated, like Telegram after a group upgrade."""
+
+    def __init__(self, old_id: int, new_id: int):
+        super().__init__()
+        self.old_id = old_id
+        self.new_id = new_id
+        self.delivered = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == self.old_id:
+            raise ChatMigrated(self.new_id)
+        self.delivered.append(chat_id)
+        return True
+
+
+def test_migrated_chat_gets_the_broadcast_under_the_new_id(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    old_id, new_id = -2601, -1002601
+    bot.save_broadcast_chats([old_id])
+    fake_bot = MigratingBot(old_id, new_id)
+    job = SimpleNamespace(data={"utc_offset": bot.DEFAULT_UTC_OFFSET})
+
+    asyncio.run(bot.broadcast_job(SimpleNamespace(bot=fake_bot, job=job)))
+
+    assert fake_bot.delivered == [new_id]
+    assert bot.load_broadcast_chats() == [new_id]
@@ -0,0 +1,59 @@
+import asyncio
+import os
+import tempfile
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+os.environ.setdefault("USER_STORE_PATH", os.path.join(tempfile.mkdtemp(), "user_data.db"))
+
+import bot
+from bench_handlers import FakeBot, make_user, stub_price_providers
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+stub_price_providers()
+
+
+def tap(fake_bot: FakeBot, chat_id: int, message_id: int, data: str, update_id: int) -> Update:
+    """A button tap on an existing bot message; several taps may share the message."""
+    user = User(chat_id, "Test", False)
+    message = Message(message_id, datetime.now(timezone.utc), Chat(chat_id, Chat.PRIVATE), from_user=user, text="menu")
+    update = Update(update_id, callback_query=CallbackQuery(str(update_id), user, "test", message=message, data=data))
+    for obj in (update, update.callback_query, message):
+        obj.set_bot(fake_bot)
+    return update
+
+
+def test_superseded_language_tap_is_still_applied():
+    chat_id = 3301
+    make_user(chat_id, "ru")
+    fake_bot = FakeBot()
+    context = SimpleNamespace(bot=fake_bot, job_queue=None)
+    language_tap = tap(fake_bot, chat_id, 10, "set_lang_en", 101)
+    menu_tap = tap(fake_bot, chat_id, 10, "main_menu", 102)
+    bot.note_callback_tap(language_tap)
+    bot.note_callback_tap(menu_tap)
+    coalesced = bot.metrics.get("callback_taps_coalesced_total", 0)
+
+    asyncio.run(bot.button_handler(language_tap, context))
+    assert bot.user_data[chat_id]["language"] == "en"
+    assert bot.metrics["callback_taps_coalesced_total"] == coalesced + 1
+
+    asyncio.run(bot.button_handler(menu_tap, context))
+    assert bot.user_data[chat_id]["language"] == "en"
+
+
+def test_superseded_navigation_tap_is_skipped():
+    chat_id = 3302
+    make_user(chat_id, "ru")
+    fake_bot = FakeBot()
+    context = SimpleNamespace(bot=fake_bot, job_queue=None)
+    first = tap(fake_bot, chat_id, 11, "settings_menu", 201)
+    second = tap(fake_bot, chat_id, 11, "main_menu", 202)
+    bot.note_callback_tap(first)
+    bot.note_callback_tap(second)
+    edits = bot.metrics.get("edits_sent_total", 0)
+
+    asyncio.run(bot.button_handler(first, context))
+    assert bot.metrics.get("edits_sent_total", 0) == edits
+    asyncio.run(bot.button_handler(second, context))
+    assert bot.metrics["edits_sent_total"] == edits + 1
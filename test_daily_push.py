@@ -0,0 +1,100 @@
+import asyncio
+import os
+import tempfile
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+os.environ.setdefault("USER_STORE_PATH", os.path.join(tempfile.mkdtemp(), "user_data.db"))
+
+import bot
+from bench_handlers import FakeBot, make_callback_update, make_user, stub_price_providers
+from telegram.error import NetworkError
+
+stub_price_providers()
+
+
+class PushBot(FakeBot):
+    """Records daily pushes; the first `failures` sends to `failing_chat` raise a transient error."""
+
+    def __init__(self, failing_chat: int = None, failures: int = 0):
+        super().__init__()
+        self.failing_chat = failing_chat
+        self.failures = failures
+        self.pushes = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == self.failing_chat and self.failures:
+            self.failures -= 1
+            raise NetworkError("connection reset")
+        self.pushes.append((chat_id, text))
+        return True
+
+
+def freeze_clock(monkeypatch, moment: datetime):
+    monkeypatch.setattr(bot, "local_now", lambda utc_offset: moment.replace(tzinfo=bot.offset_tz(utc_offset)))
+
+
+def run_push_job(fake_bot):
+    asyncio.run(bot.daily_push_job(SimpleNamespace(bot=fake_bot)))
+
+
+def test_viewing_another_sign_keeps_push_sign():
+    chat_id = 4901
+    make_user(chat_id, "en")
+    fake_bot = FakeBot()
+    context = SimpleNamespace(bot=fake_bot)
+    asyncio.run(bot.button_handler(make_callback_update(fake_bot, chat_id, "push_sign_Лев"), context))
+    asyncio.run(bot.button_handler(make_callback_update(fake_bot, chat_id, "zodiac_Рыбы", 2), context))
+
+    user_info = bot.user_data[chat_id]
+    assert user_info["zodiac"] == "Рыбы"
+    assert user_info["push_zodiac"] == "Лев"
+    assert "Leo" in bot.format_daily_push(chat_id)
+    checked = [
+        button.callback_data
+        for row in bot.daily_push_keyboard("en", user_info["push_zodiac"]).inline_keyboard
+        for button in row if button.text.startswith("✅")
+    ]
+    assert checked == ["push_sign_Лев"]
+    # /campaign sign=... targets the user's own sign, not the last viewed one
+    assert chat_id in bot.user_index.fields["zodiac"]["Лев"]
+    assert chat_id not in bot.user_index.fields["zodiac"].get("Рыбы", set())
+    bot.set_daily_push(chat_id, None)
+    assert chat_id in bot.user_index.fields["zodiac"]["Лев"]
+
+
+def test_transient_failure_is_retried(monkeypatch):
+    chat_id = 4902
+    make_user(chat_id, "ru")
+    bot.set_daily_push(chat_id, "Овен")
+    offset = bot.get_user_offset(chat_id)
+    start = datetime.combine(datetime(2026, 3, 10), bot.bucket_time(bot.DAILY_PUSH_WINDOW_START, offset))
+    slot_time = start.replace(tzinfo=None) + timedelta(seconds=bot.push_slot(chat_id) * bot.DAILY_PUSH_SLOT_SECONDS + 1)
+    bot.push_progress.clear()
+    bot.push_retries.clear()
+
+    fake_bot = PushBot(chat_id, failures=1)
+    freeze_clock(monkeypatch, slot_time)
+    run_push_job(fake_bot)
+    assert bot.user_data[chat_id]["push_day"] != "2026-03-10"
+
+    freeze_clock(monkeypatch, slot_time + timedelta(minutes=1))
+    run_push_job(fake_bot)
+    run_push_job(fake_bot)
+    assert [pushed for pushed, _ in fake_bot.pushes].count(chat_id) == 1
+    assert bot.user_data[chat_id]["push_day"] == "2026-03-10"
+    bot.set_daily_push(chat_id, None)
+
+
+def test_window_across_midnight_keeps_late_slots(monkeypatch):
+    monkeypatch.setattr(bot, "DAILY_PUSH_WINDOW_START", "23:00")
+    bot.push_progress.clear()
+
+    freeze_clock(monkeypatch, datetime(2026, 3, 10, 23, 30))
+    day, slots = bot.due_push_slots(0)
+    assert day.isoformat() == "2026-03-10" and slots.stop == 31
+
+    freeze_clock(monkeypatch, datetime(2026, 3, 11, 0, 30))
+    day, slots = bot.due_push_slots(0)
+    assert day.isoformat() == "2026-03-10"
+    assert (slots.start, slots.stop) == (31, 91)
@@ -0,0 +1,45 @@
+import asyncio
+import os
+import tempfile
+from datetime import datetime, timezone
+
+os.environ.setdefault("USER_STORE_PATH", os.path.join(tempfile.mkdtemp(), "user_data.db"))
+
+import bot
+from bench_handlers import FakeBot, make_command_update
+
+
+def freeze_clock(monkeypatch, moment: datetime):
+    monkeypatch.setattr(bot, "local_now", lambda utc_offset: moment.astimezone(bot.offset_tz(utc_offset)))
+
+
+def send_updates(chat_ids):
+    async def process():
+        processor = bot.PerChatUpdateProcessor(4)
+        fake_bot = FakeBot()
+        for update_id, chat_id in enumerate(chat_ids, 1):
+            await processor.do_process_update(make_command_update(fake_bot, chat_id, "start", update_id), asyncio.sleep(0))
+
+    asyncio.run(process())
+
+
+def test_dau_does_not_drop_when_one_zone_passes_midnight(monkeypatch):
+    east, west = 4701, 4702
+    bot.set_user_offset(east, 720)  # UTC+12
+    bot.set_user_offset(west, -300)  # UTC-5
+    with bot.daily_active_lock:
+        bot.daily_active.clear()
+        bot._rebuild_weekly_active()
+
+    # 20:30 UTC: already the next day in UTC+12, still the same day in UTC-5 and in the reference zone
+    freeze_clock(monkeypatch, datetime(2026, 3, 10, 20, 30, tzinfo=timezone.utc))
+    assert bot.local_now(720).date() != bot.local_now(-300).date()
+    send_updates([east, west, east])
+    assert bot.daily_active_count(1) == 2
+    assert bot.daily_active_count(7) == 2
+
+    # 21:30 UTC: the reference zone (UTC+3) starts a new day; yesterday's actives stay in WAU
+    freeze_clock(monkeypatch, datetime(2026, 3, 10, 21, 30, tzinfo=timezone.utc))
+    send_updates([west])
+    assert bot.daily_active_count(1) == 1
+    assert bot.daily_active_count(7) == 2